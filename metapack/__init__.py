@@ -12,5 +12,15 @@ from .package import open_package, Downloader
 from .appurl import MetapackUrl, MetapackDocumentUrl, MetapackResourceUrl, MetapackPackageUrl
 from .terms import Resource
 
-from metapack.jupyter.magic import load_ipython_extension, unload_ipython_extension
 
+# The IPython extension hooks import metapack.jupyter.magic when they are called, so importing
+# metapack does not import IPython or nbconvert
+
+def load_ipython_extension(ipython):
+    from metapack.jupyter.magic import load_ipython_extension
+    return load_ipython_extension(ipython)
+
+
+def unload_ipython_extension(ipython):
+    from metapack.jupyter.magic import unload_ipython_extension
+    return unload_ipython_extension(ipython)
@@ -6,15 +6,90 @@
 """
 
 
+from collections import namedtuple
+from functools import lru_cache
+
 from metapack.exc import MetapackError, ResourceError
 from appurl.util import parse_url_to_dict, unparse_url_dict, file_ext
 from os.path import basename, join, dirname
-from appurl import Url, parse_app_url, DownloadError
+from appurl import Url, DownloadError
+from appurl import parse_app_url as _parse_app_url
 from appurl.web import WebUrl
 from appurl.file import FileUrl
 
 from metatab import DEFAULT_METATAB_FILE
 
+URL_CACHE_SIZE = 8192
+
+# Immutable, parsed parts of a URL string, for code that only needs to inspect the URL
+UrlParts = namedtuple('UrlParts', 'url scheme proto scheme_extension netloc path fragment '
+                                  'resource_format target_format encoding')
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def _url_class(u_str):
+    """Return the Url class that parse_app_url() selects for a URL string, and the default downloader"""
+
+    u = _parse_app_url(u_str)
+
+    if u is None:
+        return None, None
+
+    return type(u), getattr(u, "_downloader", None)
+
+
+def parse_app_url(u_str, downloader=None, **kwargs):
+    """Like appurl.parse_app_url(), but memoizes the entry point matching that selects the Url class, so
+    parsing a URL string that has been parsed before only constructs the Url object. Returns a new,
+    mutable Url on every call"""
+
+    if not u_str or isinstance(u_str, Url) or not isinstance(u_str, str) or kwargs:
+        if downloader is None:
+            return _parse_app_url(u_str, **kwargs)
+        return _parse_app_url(u_str, downloader=downloader, **kwargs)
+
+    cls, default_downloader = _url_class(u_str)
+
+    if cls is None:
+        return None
+
+    return cls(u_str, downloader=downloader or default_downloader)
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def url_parts(u_str):
+    """Return the UrlParts for a URL string. The result is shared, and is a dictionary lookup
+    for strings that have been seen before"""
+
+    u = parse_app_url(str(u_str))
+
+    def _a(name):
+        try:
+            return getattr(u, name)
+        except Exception:
+            return None
+
+    fragment = _a('fragment')
+
+    return UrlParts(str(u_str), _a('scheme'), _a('proto'), _a('scheme_extension'), _a('netloc'), _a('path'),
+                    tuple(fragment) if isinstance(fragment, (list, tuple)) else fragment,
+                    _a('resource_format'), _a('target_format'), _a('encoding'))
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def _has_fragment(u_str):
+    return bool(Url(u_str).fragment[0])
+
+
+def _document_path(path):
+    """If there is no file with an extension in the path, assume that this
+    is a filesystem package, and that the path should have DEFAULT_METATAB_FILE"""
+
+    if file_ext(basename(path)) not in ('zip', 'xlsx', 'csv'):
+        return join(path, DEFAULT_METATAB_FILE)
+
+    return path
+
 
 class _MetapackUrl(object):
 
@@ -36,10 +111,7 @@ class MetapackDocumentUrl(Url, _MetapackUrl):
 
         assert downloader
 
-        # If there is no file with an extension in the path, assume that this
-        # is a filesystem package, and that the path should have DEFAULT_METATAB_FILE
-        if file_ext(basename(u.path)) not in ('zip', 'xlsx', 'csv'):
-            u.path = join(u.path, DEFAULT_METATAB_FILE)
+        u.path = _document_path(u.path)
 
         super().__init__(str(u), downloader=downloader, **kwargs)
 
@@ -110,6 +182,13 @@ class MetapackDocumentUrl(Url, _MetapackUrl):
         t = self.get_resource().get_target()
         return MetapackDoc(t, package_url=self.package_url)
 
+    @property
+    def shared_doc(self):
+        """Return a cached, read-only metatab document for the URL. Use doc to get a
+        document that can be altered. """
+        from metapack.doc import shared_doc
+        return shared_doc(self)
+
     @property
     def generator(self):
 
@@ -126,7 +205,7 @@ class MetapackDocumentUrl(Url, _MetapackUrl):
             # For CSV packages, need to get the package and open it to get the resoruce URL, becuase
             # they are always absolute web URLs and may not be related to the location of the metadata.
             s = self.get_resource()
-            rs = s.doc.resource(resource_name)
+            rs = s.shared_doc.resource(resource_name)
             return parse_app_url(rs.url)
         else:
             jt = self.join_target(resource_name)
@@ -254,7 +333,7 @@ class MetapackPackageUrl(FileUrl, _MetapackUrl):
             # For CSV packages, need to get the package and open it to get the resource URL, because
             # they are always absolute web URLs and may not be related to the location of the metadata.
             s = self.get_resource()
-            rs = s.metadata_url.doc.resource(resource_name)
+            rs = s.metadata_url.shared_doc.resource(resource_name)
             if rs is not None:
                 t = parse_app_url(rs.url)
             else:
@@ -286,13 +365,7 @@ class MetapackResourceUrl(FileUrl, _MetapackUrl):
         self.scheme_extension = 'metapack'
 
         # Expand the path in the same was as the document URL
-
-        # Using .clone() causes recursion
-        d = self.dict
-        d['fragment'] = None
-
-        md = MetapackDocumentUrl(None,downloader = downloader, **d)
-        self.path = md.path
+        self.path = _document_path(self.path)
 
         self.base_url = base_url
 
@@ -317,6 +390,12 @@ class MetapackResourceUrl(FileUrl, _MetapackUrl):
         """Return the metatab document for the URL"""
         return self.metadata_url.doc
 
+    @property
+    def shared_doc(self):
+        """Return a cached, read-only metatab document for the URL. Use doc to get a
+        document that can be altered. """
+        return self.metadata_url.shared_doc
+
     @property
     def metadata_url(self):
         assert self._downloader
@@ -337,7 +416,8 @@ class MetapackResourceUrl(FileUrl, _MetapackUrl):
             return mru
 
     def get_target(self):
-        return self.resource.resolved_url.get_resource().get_target()
+        # Only reads the resource's URL, so the shared document is safe to use
+        return self.shared_doc.resource(self.target_file).resolved_url.get_resource().get_target()
 
 
     @property
@@ -362,9 +442,12 @@ class MetapackUrl(Url):
 
         assert downloader
 
-        u = Url(url, **kwargs)
+        if kwargs or not isinstance(url, str):
+            has_fragment = Url(url, **kwargs).fragment[0]
+        else:
+            has_fragment = _has_fragment(url)
 
-        if u.fragment[0]:
+        if has_fragment:
             return MetapackResourceUrl(url, downloader, **kwargs)
         else:
             return MetapackDocumentUrl(url, downloader, **kwargs)
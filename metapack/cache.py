@@ -0,0 +1,223 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Manage the size of the download cache, with a byte budget, eviction of the least recently
+accessed files, and pins for files that should never be evicted.
+"""
+
+import json
+from collections import namedtuple
+from os import walk, remove, stat, utime, environ
+from os.path import join, relpath, exists
+from threading import Lock
+from time import time
+
+PINS_FILE = '_pins.json'
+
+# Files in the cache that are bookkeeping, not cached content
+_SYSTEM_SUFFIXES = ('.lock', '.part')
+
+CacheEntry = namedtuple('CacheEntry', 'path size atime pinned')
+
+
+def parse_size(v):
+    """Parse a size like '500M' or '10G' into a number of bytes"""
+
+    if v is None:
+        return None
+
+    if isinstance(v, int):
+        return v
+
+    v = str(v).strip().upper().rstrip('B')
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+    if v and v[-1] in units:
+        return int(float(v[:-1]) * units[v[-1]])
+
+    return int(v)
+
+
+def format_size(n):
+
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(n) < 1024:
+            return "{:.1f}{}".format(n, unit) if unit != 'B' else "{}B".format(n)
+        n /= 1024.0
+
+    return "{:.1f}T".format(n)
+
+
+def cache_path_for_url(url):
+    """Return the path, relative to the cache root, where the Downloader stores a URL"""
+    import hashlib
+    from os.path import dirname, basename
+    from urllib.parse import urlparse
+
+    parsed = urlparse(str(url))
+
+    cache_path = join(parsed.netloc, parsed.path.strip('/'))
+
+    if parsed.query:
+        hash = hashlib.sha224(parsed.query.encode('utf8')).hexdigest()
+        cache_path = join(dirname(cache_path), hash, basename(cache_path))
+
+    return cache_path
+
+
+def touch(path):
+    """Record an access to a cached file, by setting its access time. The modification time is
+    left alone, since it is used to validate cached, parsed documents"""
+
+    try:
+        st = stat(path)
+        utime(path, (time(), st.st_mtime))
+    except OSError:
+        pass
+
+
+class CacheManager(object):
+    """Report on, and limit the size of, a download cache"""
+
+    _lock = Lock()
+
+    def __init__(self, cache, budget=None):
+        """
+        :param cache: A pyfilesystem filesystem, usually Downloader().cache
+        :param budget: Maximum size of the cache, in bytes or as a string like '10G'. Defaults to the
+        METAPACK_CACHE_BUDGET env var.
+        """
+        self.cache = cache
+        self.root = cache.getsyspath('/')
+        self.budget = parse_size(budget if budget is not None else environ.get('METAPACK_CACHE_BUDGET'))
+
+    @property
+    def pins_path(self):
+        return join(self.root, PINS_FILE)
+
+    @property
+    def pins(self):
+        try:
+            with open(self.pins_path) as f:
+                return set(json.load(f))
+        except (IOError, ValueError):
+            return set()
+
+    def _write_pins(self, pins):
+        with open(self.pins_path, 'w') as f:
+            json.dump(sorted(pins), f, indent=0)
+
+    def pin(self, *paths):
+        """Pin cache paths, or directory prefixes, so they are never evicted"""
+        with self._lock:
+            self._write_pins(self.pins | set(p.strip('/') for p in paths if p))
+
+    def unpin(self, *paths):
+        with self._lock:
+            self._write_pins(self.pins - set(p.strip('/') for p in paths))
+
+    def package_paths(self, doc):
+        """Return the cache paths for the web resources, references and documentation of a
+        package, and for the package's generated resource code"""
+        from metapack.util import slugify
+        from metapack.package.core import remote_urls
+
+        return ['resource-code/{}'.format(slugify(doc.name))] + [cache_path_for_url(u) for u in remote_urls(doc)]
+
+    def pin_package(self, doc):
+        paths = self.package_paths(doc)
+        self.pin(*paths)
+        return paths
+
+    def is_pinned(self, path, pins=None):
+        pins = self.pins if pins is None else pins
+
+        return any(path == p or path.startswith(p + '/') for p in pins)
+
+    def entries(self):
+        """Yield a CacheEntry for each cached file"""
+
+        pins = self.pins
+
+        for root, dirs, files in walk(self.root):
+            for f in files:
+
+                sys_path = join(root, f)
+                path = relpath(sys_path, self.root)
+
+                if path == PINS_FILE or f.endswith(_SYSTEM_SUFFIXES):
+                    continue
+
+                try:
+                    st = stat(sys_path)
+                except OSError:
+                    continue
+
+                yield CacheEntry(path, st.st_size, st.st_atime, self.is_pinned(path, pins))
+
+    def usage(self):
+        """Return a dict with the total size and file counts, pinned and unpinned"""
+
+        d = dict(files=0, size=0, pinned_files=0, pinned_size=0)
+
+        for e in self.entries():
+            d['files'] += 1
+            d['size'] += e.size
+            if e.pinned:
+                d['pinned_files'] += 1
+                d['pinned_size'] += e.size
+
+        d['budget'] = self.budget
+
+        return d
+
+    def evict(self, budget=None, keep=None, dry_run=False):
+        """Remove the least recently accessed, unpinned files until the cache is no larger than
+        the budget. Returns the list of evicted entries
+
+        :param budget: Size limit, overriding the budget set in the constructor
+        :param keep: Extra cache paths or prefixes to treat as pinned for this eviction only, such as the
+        paths returned by package_paths() for the currently open package
+        :param dry_run: If True, report what would be evicted, but don't remove anything
+        """
+        from metapack.package.core import REVALIDATE_DIR
+
+        budget = parse_size(budget) if budget is not None else self.budget
+
+        if budget is None:
+            return []
+
+        with self._lock:
+            entries = list(self.entries())
+
+            if keep:
+                keep = set(p.strip('/') for p in keep)
+                entries = [e._replace(pinned=e.pinned or self.is_pinned(e.path, keep)) for e in entries]
+
+            total = sum(e.size for e in entries)
+
+            evicted = []
+
+            for e in sorted((e for e in entries if not e.pinned and not e.path.startswith(REVALIDATE_DIR)),
+                            key=lambda e: e.atime):
+
+                if total <= budget:
+                    break
+
+                if not dry_run:
+                    try:
+                        remove(join(self.root, e.path))
+                    except OSError:
+                        continue
+
+                    # Remove the revalidation headers along with the file
+                    meta = join(self.root, REVALIDATE_DIR, e.path + '.json')
+                    if exists(meta):
+                        remove(meta)
+
+                total -= e.size
+                evicted.append(e)
+
+        return evicted
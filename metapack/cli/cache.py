@@ -0,0 +1,93 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+CLI program for managing the download cache
+"""
+
+from metapack import Downloader, MetapackDoc
+from metapack.cache import CacheManager, format_size
+from metapack.cli.core import prt, err, get_config
+
+downloader = Downloader()
+
+
+def cache(subparsers):
+    parser = subparsers.add_parser(
+        'cache',
+        help='Show the size of the download cache, evict old files, and pin files',
+        epilog='Cache dir: {}\n'.format(str(downloader.cache.getsyspath('/'))))
+
+    parser.set_defaults(run_command=run_cache)
+
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument('-s', '--show', default=False, action='store_true',
+                       help='Show cache usage. This is the default')
+
+    group.add_argument('-l', '--list', default=False, action='store_true',
+                       help='List cached files, least recently used first')
+
+    group.add_argument('-e', '--evict', nargs='?', const=True, default=False, metavar='BUDGET',
+                       help="Evict least recently used files until the cache is smaller than BUDGET, "
+                            "such as '500M' or '10G'. Defaults to the configured cache budget")
+
+    group.add_argument('-p', '--pin', nargs='+', metavar='PATH',
+                       help='Pin cache paths or directories so they are never evicted')
+
+    group.add_argument('-u', '--unpin', nargs='+', metavar='PATH',
+                       help='Remove pins')
+
+    group.add_argument('-P', '--pin-package', metavar='METATABFILE',
+                       help='Pin the cached resources, references and documentation of a package')
+
+    parser.add_argument('-n', '--dry-run', default=False, action='store_true',
+                        help='With --evict, show what would be removed, without removing it')
+
+
+def cache_manager(cache):
+    """Return a CacheManager with the budget from the config or the environment"""
+    return CacheManager(cache, get_config().get('cache_budget'))
+
+
+def run_cache(args):
+
+    cm = cache_manager(downloader.cache)
+
+    if args.list:
+        for e in sorted(cm.entries(), key=lambda e: e.atime):
+            prt("{:>8} {} {}".format(format_size(e.size), 'P' if e.pinned else ' ', e.path))
+
+    elif args.evict:
+
+        budget = None if args.evict is True else args.evict
+
+        if budget is None and cm.budget is None:
+            err("No cache budget. Set one on the command line, with 'cache_budget' in the config, "
+                "or with the METAPACK_CACHE_BUDGET env var")
+
+        evicted = cm.evict(budget, dry_run=args.dry_run)
+
+        for e in evicted:
+            prt("{} {}".format('Would evict' if args.dry_run else 'Evicted', e.path))
+
+        prt("{} {} files, {}".format('Would evict' if args.dry_run else 'Evicted',
+                                     len(evicted), format_size(sum(e.size for e in evicted))))
+
+    elif args.pin:
+        cm.pin(*args.pin)
+
+    elif args.unpin:
+        cm.unpin(*args.unpin)
+
+    elif args.pin_package:
+        for p in cm.pin_package(MetapackDoc(args.pin_package, downloader=downloader)):
+            prt("Pinned", p)
+
+    else:
+        u = cm.usage()
+
+        prt("Cache dir:  ", cm.root)
+        prt("Size:       ", format_size(u['size']), "in", u['files'], "files")
+        prt("Pinned:     ", format_size(u['pinned_size']), "in", u['pinned_files'], "files")
+        prt("Budget:     ", format_size(u['budget']) if u['budget'] is not None else 'None')
@@ -1,5 +1,6 @@
 import logging
 import sys
+from collections import namedtuple
 from genericpath import exists
 from itertools import islice
 from os.path import join
@@ -8,12 +9,7 @@ from uuid import uuid4
 import six
 
 from appurl import parse_app_url
-from metapack import MetapackDoc, MetapackUrl
-from metapack.package.csv import CsvPackageBuilder
-from metapack.package.excel import ExcelPackageBuilder
-from metapack.package.filesystem import FileSystemPackageBuilder
-from metapack.package.s3 import S3PackageBuilder
-from metapack.package.zip import ZipPackageBuilder
+from metapack import MetapackDoc, MetapackUrl, Downloader
 from metatab import  DEFAULT_METATAB_FILE
 from metatab.util import make_metatab_file
 from rowgenerators import SelectiveRowGenerator
@@ -174,9 +170,94 @@ def get_table(doc, name):
 
     return t
 
+ResolvedResource = namedtuple('ResolvedResource', 'name url mimetype format term')
+
+
+class ResolvedDistribution(object):
+    """A Root.Distribution term, with the package it refers to and, for CSV packages, the
+    resolved URLs of the package's resources"""
+
+    def __init__(self, dist):
+        self.dist = dist
+        self.doc = None
+        self.resources = []
+        self.error = None
+
+        try:
+            self.package_url = dist.package_url
+            self.metadata_url = dist.metadata_url
+            self.type = dist.type
+        except Exception as e:
+            # The distribution's URL can't be parsed, so it can't be resolved
+            self.package_url = self.metadata_url = self.type = None
+            self.error = e
+
+    def __repr__(self):
+        return "<ResolvedDistribution {} {}>".format(self.type, self.dist.value)
+
+
+def _resolve_resources(doc):
+    import mimetypes
+
+    resources = []
+
+    for r in doc.resources():
+        url = r.resolved_url
+
+        mimetype = mimetypes.guess_type(url.path)[0]
+
+        try:
+            ext = mimetypes.guess_extension(mimetype)[1:]
+        except:
+            ext = None
+
+        resources.append(ResolvedResource(r.name, url, mimetype, ext, r))
+
+    return resources
+
+
+def resolve_distributions(doc, max_workers=4):
+    """Open the packages for all of the Root.Distribution terms in a document concurrently, and
+    return a list of ResolvedDistribution objects, in the order of the distribution terms.
+
+    Each distinct package metadata URL is opened once. Errors are stored in the error property
+    of each ResolvedDistribution, rather than raised. """
+    from concurrent.futures import ThreadPoolExecutor
+    from metapack.package import open_package
+
+    dists = [ResolvedDistribution(d) for d in doc.find('Root.Distribution')]
+
+    def _open(dist):
+        p = open_package(dist.metadata_url, downloader=doc.downloader)
+        return p, (_resolve_resources(p) if dist.type == 'csv' else [])
+
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        for rd in dists:
+            key = str(rd.metadata_url)
+            if rd.error is None and rd.type in ('csv', 'fs') and key not in futures:
+                futures[key] = executor.submit(_open, rd)
+
+        for rd in dists:
+            f = futures.get(str(rd.metadata_url)) if rd.error is None else None
+
+            if f is None:
+                continue
+
+            try:
+                rd.doc, rd.resources = f.result()
+            except Exception as e:
+                rd.error = e
+
+    return dists
+
+
 PACKAGE_PREFIX = '_packages'
 
 def make_excel_package(file, package_root, cache, env, skip_if_exists):
+    from metapack.package.excel import ExcelPackageBuilder
 
     assert package_root
 
@@ -196,6 +277,7 @@ def make_excel_package(file, package_root, cache, env, skip_if_exists):
 
 
 def make_zip_package(file, package_root, cache, env, skip_if_exists):
+    from metapack.package.zip import ZipPackageBuilder
 
     assert package_root
 
@@ -215,6 +297,7 @@ def make_zip_package(file, package_root, cache, env, skip_if_exists):
 
 
 def make_filesystem_package(file, package_root, cache, env, skip_if_exists):
+    from metapack.package.filesystem import FileSystemPackageBuilder
 
     assert package_root
 
@@ -239,6 +322,8 @@ def make_filesystem_package(file, package_root, cache, env, skip_if_exists):
 
 
 def make_csv_package(file, package_root, cache, env, skip_if_exists):
+    from metapack.package.csv import CsvPackageBuilder
+
     assert package_root
 
     p = CsvPackageBuilder(file, package_root, callback=prt,  env=env)
@@ -255,6 +340,7 @@ def make_csv_package(file, package_root, cache, env, skip_if_exists):
     return p, MetapackUrl(url, downloader=package_root.downloader), created
 
 def make_s3_package(file, package_root,  cache,  env,  skip_if_exists, acl='public-read'):
+    from metapack.package.s3 import S3PackageBuilder
 
     assert package_root
 
@@ -441,6 +527,20 @@ class MetapackCliMemo(object):
 
         self.config = get_config()
 
+        # Revalidation policy for cached HTTP downloads. In the config:
+        #
+        # revalidate:
+        #   max_age: 86400 # Default max age, in seconds
+        #   urls:
+        #     - pattern: census.gov
+        #       max_age: 604800
+        rv = self.config.get('revalidate') or {}
+        Downloader.configure_revalidation(rv.get('urls'), rv.get('max_age'))
+
+        # The --revalidate option overrides the max age from the config
+        if getattr(args, 'revalidate', None) is not None:
+            Downloader.max_age = args.revalidate
+
         frag = ''
 
         # Just the fragment was provided
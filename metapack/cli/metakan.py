@@ -10,11 +10,16 @@ The program uses the Root.Distributions in the source package to locate packages
 
 import mimetypes
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from copy import copy, deepcopy
 from os import getenv
 from os.path import join, basename
+from threading import Lock, local
+from time import monotonic, sleep
 
-from metapack import MetapackDoc, Downloader, open_package
-from metapack.cli.core import err
+from appurl import parse_app_url, DownloadError
+from metapack import MetapackDoc, MetapackUrl, Downloader, open_package
+from metapack.cli.core import err, resolve_distributions
 from metatab import  DEFAULT_METATAB_FILE, MetatabError
 from metapack.package.s3 import S3Bucket
 from .core import MetapackCliMemo as _MetapackCliMemo
@@ -43,10 +48,190 @@ class MetapackCliMemo(_MetapackCliMemo):
 
     def update_mt_arg(self, metatabfile):
         """Return a new memo with a new metatabfile argument"""
-        o = MetapackCliMemo(self.args)
+        o = copy(self)
+        o.mtfile_arg = metatabfile
+        o.mtfile_url = MetapackUrl(metatabfile, downloader=self.downloader)
+        o.resource = o.mtfile_url.fragment
+        o.package_url = o.mtfile_url.package_url
+        o.mt_file = o.mtfile_url.metadata_url
         o.set_mt_arg(metatabfile)
         return o
 
+
+class RateLimiter(object):
+    """Limit the rate of CKAN API calls, across all of the publishing threads"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = Lock()
+        self._next = 0
+
+    def wait(self):
+
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = monotonic()
+            t = max(now, self._next)
+            self._next = t + self.interval
+
+        if t > now:
+            sleep(t - now)
+
+
+class CkanClient(object):
+    """Wraps RemoteCKAN so that each thread gets its own client, and every
+    action call goes through the rate limiter"""
+
+    def __init__(self, ckan_url, api_key, limiter=None):
+        self.ckan_url = ckan_url
+        self.api_key = api_key
+        self.limiter = limiter or RateLimiter()
+        self._local = local()
+
+    @property
+    def client(self):
+        from ckanapi import RemoteCKAN
+
+        try:
+            return self._local.client
+        except AttributeError:
+            self._local.client = RemoteCKAN(self.ckan_url, apikey=self.api_key)
+            return self._local.client
+
+    @property
+    def action(self):
+        return _ThrottledAction(self.client.action, self.limiter)
+
+
+class _ThrottledAction(object):
+
+    def __init__(self, action, limiter):
+        self._action = action
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        f = getattr(self._action, name)
+
+        def _f(*args, **kwargs):
+            self._limiter.wait()
+            return f(*args, **kwargs)
+
+        return _f
+
+
+class CkanLookups(object):
+    """Cache organization and group lookups, which are the same for most of the
+    packages in a catalog"""
+
+    def __init__(self):
+        self._orgs = {}
+        self._groups = {}
+        self._lock = Lock()
+
+    def _lookup(self, cache, key, f):
+        from ckanapi import NotFound
+
+        with self._lock:
+            if key in cache:
+                return cache[key]
+
+        try:
+            v = f()
+        except NotFound:
+            v = None
+
+        with self._lock:
+            cache[key] = v
+
+        return v
+
+    def organization_id(self, c, name):
+        """Return the id of the organization, or None if it does not exist"""
+        o = self._lookup(self._orgs, name, lambda: c.action.organization_show(id=name))
+        return o.get('id') if o else None
+
+    def group_exists(self, c, name):
+        return self._lookup(self._groups, name, lambda: c.action.group_show(id=name)) is not None
+
+
+# Package keys that send_to_ckan sets, and which are compared to decide if a dataset has changed
+CKAN_PACKAGE_KEYS = ('title', 'version', 'notes', 'owner_org', 'groups', 'tags', 'extras', 'resources')
+CKAN_RESOURCE_KEYS = ('name', 'url', 'format', 'mimetype', 'description')
+
+
+def canonical_package(pkg):
+    """Reduce a CKAN package dict to the keys that send_to_ckan sets, in a form that
+    does not depend on ordering or on the extra fields that CKAN adds"""
+
+    def s(v):
+        return str(v) if v is not None and v != '' else None
+
+    return {
+        'title': s(pkg.get('title')),
+        'version': s(pkg.get('version')),
+        'notes': s(pkg.get('notes')),
+        'owner_org': s(pkg.get('owner_org')),
+        'groups': sorted(g['name'] for g in pkg.get('groups') or []),
+        'tags': sorted(t['name'] for t in pkg.get('tags') or []),
+        'extras': sorted((e['key'], s(e['value'])) for e in pkg.get('extras') or []),
+        'resources': [[s(r.get(k)) for k in CKAN_RESOURCE_KEYS] for r in pkg.get('resources') or []]
+    }
+
+
+def package_hash(pkg):
+    """Hash of the canonical form of a CKAN package dict"""
+    import hashlib
+    import json
+
+    return hashlib.sha1(json.dumps(canonical_package(pkg), sort_keys=True).encode('utf8')).hexdigest()
+
+
+def changed_package_keys(old, new):
+    """Return the package keys that differ between two CKAN package dicts"""
+    co = canonical_package(old)
+    cn = canonical_package(new)
+
+    return [k for k in CKAN_PACKAGE_KEYS if co[k] != cn[k]]
+
+
+class CkanSyncCache(object):
+    """Record the hash of the last package dict sent to CKAN for each dataset, so unchanged
+    datasets can be skipped without comparing them to the CKAN state"""
+
+    def __init__(self, cache, ckan_url):
+        from urllib.parse import urlparse
+        import json
+
+        self.path = join(cache.getsyspath('/'), 'ckan-sync', urlparse(ckan_url).netloc + '.json')
+        self._lock = Lock()
+
+        try:
+            with open(self.path) as f:
+                self._hashes = json.load(f)
+        except (IOError, ValueError):
+            self._hashes = {}
+
+    def get(self, ckan_id):
+        with self._lock:
+            return self._hashes.get(ckan_id)
+
+    def set(self, ckan_id, hash):
+        with self._lock:
+            self._hashes[ckan_id] = hash
+
+    def save(self):
+        import json
+        from metapack.util import ensure_dir
+        from os.path import dirname
+
+        ensure_dir(dirname(self.path))
+
+        with self._lock, open(self.path, 'w') as f:
+            json.dump(self._hashes, f, indent=0)
+
+
 def metakan(subparsers):
 
 
@@ -73,6 +258,18 @@ def metakan(subparsers):
     parser.add_argument('-D', '--dump', action='store_true',
                         help="Dump groups and organizations to a metatab file")
 
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help="Number of packages to publish concurrently, for s3 buckets and --packages lists")
+
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help="Maximum number of CKAN API calls per second, across all jobs")
+
+    parser.add_argument('-R', '--retries', type=int, default=3,
+                        help="Number of times to retry publishing a package after a CKAN or network error")
+
+    parser.add_argument('-F', '--force', action='store_true',
+                        help="Update CKAN datasets even if they have not changed since the last sync")
+
     parser.add_argument('metatabfile', nargs='?', default=DEFAULT_METATAB_FILE,
                         help='Path to a Metatab file, or an s3 link to a bucket with Metatab files. ')
 
@@ -84,25 +281,19 @@ def run_ckan(args):
     if m.mtfile_url.scheme == 's3':
         # Find all of the top level CSV files in a bucket and use them to create CKan entries
 
-        b = S3Bucket(m.mtfile_arg)
+        b = S3Bucket(parse_app_url(m.mtfile_arg))
 
-        for e in b.list():
-            key = e['Key']
-            if '/' not in key and key.endswith('.csv'):
-                url = b.access_url(key)
-                prt("Processing", url)
-                send_to_ckan(m.update_mt_arg(url))
+        urls = [b.access_url(e['Key']) for e in b.list()
+                if '/' not in e['Key'] and e['Key'].endswith('.csv')]
+
+        publish_packages(m, urls)
 
     elif m.args.packages:
         # Load a list of packages
         with open(m.mtfile_arg) as f:
-            for line in f.readlines():
-                url = line.strip()
-                prt("Processing", url)
-                try:
-                    send_to_ckan(m.update_mt_arg(url))
-                except Exception as e:
-                    warn("Failed to process {}: {}".format(line, e))
+            urls = [line.strip() for line in f.readlines() if line.strip()]
+
+        publish_packages(m, urls)
 
     elif m.args.configure:
         configure_ckan(m)
@@ -111,75 +302,106 @@ def run_ckan(args):
         dump_ckan(m)
 
     else:
-        send_to_ckan(m)
+        sync = CkanSyncCache(m.cache, m.ckan_url)
+        send_to_ckan(m, sync=sync)
+        sync.save()
 
     exit(0)
 
-def send_to_ckan(m):
+def publish_packages(m, urls):
+    """Publish a list of packages, with a pool of worker threads that share a
+    rate limiter and the organization and group lookups"""
 
-    from ckanapi import RemoteCKAN, NotFound
-    try:
-        doc = MetapackDoc(m.mt_file, cache=m.cache)
+    c = CkanClient(m.ckan_url, m.api_key, RateLimiter(m.args.rate))
+    lookups = CkanLookups()
+    sync = CkanSyncCache(m.cache, m.ckan_url)
 
-    except (IOError, MetatabError) as e:
-        err("Failed to open metatab '{}': {}".format(m.mt_file, e))
+    failures = []
 
-    c = RemoteCKAN(m.ckan_url, apikey=m.api_key)
+    with ThreadPoolExecutor(max_workers=max(m.args.jobs, 1)) as executor:
 
-    ckanid = doc.find_first_value('Root.Ckanid')
+        futures = {executor.submit(_send_with_retries, m, url, c, lookups, sync): url for url in urls}
 
-    unversioned_name = doc.as_version(None)
-    ckan_name = unversioned_name.replace('.','-')
+        for f in as_completed(futures):
+            url = futures[f]
+            try:
+                f.result()
+            except (Exception, SystemExit) as e:
+                warn("Failed to process {}: {}".format(url, e))
+                failures.append(url)
 
-    id_name = ckanid or ckan_name
+    sync.save()
 
-    try:
-        pkg = c.action.package_show(name_or_id=id_name)
-        prt("Updating CKAN dataset for '{}'".format(id_name))
-        found = True
-    except NotFound as e:
-        e.__traceback__ = None
-        traceback.clear_frames(e.__traceback__)
-        found = False
+    prt("Published {} of {} packages".format(len(urls) - len(failures), len(urls)))
 
-    if not found:
-        try:
-            pkg = c.action.package_show(name_or_id=ckan_name)
-            prt("Updating CKAN dataset for '{}'".format(id_name))
-            found = True
-        except NotFound as e:
-            e.__traceback__ = None
-            traceback.clear_frames(e.__traceback__)
-            found = False
+    return failures
 
-    if not found:
+
+def _send_with_retries(m, url, c, lookups, sync):
+    from ckanapi.errors import CKANAPIError
+    from requests.exceptions import RequestException
+
+    prt("Processing", url)
+
+    for i in range(m.args.retries + 1):
         try:
-            pkg = c.action.package_create(name=ckan_name)
-        except Exception as e:
-            err("Failed to create package for name '{}': {} ".format(ckan_name, e))
+            return send_to_ckan(m.update_mt_arg(url), c, lookups, sync)
+        except (CKANAPIError, RequestException, IOError) as e:
+            if i >= m.args.retries:
+                raise
+            warn("Error publishing {}, retrying: {}".format(url, e))
+            sleep(2 ** i)
 
-        prt("Adding CKAN dataset for '{}'".format(ckan_name))
 
-    pkg['title'] = doc.find_first_value('Root.Title')
+# Terms that send_to_ckan() writes to the document from the CKAN dataset
+_WRITTEN_BACK_TERMS = ('Root.CkanId', 'Root.CkanOrg', 'Root.Group')
+
+
+def send_to_ckan(m, c=None, lookups=None, sync=None):
+
+    from ckanapi import NotFound
+    try:
+        doc = MetapackDoc(m.mt_file, cache=m.cache)
+
+    except (IOError, MetatabError) as e:
+        err("Failed to open metatab '{}': {}".format(m.mt_file, e))
+
+    if c is None:
+        c = CkanClient(m.ckan_url, m.api_key)
+
+    if lookups is None:
+        lookups = CkanLookups()
+
+    # The package fields that come from the metatab document
+    fields = {}
+
+    fields['title'] = doc.find_first_value('Root.Title')
+
+    if not fields['title']:
+        fields['title'] = doc.find_first_value('Root.Description')
 
-    if not pkg['title']:
-        pkg['title'] = doc.find_first_value('Root.Description')
+    fields['version'] =  doc.find_first_value('Root.Version')
 
-    pkg['version'] =  doc.find_first_value('Root.Version')
+    fields['groups'] = []
 
-    pkg['groups'] = [ {'name': g.value } for g in doc['Root'].find('Root.Group')]
+    for g in doc['Root'].find('Root.Group'):
+        if lookups.group_exists(c, g.value):
+            fields['groups'].append({'name': g.value})
+        else:
+            warn("Didn't find group '{}'; not adding it to the package".format(g.value))
 
-    pkg['tags'] = [{'name': g.value} for g in doc['Root'].find('Root.Tag')]
+    fields['tags'] = [{'name': g.value} for g in doc['Root'].find('Root.Tag')]
 
     org_name = doc.get_value('Root.Origin', doc.get_value('Root.CkanOrg'))
 
     if org_name:
         org_name_slug = org_name.replace('.','-')
-        try:
 
-            owner_org = c.action.organization_show(id=org_name_slug).get('id')
-            pkg['owner_org'] = owner_org
-        except NotFound:
+        owner_org = lookups.organization_id(c, org_name_slug)
+
+        if owner_org:
+            fields['owner_org'] = owner_org
+        else:
             warn("Didn't find org for '{}'; not setting organization ".format(org_name_slug))
             org_name_slug = None
     else:
@@ -187,11 +409,13 @@ def send_to_ckan(m):
 
     extras = {}
 
+    # Leave out the terms that are written back to the document after the sync, so they don't change
+    # the package hash on the next sync
     for t in doc.find('*.*', section='Root'):
-        if not t.term_is('Root.Distribution'):
+        if not t.term_is('Root.Distribution') and not any(t.term_is(w) for w in _WRITTEN_BACK_TERMS):
             extras[t.qualified_term] = t.value
 
-    pkg['extras'] = [ {'key':k, 'value':v} for k, v in extras.items() ]
+    fields['extras'] = [ {'key':k, 'value':v} for k, v in extras.items() ]
 
     resources = []
 
@@ -199,14 +423,18 @@ def send_to_ckan(m):
     # correct links.
     markdown = None
 
-    for dist in doc.find('Root.Distribution'):
+    for rd in resolve_distributions(doc):
 
-        prt("Processing {} package: {}".format(dist.type, dist.value))
+        if rd.type is None:
+            warn("Failed for Distribution {}; {}".format(rd.dist.value, rd.error))
+            continue
 
-        package_url = dist.package_url
-        metadata_url = dist.metadata_url
+        prt("Processing {} package: {}".format(rd.type, rd.dist.value))
 
-        if dist.type == 'zip':
+        package_url = rd.package_url
+        metadata_url = rd.metadata_url
+
+        if rd.type == 'zip':
             d = dict(
                 url=str(package_url.inner),
                 name=basename(package_url.path),
@@ -217,7 +445,7 @@ def send_to_ckan(m):
             resources.append(d)
             prt("Adding ZIP package ", d['name'])
 
-        elif dist.type == 'xlsx':
+        elif rd.type == 'xlsx':
             d = dict(
                 url=str(package_url.inner),
                 name=basename(package_url.path),
@@ -228,7 +456,7 @@ def send_to_ckan(m):
             resources.append(d)
             prt("Adding XLS package ", d['name'])
 
-        elif dist.type == 'csv':
+        elif rd.type == 'csv':
 
             d=dict(
                 url=str(package_url.inner),
@@ -241,53 +469,105 @@ def send_to_ckan(m):
             resources.append(d)
             prt("Adding {} package {}".format(d['format'], d['name']))
 
-            try:
-                p = open_package(metadata_url)
-            except (IOError, MetatabError) as e:
-                err("Failed to open package '{}' from reference '{}': {}".format(package_url, dist.url, e))
-
-            for r in p.resources():
+            if rd.error:
+                err("Failed to open package '{}' from reference '{}': {}".format(package_url, rd.dist.value, rd.error))
 
-                mimetype = mimetypes.guess_type(r.resolved_url.path)[0]
-
-                try:
-                    ext = mimetypes.guess_extension(mimetype)[1:]
-                except:
-                    ext = None
+            for r in rd.resources:
 
                 d = dict(
                     name=r.name,
-                    format = ext,
-                    url=str(r.resolved_url),
-                    mimetype=mimetype,
-                    description=r.markdown
+                    format = r.format,
+                    url=str(r.url),
+                    mimetype=r.mimetype,
+                    description=r.term.markdown
                 )
 
                 resources.append(d)
                 prt("Adding {} resource {}".format(d['format'], d['name']))
 
-        elif dist.type == 'fs':
+        elif rd.type == 'fs':
             # Fervently hope that this is a web acessible fs distribution
             from requests import HTTPError
-            from appurl import DownloadError
             try:
-                markdown = metadata_url.doc.markdown
+                if rd.error:
+                    raise rd.error
+                markdown = rd.doc.markdown
             except (HTTPError, DownloadError):
                 pass
 
         else:
-            warn("Unknown distribution type '{}' for '{}'  ".format(dist.type, dist.value))
+            warn("Unknown distribution type '{}' for '{}'  ".format(rd.type, rd.dist.value))
 
     try:
-        pkg['notes'] = markdown or doc.markdown #doc.find_first_value('Root.Description')
+        fields['notes'] = markdown or doc.markdown #doc.find_first_value('Root.Description')
     except (OSError, DownloadError) as e:
         warn(e)
 
-    pkg['resources'] = resources
+    fields['resources'] = resources
+
+    new_hash = package_hash(fields)
 
-    c.action.package_update(**pkg)
+    ckanid = doc.find_first_value('Root.Ckanid')
+
+    if sync is not None and ckanid and not m.args.force and sync.get(ckanid) == new_hash:
+        # Sent in an earlier sync, so skip fetching the dataset. Use --force to check the CKAN state
+        prt("CKAN dataset for '{}' is unchanged since the last sync; skipping".format(ckanid))
+        return
+
+    unversioned_name = doc.as_version(None)
+    ckan_name = unversioned_name.replace('.','-')
+
+    id_name = ckanid or ckan_name
+
+    try:
+        pkg = c.action.package_show(name_or_id=id_name)
+        prt("Updating CKAN dataset for '{}'".format(id_name))
+        found = True
+    except NotFound as e:
+        e.__traceback__ = None
+        traceback.clear_frames(e.__traceback__)
+        found = False
+
+    if not found:
+        try:
+            pkg = c.action.package_show(name_or_id=ckan_name)
+            prt("Updating CKAN dataset for '{}'".format(id_name))
+            found = True
+        except NotFound as e:
+            e.__traceback__ = None
+            traceback.clear_frames(e.__traceback__)
+            found = False
+
+    created = not found
+
+    if created:
+        try:
+            pkg = c.action.package_create(name=ckan_name)
+        except Exception as e:
+            err("Failed to create package for name '{}': {} ".format(ckan_name, e))
+
+        prt("Adding CKAN dataset for '{}'".format(ckan_name))
+
+    current = deepcopy(pkg)
+
+    pkg.update(fields)
+
+    if created or m.args.force:
+        c.action.package_update(**pkg)
+        pkg = c.action.package_show(name_or_id=pkg['id'])
+    else:
+        changed = changed_package_keys(current, pkg)
+
+        if changed:
+            prt("Patching {} in CKAN dataset for '{}'".format(', '.join(changed), id_name))
+            c.action.package_patch(id=pkg['id'], **{k: pkg.get(k) for k in changed})
+            pkg = c.action.package_show(name_or_id=pkg['id'])
+        else:
+            prt("CKAN dataset for '{}' is unchanged; skipping".format(id_name))
+            pkg = current
 
-    pkg = c.action.package_show(name_or_id=pkg['id'])
+    if sync is not None:
+        sync.set(pkg['id'], new_hash)
 
     ##
     ## Add a term with CKAN info.
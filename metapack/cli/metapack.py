@@ -7,6 +7,7 @@ CLI program for managing packages
 
 import json
 import re
+from collections import namedtuple
 
 from os import getcwd
 from os.path import dirname, abspath
@@ -17,7 +18,7 @@ from metapack.cli.core import prt, err, warn, dump_resource, dump_resources, met
     make_excel_package, make_filesystem_package, make_csv_package, make_zip_package, update_name, \
     process_schemas, extract_path_name, MetapackCliMemo
 from metapack.util import make_metatab_file, datetime_now
-from metatab import ConversionError
+from metatab import ConversionError, DEFAULT_METATAB_FILE
 from rowgenerators import SourceError
 from rowgenerators.util import clean_cache
 from rowgenerators.util import fs_join as join
@@ -115,6 +116,21 @@ def metapack(subparsers):
     admin_group.add_argument('--clean-cache', default=False, action='store_true',
                              help="Clean the download cache")
 
+    admin_group.add_argument('--revalidate', type=int, nargs='?', const=0, default=None, metavar='MAX_AGE',
+                             help="Revalidate cached web downloads older than MAX_AGE seconds with conditional "
+                                  "requests. With no argument, revalidate every cached download")
+
+    admin_group.add_argument('--prefetch', type=int, nargs='?', const=8, default=None, metavar='N',
+                             help="Before building, download all of the package's web resources, references "
+                                  "and documentation into the cache, with N concurrent downloads ( default 8 )")
+
+    admin_group.add_argument('--lock', default=False, action='store_true',
+                             help="Resolve all of the package's URLs, and record them, with their cache paths and "
+                                  "content hashes, in a lockfile next to the metatab file")
+
+    admin_group.add_argument('--offline', default=False, action='store_true',
+                             help="Resolve URLs only from the lockfile and the cache, without using the network")
+
     admin_group.add_argument('-C', '--clean', default=False, action='store_true',
                              help="For some operations, like updating schemas, clear the section of existing terms first")
 
@@ -133,29 +149,348 @@ def metapack(subparsers):
     admin_group.add_argument('--markdown', default=False, action='store_true',
                              help='Generate Markdown documentation')
 
+    ##
+    ## Batch Group
+
+    batch_group = parser.add_argument_group('Batch', 'Build many packages in one run')
+
+    batch_group.add_argument('-B', '--batch', metavar='DIR_OR_LIST',
+                             help="Build every package under a directory, or listed in a file, one metatab file "
+                                  "or package directory per line, with the other options applied to each package")
+
+    batch_group.add_argument('-j', '--jobs', type=int, default=None,
+                             help="With --batch, the number of packages to build in parallel. Defaults to the "
+                                  "number of CPUs")
+
+    batch_group.add_argument('--batch-report', metavar='FILE',
+                             help="With --batch, also write the report of the builds to a JSON file")
+
 
 def run_metapack(args):
 
+    if args.profile:
+        from metatab.s3 import set_s3_profile
+        set_s3_profile(args.profile)
+
+    if args.batch:
+        run_batch(args)
+        return
+
     m = MetapackCliMemo(args, downloader)
 
     if m.args.info:
         metatab_info(m.cache)
         exit(0)
 
-    if m.args.profile:
-        from metatab.s3 import set_s3_profile
-        set_s3_profile(m.args.profile)
+    build(m)
+
+    clean_cache(m.cache)
+
+    enforce_cache_budget(m.cache, [m.mt_file])
+
+
+def build(m):
+    """Run the build, derived package, query and administration operations for one metatab file,
+    and return the list of derived packages that metatab_derived_handler() created """
+
+    if m.args.lock or m.args.offline:
+        configure_lock(m)
+
+    if m.args.prefetch and not m.args.offline:
+        prefetch_inputs(m)
+
+    create_list = []
 
     try:
-        for handler in (metatab_build_handler, metatab_derived_handler, metatab_query_handler, metatab_admin_handler):
-            handler(m)
+        metatab_build_handler(m)
+        create_list = metatab_derived_handler(m)
+        metatab_query_handler(m)
+        metatab_admin_handler(m)
     except Exception as e:
         if m.args.exceptions:
             raise e
         else:
             err(e)
 
-    clean_cache(m.cache)
+    if m.args.lock:
+        write_lockfile(m)
+
+    return create_list
+
+
+def lockfile_path(m):
+    from metapack.lockfile import LOCKFILE_NAME
+
+    return join(dirname(m.mt_file.path), LOCKFILE_NAME)
+
+
+def configure_lock(m):
+    """Set up the lockfile for recording, with --lock, or for offline resolution, with --offline"""
+    from metapack.lockfile import Lockfile
+
+    if m.mt_file.scheme != 'file':
+        err("Lockfiles can only be used with local metatab files")
+
+    if m.args.offline:
+        lf = Lockfile.load(lockfile_path(m))
+
+        if not len(lf):
+            warn("No lockfile at '{}'; resolving from the cache only".format(lf.path))
+
+        Downloader.configure_lock(lf, offline=True)
+    else:
+        Downloader.configure_lock(Lockfile(lockfile_path(m)))
+
+
+def write_lockfile(m):
+    """Resolve all of the package's inputs, so they are recorded in the lockfile, and write it"""
+    from metapack.package.core import prefetch
+
+    lf = Downloader.lockfile
+
+    doc = MetapackDoc(m.mt_file, cache=m.cache)
+
+    for r in prefetch(doc, m.downloader):
+        if r.error:
+            warn("Failed to download '{}': {}".format(r.url, r.error))
+
+    for r in list(doc.resources()) + list(doc.references()):
+        try:
+            r.resolved_url
+        except Exception as e:
+            warn("Failed to resolve '{}': {}".format(r.name, e))
+
+    lf.save()
+
+    prt("Wrote lockfile '{}' with {} urls and {} resources".format(lf.path, len(lf.urls), len(lf.resources)))
+
+
+def prefetch_inputs(m):
+    """Download the package's remote inputs concurrently, reporting the time for each, and failures"""
+    from metapack.package.core import Prefetcher
+
+    try:
+        p = Prefetcher(MetapackDoc(m.mt_file, cache=m.cache), m.downloader, max_workers=m.args.prefetch)
+    except Exception as e:
+        warn("Prefetch failed: {}".format(e))
+        return
+
+    prt("Prefetching {} urls".format(len(p.urls)))
+
+    failures = []
+
+    for r in p:
+        if r.error:
+            failures.append(r)
+            warn("Failed  {:6.2f}s {}: {}".format(r.elapsed, r.url, r.error))
+        else:
+            prt("{} {:6.2f}s {}".format('Cached ' if r.cached else 'Fetched', r.elapsed, r.url))
+
+    if failures:
+        warn("{} of {} urls failed to prefetch".format(len(failures), len(p.urls)))
+
+
+def enforce_cache_budget(cache, mt_files):
+    """If there is a cache budget, evict old files from the cache, keeping the files
+    for the packages that were just built"""
+    from metapack.cli.cache import cache_manager
+
+    cm = cache_manager(cache)
+
+    if cm.budget is None:
+        return
+
+    keep = []
+
+    for mt_file in mt_files:
+        try:
+            keep += cm.package_paths(MetapackDoc(mt_file, cache=cache))
+        except Exception:
+            pass
+
+    evicted = cm.evict(keep=keep)
+
+    if evicted:
+        prt("Evicted {} files from the cache".format(len(evicted)))
+
+
+BatchResult = namedtuple('BatchResult', 'path ok elapsed packages error log')
+
+
+def discover_packages(spec):
+    """Return the paths to the metatab files under a directory, or listed in a file. Directories that
+    start with '_' or '.', such as the _packages directory of built packages, are skipped"""
+    from os import walk
+    from os.path import isdir, exists, join
+
+    if isdir(spec):
+        paths = []
+
+        for root, dirs, files in walk(spec):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(('_', '.')))
+
+            if DEFAULT_METATAB_FILE in files:
+                paths.append(abspath(join(root, DEFAULT_METATAB_FILE)))
+
+        return paths
+
+    if not exists(spec):
+        err("Batch argument '{}' is not a directory or a file".format(spec))
+
+    base = dirname(abspath(spec))
+
+    paths = []
+
+    with open(spec) as f:
+        for line in f:
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            p = abspath(join(base, line))
+
+            if isdir(p):
+                p = join(p, DEFAULT_METATAB_FILE)
+
+            paths.append(p)
+
+    return paths
+
+
+def build_one(args, path):
+    """Build one package of a batch, in the package's directory, capturing its output.
+    Returns a BatchResult"""
+    import io
+    import logging
+    from copy import copy
+    from os import chdir
+    from time import time
+    from metapack.cli.core import logger, logger_err
+
+    buf = io.StringIO()
+    h = logging.StreamHandler(buf)
+    h.setFormatter(logging.Formatter('%(message)s'))
+
+    handlers = logger.handlers, logger_err.handlers
+    logger.handlers = logger_err.handlers = [h]
+
+    cwd = getcwd()
+    t = time()
+
+    try:
+        chdir(dirname(path))
+
+        a = copy(args)
+        a.metatabfile = path
+        a.batch = None
+
+        packages = [(kind, str(url), created) for kind, url, created in build(MetapackCliMemo(a, downloader))]
+
+        return BatchResult(path, True, time() - t, packages, None, buf.getvalue())
+
+    except SystemExit:  # From err()
+        log = buf.getvalue()
+        return BatchResult(path, False, time() - t, [], (log.strip().splitlines() or ['Failed'])[-1], log)
+
+    except Exception as e:
+        return BatchResult(path, False, time() - t, [], '{}: {}'.format(type(e).__name__, e), buf.getvalue())
+
+    finally:
+        chdir(cwd)
+        logger.handlers, logger_err.handlers = handlers
+
+
+def run_batch(args):
+    """Build all of the packages in a batch, in parallel worker processes, and report the results.
+
+    The workers are forked after the parent has parsed a metatab file, so they share the parsed declaration
+    documents, and they all use the same download cache. With --prefetch, the distinct remote inputs of all of
+    the packages are downloaded once, before the builds start."""
+    import multiprocessing
+    from functools import partial
+    from os import cpu_count
+    from time import time
+    from tabulate import tabulate
+
+    paths = discover_packages(args.batch)
+
+    if not paths:
+        err("No metatab files found for batch '{}'".format(args.batch))
+
+    jobs = max(1, min(args.jobs or cpu_count() or 1, len(paths)))
+
+    prt("Building {} packages with {} workers".format(len(paths), jobs))
+
+    t = time()
+
+    docs = []
+
+    for p in paths:
+        try:
+            docs.append(MetapackDoc(p, cache=downloader.cache))
+        except Exception as e:
+            warn("Failed to open '{}': {}".format(p, e))
+
+        if docs and not args.prefetch:
+            break  # One document is enough to load the declarations
+
+    if args.prefetch and not args.offline and docs:
+        from metapack.package.core import Prefetcher
+
+        failures = [r for r in Prefetcher(docs, downloader, max_workers=args.prefetch) if r.error]
+
+        for r in failures:
+            warn("Failed to prefetch {}: {}".format(r.url, r.error))
+
+    args.prefetch = None  # Already done, or not wanted
+
+    results = []
+
+    if jobs == 1:
+        for p in paths:
+            results.append(build_one(args, p))
+            report_one(results[-1])
+    else:
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            ctx = multiprocessing.get_context()
+
+        with ctx.Pool(jobs) as pool:
+            for r in pool.imap_unordered(partial(build_one, args), paths):
+                results.append(r)
+                report_one(r)
+
+    results.sort(key=lambda r: r.path)
+
+    prt('')
+    prt(tabulate([('ok' if r.ok else 'FAILED', '{:.1f}'.format(r.elapsed), r.path,
+                   ' '.join(kind for kind, _, created in r.packages if created) if r.ok else r.error)
+                  for r in results],
+                 'Status Seconds Package Result'.split()))
+
+    failed = [r for r in results if not r.ok]
+
+    prt("{} packages built, {} failed, in {:.1f}s".format(len(results) - len(failed), len(failed), time() - t))
+
+    if args.batch_report:
+        with open(args.batch_report, 'w') as f:
+            json.dump([r._asdict() for r in results], f, indent=4)
+
+    clean_cache(downloader.cache)
+
+    enforce_cache_budget(downloader.cache, [r.path for r in results])
+
+    if failed:
+        exit(1)
+
+
+def report_one(r):
+    if r.ok:
+        prt("ok     {:6.1f}s {}".format(r.elapsed, r.path))
+    else:
+        warn("FAILED {:6.1f}s {}: {}".format(r.elapsed, r.path, r.error))
 
 
 def metatab_build_handler(m):
@@ -12,7 +12,8 @@ from os.path import join, basename
 from metatab import DEFAULT_METATAB_FILE, resolve_package_metadata_url, MetatabDoc, MetatabError, open_package
 from metatab.cli.core import err
 from rowgenerators import get_cache, Url
-from .core import prt, warn
+from metapack import MetapackDoc
+from .core import prt, warn, resolve_distributions
 
 from metatab.util import slugify
 import json
@@ -55,7 +56,7 @@ def metaworld():
     m = MetapackCliMemo(parser.parse_args(sys.argv[1:]))
 
     try:
-        doc = MetatabDoc(m.mt_file, cache=m.cache)
+        doc = MetapackDoc(m.mt_file, cache=m.cache)
     except (IOError, MetatabError) as e:
         err("Failed to open metatab '{}': {}".format(m.mt_file, e))
 
@@ -86,47 +87,36 @@ def get_resource_urls(doc):
 
     resources = {}
 
-    for dist in doc.find("Root.Distribution"):
+    for rd in resolve_distributions(doc):
 
-        try:
-            package_url, metadata_url = resolve_package_metadata_url(dist.value)
-        except Exception as e:
-            warn("Failed for Distribution {}; {}".format(dist.value, e))
+        if rd.type is None:
+            warn("Failed for Distribution {}; {}".format(rd.dist.value, rd.error))
             continue
 
-        u = Url(package_url)
+        package_url = rd.package_url
 
-        if u.resource_format == 'zip':
+        if rd.type == 'zip':
             prt("Skipping ZIP package ", package_url)
 
-        elif u.resource_format == 'xlsx':
+        elif rd.type == 'xlsx':
             if False:
-                resources[basename(package_url)] = package_url
+                resources[basename(package_url.path)] = str(package_url.inner)
                 prt("Adding XLS package ", package_url)
                 pass
 
-        elif u.resource_format == 'csv':
+        elif rd.type == 'csv':
 
-            resources[basename(package_url)] = u.signed_resource_url
+            if rd.error:
+                err("Failed to open package '{}' from reference '{}': {}".format(package_url, rd.dist.value, rd.error))
 
-            prt("Adding CSV package {}".format(basename(package_url)))
+            resources[basename(package_url.path)] = Url(str(package_url.inner)).signed_resource_url
 
-            try:
-                p = open_package(package_url)
-            except (IOError, MetatabError) as e:
-                err("Failed to open package '{}' from reference '{}': {}".format(package_url, dist.value, e))
+            prt("Adding CSV package {}".format(basename(package_url.path)))
 
-            for r in p.resources():
-
-                mimetype = mimetypes.guess_type(r.resolved_url)[0]
-
-                try:
-                    ext = mimetypes.guess_extension(mimetype)[1:]
-                except:
-                    ext = None
+            for r in rd.resources:
 
                 # '.csv': Data>world currently get the format from the name, not the URL
-                resources[r.name+'.csv'] = r.resolved_url
+                resources[r.name+'.csv'] = str(r.url)
                 prt("Adding CSV resource {}".format( r.name))
         else:
             prt('Skipping {}'.format(package_url))
@@ -6,21 +6,63 @@ Root program for metapack programs
 
 """
 
-from pkg_resources import iter_entry_points, get_distribution, DistributionNotFound
-from .core import prt
 import argparse
+from collections import OrderedDict
 
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:
-   # package is not installed
-   pass
+from metapack.cli.core import prt, cli_init
 
-from metapack.cli.core import  cli_init
+# The subcommands, with the function that adds each one's parser and the help that is
+# shown for it in 'mp --help'. Only the module of the subcommand that is run is imported.
+# Subcommands that other packages register in the 'mt.subcommands' entry point group are
+# loaded when one of them is run.
+SUBCOMMANDS = OrderedDict([
+    ('pack', ('metapack.cli.metapack:metapack', 'Create and manipulate metatab data packages')),
+    ('s3', ('metapack.cli.metas3:metas3', 'Create packages and store them in s3 buckets')),
+    ('ckan', ('metapack.cli.metakan:metakan', 'CKAN management of Metatab packages')),
+    ('notebook', ('metapack.cli.notebook:notebook', 'Convert Metatab-formatted Jupyter notebooks. ')),
+    ('run', ('metapack.cli.run:run', 'Generate rows for a resource or reference ')),
+    ('cache', ('metapack.cli.cache:cache', 'Show the size of the download cache, evict old files, and pin files')),
+    ('serve', ('metapack.cli.serve:serve', 'Serve package metadata and data over HTTP')),
+])
 
 
-def mp():
-    cli_init()
+def load_subcommand(spec):
+    """Return the function for a 'module:function' subcommand spec"""
+    from importlib import import_module
+
+    module, func = spec.split(':')
+
+    return getattr(import_module(module), func)
+
+
+def plugin_subcommands():
+    """Return the entry points for subcommands that are registered by other packages"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        from pkg_resources import iter_entry_points
+        eps = iter_entry_points('mt.subcommands')
+    else:
+        eps = entry_points()
+        eps = eps.select(group='mt.subcommands') if hasattr(eps, 'select') else eps.get('mt.subcommands', [])
+
+    return [ep for ep in eps if ep.name not in SUBCOMMANDS]
+
+
+def command_name(argv):
+    """Return the subcommand name from the command line arguments. The root program's
+    options don't take values, so it is the first argument that isn't an option"""
+
+    for a in argv:
+        if not a.startswith('-'):
+            return a
+
+    return None
+
+
+def make_parser(argv):
+    """Make the argument parser, with the full parser for the subcommand that is being run,
+    and only a name and help for the others """
 
     parser = argparse.ArgumentParser(
         prog='metapack',
@@ -34,19 +76,43 @@ def mp():
 
     subparsers = parser.add_subparsers(help='Commands')
 
-    for ep in iter_entry_points(group='mt.subcommands'):
+    command = command_name(argv)
+
+    for name, (spec, help) in SUBCOMMANDS.items():
+        if name == command:
+            load_subcommand(spec)(subparsers)
+        else:
+            subparsers.add_parser(name, help=help)
+
+    # Only look for plugins when the command isn't a built in one, since scanning
+    # the installed distributions is slow
+    if command is not None and command not in SUBCOMMANDS:
+        for ep in plugin_subcommands():
+            if ep.name == command:
+                ep.load()(subparsers)
+            else:
+                subparsers.add_parser(ep.name)
+
+    return parser
+
 
-        f = ep.load()
-        f(subparsers)
+def mp():
+    import sys
+
+    cli_init()
+
+    parser = make_parser(sys.argv[1:])
 
     args = parser.parse_args()
 
     if args.version:
+        from pkg_resources import get_distribution
+
         prt(get_distribution('metapack'))
 
     elif args.versions:
 
-        from pkg_resources import EntryPoint
+        from pkg_resources import get_distribution, DistributionNotFound
 
         prt('--- Main Packages')
 
@@ -63,8 +129,11 @@ def mp():
         prt('')
         prt('--- Subcommands')
 
-        for ep in iter_entry_points(group='mt.subcommands'):
-            prt(ep.name,  ep.dist)
+        for name, (spec, _) in SUBCOMMANDS.items():
+            prt(name, spec)
+
+        for ep in plugin_subcommands():
+            prt(ep.name, getattr(ep, 'value', None) or ep.module_name)
 
     else:
-        args.run_command(args)
\ No newline at end of file
+        args.run_command(args)
@@ -8,12 +8,11 @@ CLI program for managing packages
 import sys
 from metapack import Downloader
 from metapack.cli.core import prt, err, MetapackCliMemo
-from metapack.jupyter.convert import convert_documentation, convert_notebook, extract_metatab, convert_hugo
+from metapack.writers import FORMATS, format_for_path, open_output, select_rows, write_rows
 from tabulate import tabulate
 import shutil
 from itertools import islice
 from bisect import bisect
-from terminaltables import AsciiTable, SingleTable, DoubleTable, GithubFlavoredMarkdownTable
 
 downloader = Downloader()
 
@@ -50,7 +49,30 @@ def run(subparsers):
                        help='Output JSON')
 
     group.add_argument('-y', '--yaml', default=False, action='store_true',
-                       help='Output YAML')
+                       help='Output YAML, with the same structure as the JSON output')
+
+    group.add_argument('-F', '--format', choices=FORMATS,
+                       help='Write rows in a format, to stdout or to the file given by --output. '
+                            'Parquet and Arrow require pyarrow')
+
+    parser.add_argument('-o', '--output',
+                        help='Write rows to a file, in the format given by --format, or by the file extension')
+
+    parser.add_argument('-L', '--limit', type=int,
+                        help='Output at most this many rows')
+
+    parser.add_argument('-O', '--offset', type=int,
+                        help='Skip this many rows before output')
+
+    parser.add_argument('-C', '--columns',
+                        help='Comma separated list of the columns to output')
+
+    parser.add_argument('-s', '--stats', default=False, action='store_true',
+                        help='Compute column statistics in one pass over the rows, and print them as a table, '
+                             'or as JSON with -j')
+
+    parser.add_argument('-W', '--write-stats', default=False, action='store_true',
+                        help='With --stats, write the statistics as column properties in the Schema section')
 
     # Arguments for Table
     parser.add_argument('-p', '--pivot', default=False, action='store_true',
@@ -99,10 +121,39 @@ def run_run(args):
             list_rr(doc)
             sys.exit(1)
 
-        if m.args.table:
+        columns = [c.strip() for c in m.args.columns.split(',')] if m.args.columns else None
+
+        rows = select_rows(r, columns, m.args.offset, m.args.limit)
+
+        if m.args.stats:
+            run_stats(m, doc, r, rows)
+            return
+
+        terminal = m.args.table or m.args.json or m.args.yaml
+
+        if terminal and m.args.output:
+            err("The --table, --json and --yaml options print to the terminal, and can't be used with --output. "
+                "Use --format, or an output file extension, to choose the file format")
+
+        if m.args.CSV:
+            fmt = 'csv'
+        elif m.args.tabs:
+            fmt = 'tsv'
+        elif terminal:
+            fmt = None
+        else:
+            fmt = m.args.format or format_for_path(m.args.output, 'csv' if m.args.output else None)
+
+        if fmt:
+            with open_output(m.args.output) as f:
+                write_rows(f, rows, fmt, columns=list(r.columns()) if fmt in ('parquet', 'arrow') else None)
+
+        elif m.args.table:
+            from terminaltables import SingleTable, GithubFlavoredMarkdownTable
+
             t_width = shutil.get_terminal_size()[0]
 
-            rows = list(islice(r, None, 20))
+            rows = list(islice(rows, None, 20))
 
             if m.args.pivot:
                 rows = list(zip(*rows))
@@ -137,12 +188,67 @@ def run_run(args):
 
         elif m.args.json:
             print('[')
-            for i,j in enumerate(r.iterjson()):
+            for i, j in enumerate(iter_json(r, rows)):
                 term = ",\n" if i > 0 else ""
-                print(term, j,end='')
+                print(term, j, end='')
             print(']')
 
+        elif m.args.yaml:
+            import json
+            import yaml
+
+            # Each row is dumped as a one item list, so the output is one YAML list
+            for j in iter_json(r, rows):
+                print(yaml.safe_dump([json.loads(j)], default_flow_style=False), end='')
+
         else:
 
-            for row in r:
+            for row in rows:
                 print(row)
+
+
+def iter_json(r, rows):
+    """Yield a JSON string for the structure of each of the selected rows of a resource, built
+    from the JSON header specifications of the resource's columns, as Resource.iterjson() does"""
+    from metapack.jsonstruct import compile_struct_builder, make_encoder
+
+    rows = iter(rows)
+    headers = next(rows, None) or []
+
+    json_paths = {c['header']: c.get('json') for c in r.columns()}
+
+    build = compile_struct_builder([(i, json_paths.get(h) or h) for i, h in enumerate(headers)])
+    encode = make_encoder()
+
+    for row in rows:
+        yield encode(build(row))
+
+
+def run_stats(m, doc, r, rows):
+    from metapack.stats import profile, write_schema_stats
+
+    stats = profile(rows)
+
+    if m.args.json:
+        import json
+        print(json.dumps([s.dict() for s in stats], indent=4, default=str))
+
+    else:
+        def fmt_top(top):
+            return ', '.join('{} ({})'.format(v, n) for v, n in top if n > 1)
+
+        d = [(s['name'], s['count'], s['nulls'], s['distinct'], s['min'], s['max'], s['mean'], s['std'],
+              fmt_top(s['top']))
+             for s in (s.dict() for s in stats)]
+
+        prt(tabulate(d, 'Name Count Nulls Distinct Min Max Mean Std Top'.split()))
+
+    if m.args.write_stats:
+        n = write_schema_stats(r, stats)
+
+        if n:
+            from metapack.cli.core import write_doc
+            write_doc(doc, m.mt_file)
+            prt("Wrote statistics for {} columns to {}".format(n, m.mt_file))
+        else:
+            err("Resource '{}' has no schema table to write statistics to".format(r.name))
@@ -0,0 +1,415 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+CLI program for serving package metadata and data over HTTP
+
+    GET /                                       List the packages, as JSON
+    GET /packages/<name>                        Package metadata, as JSON
+    GET /packages/<name>/metadata.csv           The package's metatab file
+    GET /packages/<name>/resources/<resource>   Rows of a resource or reference
+
+Rows are streamed as CSV, TSV, JSON Lines, Arrow or Parquet, chosen by an extension on the resource name,
+such as /resources/cities.jsonl, or with the format parameter. The columns, offset and limit parameters
+select columns and rows, and each where parameter, such as where=state=CA or where=population>=10000,
+filters the rows.
+"""
+
+import json
+import re
+from collections import OrderedDict
+from itertools import chain
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from os.path import isdir, join
+from threading import RLock
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from metapack import Downloader, MetapackDoc, MetapackUrl
+from metapack.cli.core import prt, err, warn
+from metapack.doc import _file_validator
+from metapack.exc import MetapackError, ResourceError
+from metapack.writers import FORMATS, BUFFER_SIZE, filter_rows, select_rows, write_rows
+from metatab import DEFAULT_METATAB_FILE
+
+downloader = Downloader()
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'tsv': 'text/tab-separated-values; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def serve(subparsers):
+    parser = subparsers.add_parser(
+        'serve',
+        help='Serve package metadata and data over HTTP',
+        epilog='Cache dir: {}\n'.format(str(downloader.cache.getsyspath('/'))))
+
+    parser.set_defaults(run_command=run_serve)
+
+    parser.add_argument('-b', '--bind', default='127.0.0.1',
+                        help='Address to listen on. Defaults to 127.0.0.1')
+
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help='Port to listen on. Defaults to 8000')
+
+    parser.add_argument('-m', '--max-age', type=int, default=60,
+                        help='Max age, in seconds, for the Cache-Control header. Defaults to 60')
+
+    parser.add_argument('packages', nargs='*',
+                        help="Paths or URLs to metatab files, or directories to search for them. "
+                             "Defaults to 'metadata.csv' in the current directory")
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ServedPackage(object):
+    """A package that is kept parsed, and reloaded when its metadata file changes"""
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = RLock()
+        self._validator = None
+        self.doc = None
+        self.hash = None
+
+        self.load()
+
+    def _metadata_path(self):
+        try:
+            return self.url.metadata_url.path if self.url.metadata_url.proto == 'file' else None
+        except AttributeError:
+            return None
+
+    def load(self):
+        path = self._metadata_path()
+
+        with self._lock:
+            validator = _file_validator(path) if path else None
+
+            if self.doc is not None and (validator is None or validator == self._validator):
+                return self.doc
+
+            doc = MetapackDoc(self.url, cache=downloader.cache)
+
+            self.hash = self._hash(doc, path)
+            self._validator = validator
+            self.doc = doc
+
+            return doc
+
+    @staticmethod
+    def _hash(doc, path):
+        """Hash the metadata, and the size and modification time of the package's local data files"""
+
+        h = sha1()
+
+        if path:
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        else:
+            h.update(doc.as_csv().encode('utf8'))
+
+        for r in doc.resources():
+            try:
+                u = r.resolved_url.get_resource().get_target()
+                h.update(repr(_file_validator(u.path)).encode('utf8') if u.proto == 'file' else b'')
+            except Exception:
+                pass
+
+        return h.hexdigest()
+
+    @property
+    def name(self):
+        return self.doc.name
+
+    def resource(self, name):
+        doc = self.load()
+
+        r = doc.resource(name) or doc.reference(name)
+
+        if not r:
+            raise HttpError(404, "No resource or reference '{}' in package '{}'".format(name, self.name))
+
+        return r
+
+    def metadata(self, base):
+        """Return a dict of the package metadata, for JSON"""
+
+        doc = self.load()
+
+        def resource_dict(r, kind):
+            d = OrderedDict([
+                ('name', r.name),
+                ('type', kind),
+                ('url', r.url),
+                ('description', r.get_value('description')),
+                ('columns', [OrderedDict((k, v) for k, v in c.items() if k != 'pos') for c in r.columns()]),
+                ('links', OrderedDict((f, '{}/resources/{}.{}'.format(base, r.name, f)) for f in FORMATS))
+            ])
+
+            return d
+
+        return OrderedDict([
+            ('name', doc.name),
+            ('identifier', doc.identifier),
+            ('title', doc.get_value('Root.Title')),
+            ('description', doc.description),
+            ('hash', self.hash),
+            ('resources', [resource_dict(r, 'resource') for r in doc.resources()]),
+            ('references', [resource_dict(r, 'reference') for r in doc.references()]),
+            ('metadata', '{}/metadata.csv'.format(base)),
+        ])
+
+
+class PackageService(object):
+    """The packages being served, keyed by name"""
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.packages = OrderedDict()
+
+    def add(self, ref):
+        url = MetapackUrl(str(ref), downloader=downloader)
+
+        p = ServedPackage(url)
+
+        if p.name in self.packages:
+            warn("Package '{}' from '{}' replaces an earlier package with the same name".format(p.name, ref))
+
+        self.packages[p.name] = p
+
+        return p
+
+    def package(self, name):
+        try:
+            return self.packages[name]
+        except KeyError:
+            raise HttpError(404, "No package named '{}'".format(name))
+
+    def index(self):
+        return [OrderedDict([('name', name), ('title', p.doc.get_value('Root.Title')), ('hash', p.hash),
+                             ('url', '/packages/{}'.format(name))])
+                for name, p in self.packages.items()]
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server, like http.server.ThreadingHTTPServer, which is only in Python 3.7 and later"""
+    daemon_threads = True
+
+
+def make_handler(service):
+    class Handler(ServiceHandler):
+        pass
+
+    Handler.service = service
+
+    return Handler
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """Request handler for a PackageService"""
+
+    service = None
+
+    wbufsize = BUFFER_SIZE
+
+    server_version = 'Metapack'
+
+    def log_message(self, format, *args):
+        prt("{} {}".format(self.address_string(), format % args))
+
+    def do_GET(self):
+
+        self.response_started = False
+
+        u = urlsplit(self.path)
+        query = parse_qs(u.query)
+        parts = [unquote(p) for p in u.path.split('/') if p]
+
+        try:
+            if not parts:
+                self.send_json(self.service.index())
+
+            elif parts[0] == 'packages' and len(parts) >= 2:
+                p = self.service.package(parts[1])
+                p.load()
+
+                if len(parts) == 2:
+                    self.send_json(p.metadata('/packages/{}'.format(p.name)), p.hash)
+
+                elif len(parts) == 3 and parts[2] == DEFAULT_METATAB_FILE:
+                    self.send_body(p.doc.as_csv().encode('utf8'), 'text/csv; charset=utf-8', p.hash)
+
+                elif len(parts) == 4 and parts[2] in ('resources', 'references'):
+                    self.send_rows(p, parts[3], query)
+
+                else:
+                    raise HttpError(404, "Not found: '{}'".format(u.path))
+            else:
+                raise HttpError(404, "Not found: '{}'".format(u.path))
+
+        except BrokenPipeError:
+            pass
+
+        except Exception as e:
+
+            if self.response_started:
+                # Too late to send an error status; drop the connection, so the client sees a short response
+                warn("Failed while sending '{}': {}".format(self.path, e))
+                self.close_connection = True
+
+            elif isinstance(e, HttpError):
+                self.send_json({'error': str(e)}, status=e.status)
+
+            else:
+                self.send_json({'error': '{}: {}'.format(type(e).__name__, e)}, status=500)
+
+    def etag(self, package_hash):
+        """An ETag for the representation at this path and query, of a package with a content hash"""
+        return '"{}"'.format(sha1((package_hash + self.path).encode('utf8')).hexdigest())
+
+    def not_modified(self, etag):
+
+        if etag and etag in [e.strip() for e in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return True
+
+        return False
+
+    def send_headers(self, content_type, package_hash=None, status=200, length=None):
+
+        self.response_started = True
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+
+        if length is not None:
+            self.send_header('Content-Length', str(length))
+
+        if package_hash:
+            self.send_header('ETag', self.etag(package_hash))
+            self.send_header('Cache-Control', 'max-age={}'.format(self.service.max_age))
+        else:
+            self.send_header('Cache-Control', 'no-cache')
+
+        self.end_headers()
+
+    def send_body(self, body, content_type, package_hash=None, status=200):
+
+        if package_hash and self.not_modified(self.etag(package_hash)):
+            return
+
+        self.send_headers(content_type, package_hash, status, len(body))
+        self.wfile.write(body)
+
+    def send_json(self, o, package_hash=None, status=200):
+        self.send_body(json.dumps(o, indent=4, default=str).encode('utf8'), 'application/json',
+                       package_hash, status)
+
+    def send_rows(self, p, name, query):
+
+        def param(k, default=None):
+            return query[k][-1] if k in query else default
+
+        fmt = param('format')
+
+        if fmt is None:
+            m = re.match(r'^(.*)\.({})$'.format('|'.join(FORMATS)), name)
+            name, fmt = (m.group(1), m.group(2)) if m else (name, 'csv')
+
+        if fmt not in FORMATS:
+            raise HttpError(400, "Unknown format '{}'; formats are {}".format(fmt, ', '.join(FORMATS)))
+
+        try:
+            offset = int(param('offset', 0))
+            limit = int(param('limit')) if param('limit') is not None else None
+        except ValueError:
+            raise HttpError(400, "The offset and limit must be integers")
+
+        columns = [c.strip() for c in param('columns').split(',')] if param('columns') else None
+
+        r = p.resource(name)
+
+        if self.not_modified(self.etag(p.hash)):
+            return
+
+        where = query.get('where', [])
+
+        rows = select_rows(filter_rows(r, where) if where else r, columns, offset, limit)
+
+        # The filters and columns are checked when the header is read, before the response
+        # starts, so errors get a status
+        try:
+            headers = next(rows)
+        except StopIteration:
+            headers = []
+        except ResourceError:
+            raise
+        except MetapackError as e:
+            raise HttpError(400, str(e))
+
+        rows = chain([headers], rows)
+
+        types = list(r.columns()) if fmt in ('arrow', 'parquet') else None
+
+        if fmt in ('arrow', 'parquet'):
+            # The Arrow and Parquet writers may seek or ask for the position, which a socket can't do
+            from tempfile import SpooledTemporaryFile
+            from shutil import copyfileobj
+
+            with SpooledTemporaryFile(max_size=64 * 1024 * 1024) as f:
+                write_rows(f, rows, fmt, columns=types)
+                length = f.tell()
+                f.seek(0)
+
+                self.send_headers(CONTENT_TYPES[fmt], p.hash, length=length)
+                copyfileobj(f, self.wfile, BUFFER_SIZE)
+        else:
+            self.send_headers(CONTENT_TYPES[fmt], p.hash)
+            write_rows(self.wfile, rows, fmt)
+
+
+def run_serve(args):
+    service = PackageService(max_age=args.max_age)
+
+    refs = args.packages or [DEFAULT_METATAB_FILE]
+
+    for ref in refs:
+        if isdir(ref):
+            from metapack.cli.metapack import discover_packages
+            refs_ = discover_packages(ref) or [join(ref, DEFAULT_METATAB_FILE)]
+        else:
+            refs_ = [ref]
+
+        for r in refs_:
+            try:
+                p = service.add(r)
+                prt("Serving '{}' from {}".format(p.name, r))
+            except Exception as e:
+                warn("Failed to load package '{}': {}".format(r, e))
+
+    if not service.packages:
+        err("No packages to serve")
+
+    server = _Server((args.bind, args.port), make_handler(service))
+
+    prt("Listening on http://{}:{}/".format(*server.server_address[:2]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
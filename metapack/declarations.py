@@ -0,0 +1,142 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+A process-wide registry of parsed declaration documents.
+
+Nearly every Metatab document starts with 'Declare: metatab-latest', and the standard term parser
+reads and parses the declaration document for every document it parses. The DeclarationRegistry parses
+each declaration document once, and the TermParser in this module installs the parsed declarations
+from the registry instead of parsing the document again.
+"""
+
+from threading import RLock
+
+from metatab import TermParser as _TermParser
+from rowgenerators import Source
+
+
+class _EmptyDeclaration(Source):
+    """Stands in for a declaration document whose declarations have already been installed"""
+
+    def __init__(self, ref):
+        super().__init__(ref)
+
+    def get_resource(self):
+        return self
+
+    def get_target(self):
+        return self
+
+    def __iter__(self):
+        return iter([])
+
+
+class DeclarationRegistry(object):
+    """Parsed declarations, keyed by the URL of the declaration document. The parsed declarations
+    are shared, so they must not be altered; use install() to copy them into a term parser"""
+
+    def __init__(self):
+        self._decls = {}
+        self._lock = RLock()
+
+    @staticmethod
+    def _key(url):
+        from os.path import getmtime
+
+        if url.scheme == 'file':
+            try:
+                return url.path, getmtime(url.path)
+            except OSError:
+                return url.path, None
+
+        return str(url), None
+
+    def get(self, url, resolver):
+        """Return a dict of the 'terms' and 'sections' declared in the document at url,
+        parsing the document if it has not been parsed yet. """
+
+        key = self._key(url)
+
+        with self._lock:
+            dd = self._decls.get(key)
+
+            if dd is None:
+                tp = _TermParser(resolver.get_row_generator([['Declare', key[0]]]), resolver=resolver)
+
+                for _ in tp:
+                    pass
+
+                dd = self._decls[key] = {
+                    'terms': dict(tp.declared_terms),
+                    'sections': dict(tp.declared_sections)
+                }
+
+        return dd
+
+    @staticmethod
+    def install(dd, terms, sections):
+        """Copy parsed declarations into the term and section dicts of a parser or document. Section
+        term lists are copied, since declaring terms appends to them"""
+
+        terms.update(dd['terms'])
+
+        for k, v in dd['sections'].items():
+            v = dict(v)
+            v['terms'] = list(v.get('terms', []))
+            sections[k] = v
+
+    def clear(self):
+        with self._lock:
+            self._decls.clear()
+
+    def __len__(self):
+        return len(self._decls)
+
+
+declarations = DeclarationRegistry()
+
+
+class TermParser(_TermParser):
+    """Term parser that installs declarations from the process-wide registry. It also parses the
+    rows of metadata files from the parse cache, a metapack.doc.MetadataRows, as if it were reading
+    the file"""
+
+    _metadata_path = None
+
+    def generate_terms(self, ref, root, file_type=None):
+        from metatab import Term
+
+        path = getattr(ref, 'metadata_path', None)
+
+        if path is None:
+            yield from super().generate_terms(ref, root, file_type)
+            return
+
+        # Terms from the rows get the source's class name as their file name, and declarations are resolved
+        # relative to its directory, so substitute the metadata file
+        self._metadata_path = path
+        placeholder = Term('x', None, file_name=type(ref).__name__).file_name
+        file_name = Term('x', None, file_name=path).file_name
+
+        for t in super().generate_terms(ref, root, file_type):
+            if t.file_name == placeholder:
+                t.file_name = file_name
+            yield t
+
+    def find_declare_doc(self, d, name):
+        from os.path import dirname
+
+        if not d and self._metadata_path:
+            d = dirname(self._metadata_path)
+
+        resolved = super().find_declare_doc(d, name)
+
+        try:
+            dd = declarations.get(resolved, self.resolver)
+        except Exception:
+            return resolved  # Parse the declaration document in the normal way
+
+        declarations.install(dd, self._declared_terms, self._declared_sections)
+
+        return _EmptyDeclaration(resolved)
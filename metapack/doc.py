@@ -7,11 +7,11 @@ Extensions to the MetatabDoc, Resources and References, etc.
 
 EMPTY_SOURCE_HEADER = '_NONE_'  # Marker for a column that is in the destination table but not in the source
 
+import re
+from os import environ
 from metatab import MetatabDoc, WebResolver
 
-from metapack.appurl import MetapackDocumentUrl, MetapackResourceUrl, MetapackUrl
-from appurl import parse_app_url
-from .html import linkify
+from metapack.appurl import MetapackDocumentUrl, MetapackResourceUrl, MetapackUrl, parse_app_url
 from .util import slugify
 from metapack.package.core import Downloader
 from rowgenerators import Source
@@ -25,6 +25,139 @@ class Resolver(WebResolver):
         except AttributeError:
             return super().get_row_generator(ref, cache)
 
+class DocCache(object):
+    """A bounded, thread safe LRU cache of parsed MetapackDocs, keyed on the canonical
+    metadata URL and a validator for the metadata file. The cached documents are shared,
+    so they must be treated as read-only"""
+
+    def __init__(self, maxsize=64):
+        from collections import OrderedDict
+        from threading import RLock
+
+        self.maxsize = maxsize
+        self._docs = OrderedDict()
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                doc = self._docs.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._docs[key] = doc  # Move to the most recently used end
+            self.hits += 1
+            return doc
+
+    def put(self, key, doc):
+        with self._lock:
+            self._docs.pop(key, None)
+            self._docs[key] = doc
+
+            while len(self._docs) > self.maxsize:
+                self._docs.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+
+def _file_validator(path):
+    """Return a value that changes when the file at path changes, or None if
+    the path is not a local file"""
+    from os import stat
+
+    try:
+        st = stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except (OSError, TypeError):
+        return None
+
+
+doc_cache = DocCache(int(environ.get('METAPACK_DOC_CACHE_SIZE', 64)))
+
+
+def shared_doc(url):
+    """Return a shared, read-only MetapackDoc for a MetapackDocumentUrl, from the process-wide
+    doc_cache if the metadata file has not changed since it was parsed. """
+
+    t = url.get_resource().get_target()
+    package_url = url.package_url
+
+    validator = _file_validator(t.path)
+
+    if validator is None:
+        return MetapackDoc(t, package_url=package_url)
+
+    key = (str(url), str(package_url), validator)
+
+    doc = doc_cache.get(key)
+
+    if doc is None:
+        doc = MetapackDoc(t, package_url=package_url)
+        doc_cache.put(key, doc)
+
+    return doc
+
+
+PARSE_CACHE_DIR = '_parsed'
+
+# Set METAPACK_PARSE_CACHE=0 to always read metadata files
+PARSE_CACHE = environ.get('METAPACK_PARSE_CACHE', '1') != '0'
+
+# Matches the Include term at the start of a line of a metadata CSV file
+_INCLUDE_RE = re.compile(br'^\s*"?(root\.)?include"?\s*,', re.IGNORECASE | re.MULTILINE)
+
+
+def _parsed_path(ref):
+    """Return the path in the cache for the rows of a local metadata CSV file, keyed on the file's contents.
+    Returns None if the reference can't be cached, including files with Include terms"""
+    from hashlib import sha1
+
+    if not PARSE_CACHE or not isinstance(ref, MetapackDocumentUrl):
+        return None
+
+    try:
+        if ref.scheme != 'file' or ref.resource_format != 'csv':
+            return None
+
+        with open(ref.path, 'rb') as f:
+            data = f.read()
+    except Exception:
+        return None
+
+    if _INCLUDE_RE.search(data):
+        return None  # The key would not change when an included file changes
+
+    return '{}/{}.json'.format(PARSE_CACHE_DIR, sha1(data).hexdigest())
+
+
+class MetadataRows(Source):
+    """The rows of a metadata file, read from the parse cache, or from the file before they are
+    written to the cache. The term parser reads the rows as it would read the file"""
+
+    def __init__(self, ref, rows):
+        super().__init__(ref)
+        self.rows = rows
+        self.metadata_path = ref.path
+
+    def get_resource(self):
+        return self
+
+    def get_target(self):
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
 class MetapackDoc(MetatabDoc):
 
     def __init__(self, ref=None, decl=None,  cache=None, resolver=None, package_url=None, clean_cache=False,
@@ -59,7 +192,102 @@ class MetapackDoc(MetatabDoc):
                 # For iterators, generators
                 package_url = None
 
-        super().__init__(ref, decl, package_url, cache, resolver, clean_cache)
+        super().__init__(None, decl, package_url, cache, resolver, clean_cache)
+
+        if ref:
+            self._parse(ref)
+
+    def _parse(self, ref):
+        """Parse the document, as MetatabDoc does, but with a term parser that shares
+        declarations with other documents"""
+        from os.path import getmtime
+        from appurl import AppUrlError
+        from metatab import MetatabError
+        from metapack.declarations import TermParser
+        from rowgenerators import SourceError
+
+        self._input_ref = ref
+
+        try:
+            self._ref = parse_app_url(ref)
+
+            try:
+                self._mtime = getmtime(self._ref.path) if self._ref.scheme == 'file' else 0
+            except (FileNotFoundError, OSError):
+                self._mtime = 0
+
+        except AppUrlError:  # ref is probably a generator, not a string or Url
+            self._ref = None
+
+        self._term_parser = TermParser(self._metadata_rows(ref) or ref, resolver=self.resolver, doc=self)
+
+        try:
+            self.load_terms(self._term_parser)
+        except SourceError as e:
+            raise MetatabError("Failed to load terms for document '{}': {}".format(self._ref, e))
+
+    def load_declarations(self, decls):
+        """Load declarations, using parsed declarations from the process-wide declaration registry"""
+        from metapack.declarations import TermParser
+
+        rg = self.resolver.get_row_generator([['Declare', dcl] for dcl in decls], cache=self._cache)
+
+        term_interp = TermParser(rg, resolver=self.resolver, doc=self)
+
+        list(term_interp)
+        dd = term_interp.declare_dict
+
+        self.decl_terms.update(dd['terms'])
+        self.decl_sections.update(dd['sections'])
+
+        return self
+
+    def _metadata_rows(self, ref):
+        """Return the rows of a local metadata CSV file from the parse cache, reading the file and storing
+        its rows in the cache if they aren't there. Returns None if the file can't be cached. The cache
+        holds only the rows, as JSON, so nothing in the cache is executed when it is loaded"""
+        import json
+        from os import replace
+        from uuid import uuid4
+
+        pp = _parsed_path(ref)
+
+        if pp is None:
+            return None
+
+        target = ref.get_resource().get_target()
+
+        try:
+            with self._cache.open(pp) as f:
+                rows = json.load(f)
+
+            if isinstance(rows, list) and all(isinstance(row, list) for row in rows):
+                return MetadataRows(target, rows)
+        except Exception:
+            pass
+
+        from rowgenerators import get_generator
+
+        try:
+            rows = [[str(v) if v is not None else '' for v in row] for row in get_generator(target)]
+        except Exception:
+            return None  # Let the term parser read the file, and report the error
+
+        try:
+            self._cache.makedirs(PARSE_CACHE_DIR, recreate=True)
+
+            path = self._cache.getsyspath(pp)
+            tmp = path + '.' + str(uuid4())
+
+            with open(tmp, 'w') as f:
+                json.dump(rows, f)
+
+            replace(tmp, path)
+
+        except Exception:
+            pass  # The parse cache is only an optimization
+
+        return MetadataRows(target, rows)
 
     @property
     def path(self):
@@ -195,6 +423,7 @@ class MetapackDoc(MetatabDoc):
         """Produce HTML for Jupyter Notebook"""
         from jinja2 import Template
         from markdown import markdown as convert_markdown
+        from .html import linkify
 
         extensions = [
             'markdown.extensions.extra',
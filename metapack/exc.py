@@ -16,5 +16,5 @@ class PackageError(MetapackError):
 class ResourceError(MetapackError):
     pass
 
-
-
+class ArchiveError(ResourceError):
+    pass
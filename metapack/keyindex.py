@@ -0,0 +1,268 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Persistent key indexes for CSV data files.
+
+A key index maps the values of one column of a CSV file to the byte offsets of the rows that have
+each value, so looking up a few keys reads only the matching rows, rather than the whole file. Keys
+are the text of the values in the CSV file, so a lookup for 6073 does not match '06073'.
+
+The index is a sorted table in a sidecar file next to the CSV file, searched with a binary search over a
+memory map, so opening an index does not read the whole table. The little-endian file has:
+
+    - A header with the magic number, version, number of keys, and the size and modification time
+      of the CSV file
+    - The length and UTF-8 text of the column name
+    - nkeys + 1 64 bit offsets of the start of each key in the key text
+    - nkeys 64 bit byte offsets of the rows, in key order
+    - The UTF-8 text of the keys, in sorted order
+
+The index is ignored if the CSV file has changed since the index was built. FileSystemPackageBuilder
+builds indexes for the columns that have a true Index property in the schema.
+"""
+
+import csv
+import mmap
+import re
+import struct
+import sys
+from array import array
+from glob import glob, escape
+from os import stat, replace
+from os.path import exists
+
+from metapack.exc import MetapackError
+
+KEY_INDEX_SUFFIX = '.keyidx'
+
+_MAGIC = b'MPKI'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHQQq')
+_NAME_LEN = struct.Struct('<H')
+_Q = struct.Struct('<Q')
+
+
+def key_index_path(data_path, column):
+    return '{}.{}{}'.format(data_path, re.sub(r'[^\w\-]', '_', column), KEY_INDEX_SUFFIX)
+
+
+def key_index_paths(data_path):
+    """Return the paths of all of the key indexes for a data file"""
+    return sorted(glob(escape(data_path) + '.*' + KEY_INDEX_SUFFIX))
+
+
+def schema_index_columns(columns):
+    """Return the headers of the columns, from Resource.columns(), that have a true Index property,
+    so they are indexed when the package is built"""
+
+    return [c['header'] for c in columns
+            if str(c.get('index') or '').strip().lower() in ('1', 'true', 't', 'yes', 'y')]
+
+
+def indexed_columns(data_path):
+    """Return the names of the columns of a data file that have key indexes"""
+
+    columns = []
+
+    for path in key_index_paths(data_path):
+        try:
+            with KeyIndex(path, data_path) as index:
+                columns.append(index.column)
+        except (OSError, ValueError, struct.error):
+            pass
+
+    return columns
+
+
+def _file_validator(path):
+    st = stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _records(f):
+    """Yield (byte offset, bytes) for each record of a binary CSV file, joining lines that end inside a quoted
+    value. Quotes in values are doubled, so a record is complete when it has an even number of quotes"""
+
+    pos = f.tell()
+    parts = []
+    quotes = 0
+
+    for line in f:
+        parts.append(line)
+        quotes += line.count(b'"')
+
+        if quotes % 2 == 0:
+            record = b''.join(parts)
+            yield pos, record
+            pos += len(record)
+            parts = []
+            quotes = 0
+
+    if parts:
+        yield pos, b''.join(parts)
+
+
+def _parse(record, encoding):
+    return next(csv.reader([record.decode(encoding)]), [])
+
+
+def build_key_index(data_path, column, encoding='utf-8'):
+    """Build the key index for a column of a CSV file, with the header in the first row.
+    Returns the path to the index"""
+
+    with open(data_path, 'rb') as f:
+        records = _records(f)
+
+        try:
+            headers = _parse(next(records)[1], encoding)
+        except StopIteration:
+            headers = []
+
+        try:
+            pos = headers.index(column)
+        except ValueError:
+            raise MetapackError("Can't index unknown column '{}'; columns are {}".format(column, headers))
+
+        entries = []
+
+        for offset, record in records:
+            if not record.strip():
+                continue
+
+            row = _parse(record, encoding)
+
+            entries.append(((row[pos] if pos < len(row) else '').encode('utf8'), offset))
+
+    entries.sort()
+
+    size, mtime = _file_validator(data_path)
+
+    key_starts = array('Q', [0])
+    n = 0
+    for k, _ in entries:
+        n += len(k)
+        key_starts.append(n)
+
+    offsets = array('Q', (o for _, o in entries))
+
+    name = column.encode('utf8')
+
+    path = key_index_path(data_path, column)
+    tmp = path + '.tmp'
+
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(entries), size, mtime))
+        f.write(_NAME_LEN.pack(len(name)))
+        f.write(name)
+
+        for a in (key_starts, offsets):
+            if sys.byteorder != 'little':
+                a.byteswap()
+            f.write(a.tobytes())
+
+        for k, _ in entries:
+            f.write(k)
+
+    replace(tmp, path)
+
+    return path
+
+
+class KeyIndex(object):
+    """A key index, opened for lookups. Use as a context manager, or call close()"""
+
+    def __init__(self, path, data_path):
+        self.path = path
+        self.data_path = data_path
+
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        mm = self._mm
+
+        magic, version, self.nkeys, self.size, self.mtime = _HEADER.unpack_from(mm, 0)
+
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise ValueError("Not a key index: '{}'".format(path))
+
+        p = _HEADER.size
+        name_len, = _NAME_LEN.unpack_from(mm, p)
+        p += _NAME_LEN.size
+
+        self.column = bytes(mm[p:p + name_len]).decode('utf8')
+        p += name_len
+
+        self._key_starts = p
+        self._offsets = p + (self.nkeys + 1) * 8
+        self._keys = self._offsets + self.nkeys * 8
+
+    @classmethod
+    def load(cls, data_path, column):
+        """Open the index for a column of a data file. Returns None if there is no index, or if the data
+        file has changed since the index was built"""
+
+        path = key_index_path(data_path, column)
+
+        if not exists(path) or not exists(data_path):
+            return None
+
+        try:
+            index = cls(path, data_path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+        if _file_validator(data_path) != (index.size, index.mtime) or index.column != column:
+            index.close()
+            return None
+
+        return index
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _key(self, i):
+        s, e = struct.unpack_from('<QQ', self._mm, self._key_starts + i * 8)
+        return self._mm[self._keys + s:self._keys + e]
+
+    def _offset(self, i):
+        return _Q.unpack_from(self._mm, self._offsets + i * 8)[0]
+
+    def offsets(self, key):
+        """Return the byte offsets of the rows with a key, in file order"""
+
+        k = str(key).encode('utf8')
+
+        lo, hi = 0, self.nkeys
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        offsets = []
+
+        while lo < self.nkeys and self._key(lo) == k:
+            offsets.append(self._offset(lo))
+            lo += 1
+
+        return offsets
+
+    def read(self, offsets, encoding='utf-8'):
+        """Yield (byte offset, raw row) for each row at a collection of byte offsets, in file order"""
+
+        with open(self.data_path, 'rb') as f:
+            for offset in sorted(set(offsets)):
+                f.seek(offset)
+                yield offset, _parse(next(_records(f))[1], encoding)
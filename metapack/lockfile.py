@@ -0,0 +1,103 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Resolution lockfiles, which record the URLs a package build downloaded, where they are in the cache,
+and their content hashes, along with the URL that each resource resolved to. With a lockfile, a build
+can run offline, resolving only from the lockfile and the cache.
+"""
+
+import json
+from hashlib import sha256
+from os import replace
+from os.path import exists
+from threading import Lock
+
+LOCKFILE_NAME = 'metadata.lock'
+
+
+def file_hash(path):
+    """Return the SHA256 of a file"""
+
+    h = sha256()
+
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(b)
+
+    return h.hexdigest()
+
+
+class LockfileError(IOError):
+    pass
+
+
+class Lockfile(object):
+    """The downloads and resource resolutions of a package build"""
+
+    def __init__(self, path):
+        self.path = path
+        self.urls = {}
+        self.resources = {}
+        self._verified = set()
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls, path):
+
+        lf = cls(path)
+
+        if exists(path):
+            with open(path) as f:
+                d = json.load(f)
+
+            lf.urls = d.get('urls', {})
+            lf.resources = d.get('resources', {})
+
+        return lf
+
+    def save(self):
+
+        tmp = self.path + '.tmp'
+
+        with open(tmp, 'w') as f:
+            json.dump({'urls': self.urls, 'resources': self.resources}, f, indent=4, sort_keys=True)
+
+        replace(tmp, self.path)
+
+    def record_download(self, url, cache_path, sys_path):
+
+        if url in self.urls:
+            return
+
+        e = {'cache_path': cache_path, 'sha256': file_hash(sys_path)}
+
+        with self._lock:
+            self.urls[url] = e
+
+    def record_resource(self, key, resolved_url):
+        with self._lock:
+            self.resources[key] = resolved_url
+
+    def resolved(self, key):
+        return self.resources.get(key)
+
+    def verify(self, url, sys_path):
+        """Check that the cached copy of a URL has the content hash recorded in the lockfile"""
+
+        if url in self._verified:
+            return
+
+        e = self.urls[url]
+
+        h = file_hash(sys_path)
+
+        if h != e['sha256']:
+            raise LockfileError("Cached copy of '{}' has hash {}, but lockfile '{}' expects {}"
+                                .format(url, h, self.path, e['sha256']))
+
+        with self._lock:
+            self._verified.add(url)
+
+    def __len__(self):
+        return len(self.urls)
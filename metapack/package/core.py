@@ -3,12 +3,14 @@
 
 """ """
 
+import logging
 from collections import namedtuple
 from genericpath import exists, isfile
 from hashlib import sha1
 from itertools import islice
 from os import walk
 from os.path import dirname, abspath, basename, splitext, join, isdir
+from time import time
 
 
 
@@ -26,14 +28,269 @@ from appurl import Downloader as _Downloader
 
 DEFAULT_CACHE_NAME = 'metapack'
 
+logger = logging.getLogger('metapack.download')
+
+REVALIDATE_DIR = '_revalidate'
+
+
 class Downloader(_Downloader):
-    """"Local version of the downloader. Also should be used as the source of the cache"""
+    """"Local version of the downloader. Also should be used as the source of the cache
+
+    Cached HTTP resources can be revalidated with conditional requests. The ETag and Last-Modified
+    headers of each download are stored in the cache, and when a cached copy is older than the max age
+    for its URL, the downloader sends If-None-Match and If-Modified-Since headers. A 304 response
+    re-uses the cached copy. Max ages are set with configure_revalidation()
+    """
 
     ok = True
 
+    # List of (compiled regex, max age in seconds ) tuples, matched in order against the URL
+    revalidate_policy = []
+
+    # Max age for URLs that don't match any pattern. None means cached copies never expire.
+    max_age = None
+
+    # If set, a metapack.lockfile.Lockfile that records downloads. When offline is True, URLs are resolved
+    # only from the lockfile and the cache, and nothing is downloaded
+    lockfile = None
+    offline = False
+
+    @classmethod
+    def configure_lock(cls, lockfile=None, offline=False):
+        """Set the lockfile and offline mode for all downloaders"""
+        cls.lockfile = lockfile
+        cls.offline = offline
+
+    @classmethod
+    def configure_revalidation(cls, policy=None, max_age=None):
+        """Set the revalidation policy for all downloaders.
+
+        :param policy: A list of dicts with 'pattern' and 'max_age' keys, or (pattern, max_age) tuples.
+        :param max_age: Max age, in seconds, for URLs that don't match a pattern. 0 revalidates on every access.
+        """
+        import re
+
+        rules = []
+
+        for e in policy or []:
+            if isinstance(e, dict):
+                pattern, age = e['pattern'], e.get('max_age')
+            else:
+                pattern, age = e
+
+            rules.append((re.compile(pattern), int(age) if age is not None else None))
+
+        cls.revalidate_policy = rules
+        cls.max_age = max_age
+
+    def max_age_for(self, url):
+        """Return the max age for cached copies of a URL, or None if they should not be revalidated"""
+
+        for pattern, age in self.revalidate_policy:
+            if pattern.search(url):
+                return age
+
+        return self.max_age
+
     def download(self, url):
         return super().download(url)
 
+    def _download_with_lock(self, url):
+
+        if self.offline:
+            return self._offline_download(url)
+
+        cache_path, download_time = super()._download_with_lock(url)
+
+        if download_time is None:
+            # Found it in the cache
+            if url.startswith(('http:', 'https:')) and self._revalidate(url, cache_path):
+                download_time = time()
+
+            self._touch(cache_path)
+
+        if self.lockfile is not None:
+            self.lockfile.record_download(url, cache_path, self.cache.getsyspath(cache_path))
+
+        return cache_path, download_time
+
+    def _offline_download(self, url):
+        """Return the cache path for a URL from the lockfile or the cache, without using the network"""
+        from appurl import DownloadError
+        from metapack.cache import cache_path_for_url
+        from metapack.lockfile import LockfileError
+
+        e = self.lockfile.urls.get(url) if self.lockfile is not None else None
+
+        cache_path = e['cache_path'] if e else cache_path_for_url(url)
+
+        if not self.cache.exists(cache_path):
+            raise DownloadError("Offline, and '{}' is not in the cache".format(url))
+
+        if e:
+            try:
+                self.lockfile.verify(url, self.cache.getsyspath(cache_path))
+            except LockfileError as exc:
+                raise DownloadError(str(exc))
+
+        self._touch(cache_path)
+
+        return cache_path, None
+
+    def _download(self, url, cache_path):
+
+        if url.startswith(('http:', 'https:')):
+            self._http_download(url, cache_path)
+        else:
+            super()._download(url, cache_path)
+
+    def _touch(self, cache_path):
+        """Record the access for LRU eviction in the CacheManager"""
+        from fs.errors import NoSysPath
+        from metapack.cache import touch
+
+        try:
+            touch(self.cache.getsyspath(cache_path))
+        except NoSysPath:
+            pass
+
+    def _cache_lock(self, cache_path):
+        """Return the file lock that the base downloader holds while it writes a cached file"""
+        from contextlib import ExitStack
+        from fs.errors import NoSysPath
+
+        try:
+            from filelock import FileLock
+            return FileLock(self.cache.getsyspath(cache_path + '.lock'))
+        except NoSysPath:
+            return ExitStack()  # Caches without sys paths are only used by single processes
+
+    def _replace(self, src_path, dst_path):
+        """Atomically replace a file in the cache"""
+        from os import replace
+        from fs.errors import NoSysPath
+
+        try:
+            replace(self.cache.getsyspath(src_path), self.cache.getsyspath(dst_path))
+        except NoSysPath:
+            self.cache.move(src_path, dst_path, overwrite=True)
+
+    def _meta_path(self, cache_path):
+        return join(REVALIDATE_DIR, cache_path.lstrip('/') + '.json')
+
+    def _read_meta(self, cache_path):
+        import json
+
+        try:
+            with self.cache.open(self._meta_path(cache_path)) as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _write_meta(self, cache_path, meta):
+        import json
+        from os.path import dirname
+
+        mp = self._meta_path(cache_path)
+
+        self.cache.makedirs(dirname(mp), recreate=True)
+
+        with self.cache.open(mp, 'w') as f:
+            json.dump(meta, f)
+
+    def _http_download(self, url, cache_path, headers=None):
+        """GET a URL into the cache, and record the validators from the response.
+        Returns False if the server responded that the cached copy is still valid"""
+        import requests
+        from requests.exceptions import SSLError
+        from appurl import DownloadError
+
+        if self.callback:
+            self.callback('download', url, 0)
+
+        try:
+            r = requests.get(url, stream=True, headers=headers or {})
+
+            if r.status_code == 304:
+                meta = self._read_meta(cache_path)
+                meta['fetched'] = time()
+                self._write_meta(cache_path, meta)
+                return False
+
+            r.raise_for_status()
+        except SSLError as e:
+            raise DownloadError("Failed to GET {}: {} ".format(url, e))
+
+        # Write to a temp file and move, so a failed download doesn't replace a good cached copy.
+        part_path = cache_path + '.part'
+
+        try:
+            read = 0
+            with self.cache.open(part_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+                    read += len(chunk)
+                    if self.callback:
+                        self.callback('copy_file', len(chunk), read)
+
+            self._replace(part_path, cache_path)
+
+        except (KeyboardInterrupt, Exception):
+            if self.cache.exists(part_path):
+                self.cache.remove(part_path)
+            raise
+
+        self._write_meta(cache_path, {
+            'url': url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'fetched': time()
+        })
+
+        return True
+
+    def _revalidate(self, url, cache_path):
+        """Check a cached copy with a conditional request, if it is older than the max age for the URL.
+        Returns True if a new copy was downloaded """
+        from requests.exceptions import RequestException
+
+        max_age = self.max_age_for(url)
+
+        if max_age is None:
+            return False
+
+        if not self._expired(cache_path, max_age):
+            return False
+
+        # Hold the same lock as the base downloader, so no other thread or process reads or downloads
+        # the file while it is replaced
+        with self._cache_lock(cache_path):
+
+            # Another process may have revalidated it while we waited for the lock
+            if not self._expired(cache_path, max_age):
+                return False
+
+            meta = self._read_meta(cache_path)
+
+            headers = {}
+
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+            try:
+                return self._http_download(url, cache_path, headers)
+            except (RequestException, IOError) as e:
+                logger.warning("Failed to revalidate '{}'; using cached copy: {}".format(url, e))
+                return False
+
+    def _expired(self, cache_path, max_age):
+        meta = self._read_meta(cache_path)
+
+        return not meta or time() - meta.get('fetched', 0) >= max_age
+
 
 class PackageBuilder(object):
 
@@ -498,3 +755,118 @@ def open_package(ref, cache=None, clean_cache=False, downloader=None):
     return MetapackDoc(u, downloader=downloader)
 
 
+
+
+PREFETCH_TERMS = ['Root.Datafile', 'Root.Resource', 'Root.Reference', 'Root.Documentation']
+
+REMOTE_SCHEMES = ('http', 'https', 'ftp', 's3')
+
+PrefetchResult = namedtuple('PrefetchResult', 'url path elapsed cached error')
+
+
+def remote_urls(doc):
+    """Return the distinct remote URLs for the data files, references and documentation of a
+    package, without fragments or scheme extensions"""
+
+    urls = []
+
+    for t in doc.find(PREFETCH_TERMS):
+        url = t.get_value('url') or t.value
+
+        if not url:
+            continue
+
+        try:
+            u = parse_app_url(str(url))
+        except Exception:
+            continue
+
+        if u.scheme not in REMOTE_SCHEMES:
+            continue
+
+        resource_url = str(u.resource_url)
+
+        if u.proto == 'metapack' and u.resource_format not in ('csv', 'zip', 'xlsx'):
+            # Filesystem package; the URL is the package directory
+            resource_url = resource_url.rstrip('/') + '/' + DEFAULT_METATAB_FILE
+
+        if resource_url not in urls:
+            urls.append(resource_url)
+
+    return urls
+
+
+class Prefetcher(object):
+    """Download the remote inputs of a package into the cache concurrently, so a build does not
+    wait on the network for each resource in turn.
+
+    start() submits the downloads and returns immediately, so the prefetch can overlap with other work;
+    results() waits for them to finish. Downloads of the same URL by the build share the
+    downloader's lock, so the build waits for an in-progress prefetch instead of downloading twice.
+    """
+
+    def __init__(self, doc, downloader, max_workers=8):
+        """
+        :param doc: A MetapackDoc, or a list of them, to prefetch the distinct inputs of several packages
+        :param downloader: Downloader for the cache
+        :param max_workers: Number of concurrent downloads
+        """
+        from collections import OrderedDict
+
+        self.doc = doc
+        self.downloader = downloader
+        self.max_workers = max_workers
+
+        docs = doc if isinstance(doc, (list, tuple)) else [doc]
+        self.urls = list(OrderedDict.fromkeys(u for d in docs for u in remote_urls(d)))
+        self._executor = None
+        self._futures = []
+
+    def _fetch(self, url):
+        from metapack.cache import cache_path_for_url
+
+        cached = self.downloader.cache.exists(cache_path_for_url(url))
+
+        t = time()
+
+        try:
+            r = parse_app_url(url, downloader=self.downloader).get_resource()
+            return PrefetchResult(url, str(r.fspath), time() - t, cached, None)
+        except Exception as e:
+            return PrefetchResult(url, None, time() - t, cached, e)
+
+    def start(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+            self._futures = [self._executor.submit(self._fetch, url) for url in self.urls]
+
+        return self
+
+    def results(self):
+        """Wait for the downloads, and return a PrefetchResult for each URL, in document order"""
+
+        self.start()
+
+        try:
+            return [f.result() for f in self._futures]
+        finally:
+            self._executor.shutdown()
+
+    def __iter__(self):
+        """Start the downloads and yield each PrefetchResult as it completes"""
+        from concurrent.futures import as_completed
+
+        self.start()
+
+        try:
+            for f in as_completed(self._futures):
+                yield f.result()
+        finally:
+            self._executor.shutdown()
+
+
+def prefetch(doc, downloader, max_workers=8):
+    """Download the remote inputs of a package concurrently and return a list of PrefetchResults"""
+    return Prefetcher(doc, downloader, max_workers).results()
@@ -10,13 +10,14 @@ from genericpath import exists, getmtime
 from os import getcwd, makedirs, remove
 from os.path import join, dirname, isdir
 
-from nbconvert.writers import FilesWriter
 from appurl import parse_app_url
 from metatab.datapackage import convert_to_datapackage
 from metatab import DEFAULT_METATAB_FILE
 from .core import PackageBuilder
 from metapack.util import ensure_dir, write_csv, slugify, datetime_now
 from metapack.appurl import MetapackUrl
+from metapack.rowindex import row_index_path
+from metapack.keyindex import build_key_index, key_index_paths, schema_index_columns
 
 
 class FileSystemPackageBuilder(PackageBuilder):
@@ -134,13 +135,19 @@ class FileSystemPackageBuilder(PackageBuilder):
 
         makedirs(dirname(path), exist_ok=True)
 
-        if exists(path):
-            remove(path)
+        index_path = row_index_path(path)
 
+        for p in [path, index_path] + key_index_paths(path):
+            if exists(p):
+                remove(p)
 
         gen = islice(source_r, 1, None)
         headers = source_r.headers
-        write_csv(path, headers, gen)
+        write_csv(path, headers, gen, index_path=index_path)
+
+        for column in schema_index_columns(source_r.columns()):
+            self.prt("Indexing column '{}' of '{}'".format(column, r.name))
+            build_key_index(path, column)
 
         # Writting between resources so row-generating programs and notebooks can
         # access previously created resources. We have to clean the doc before writing it
@@ -175,6 +182,8 @@ class FileSystemPackageBuilder(PackageBuilder):
         # Process all of the normal files
         super()._load_documentation_files()
 
+        from nbconvert.writers import FilesWriter
+
         de = DocumentationExporter()
         fw = FilesWriter()
         fw.build_directory = join(self.package_path.path,'docs')
@@ -3,15 +3,18 @@
 
 """ """
 import json
+from functools import lru_cache
 from io import BytesIO
 from os.path import join, getsize
-from os import walk
-import boto3
+from os import walk, environ
+from threading import Lock, local
 import unicodecsv as csv
 
 from appurl import parse_app_url
 from metatab import DEFAULT_METATAB_FILE
 
+from metapack.rowindex import ROW_INDEX_SUFFIX
+from metapack.keyindex import KEY_INDEX_SUFFIX
 from .core import PackageBuilder
 
 
@@ -79,6 +82,9 @@ class S3PackageBuilder(PackageBuilder):
         # Copy all of the files from the Filesystem package
         for root, dirs, files in walk(self.source_dir):
             for f in files:
+                if f.endswith((ROW_INDEX_SUFFIX, KEY_INDEX_SUFFIX)):
+                    continue  # Indexes are only valid for the filesystem package's own files
+
                 source = join(root, f)
                 rel = source.replace(self.source_dir, '').strip('/')
 
@@ -157,6 +163,7 @@ class S3PackageBuilder(PackageBuilder):
 def set_s3_profile(profile_name):
     """Load the credentials for an s3 profile into environmental variables"""
     import os
+    import boto3
 
     session = boto3.Session(profile_name=profile_name)
 
@@ -164,33 +171,113 @@ def set_s3_profile(profile_name):
     os.environ['AWS_SECRET_ACCESS_KEY'] = session.get_credentials().secret_key
 
 
+# Size of the connection pools for the S3 clients and resources. Override with set_s3_pool_size()
+# or the METAPACK_S3_POOL_SIZE env var
+S3_POOL_SIZE = int(environ.get('METAPACK_S3_POOL_SIZE', 50))
+
+_s3_clients = {}
+_s3_clients_lock = Lock()
+
+# Resources are not thread-safe, so each thread has its own. The generation invalidates them
+# when the clients are cleared
+_s3_local = local()
+_s3_generation = 0
+
+
+def get_s3_client(profile=None, region=None):
+    """Return the process-wide S3 client for a profile and region, creating it on first use. Clients
+    are thread-safe, so one client, and its connection pool, is shared by all threads"""
+    import boto3
+    from botocore.client import Config
+
+    key = (profile, region)
+
+    with _s3_clients_lock:
+        try:
+            return _s3_clients[key]
+        except KeyError:
+            session = boto3.Session(profile_name=profile, region_name=region)
+            c = session.client('s3', config=Config(max_pool_connections=S3_POOL_SIZE))
+            _s3_clients[key] = c
+            return c
+
+
+def get_s3_resource(profile=None, region=None):
+    """Return the S3 resource for a profile and region for the current thread"""
+    import boto3
+    from botocore.client import Config
+
+    if getattr(_s3_local, 'generation', None) != _s3_generation:
+        _s3_local.generation = _s3_generation
+        _s3_local.resources = {}
+
+    key = (profile, region)
+
+    try:
+        return _s3_local.resources[key]
+    except KeyError:
+        session = boto3.Session(profile_name=profile, region_name=region)
+        r = _s3_local.resources[key] = session.resource('s3', config=Config(max_pool_connections=S3_POOL_SIZE))
+        return r
+
+
+def clear_s3_clients():
+    """Remove all of the shared S3 clients and the per-thread resources, so they will be re-created on next use"""
+    global _s3_generation
+
+    with _s3_clients_lock:
+        _s3_clients.clear()
+        _s3_generation += 1
+
+    _is_dns_bucket.cache_clear()
+
+
+def set_s3_pool_size(n):
+    """Set the connection pool size for shared S3 clients. Clears existing clients"""
+    global S3_POOL_SIZE
+    S3_POOL_SIZE = n
+    clear_s3_clients()
+
+
+@lru_cache(maxsize=None)
+def _is_dns_bucket(bucket_name):
+    """Return True if the bucket name is a resolvable address"""
+    import socket
+
+    try:
+        socket.getaddrinfo(bucket_name, None)
+        return True
+    except socket.gaierror:
+        return False
+
+
 class S3Bucket(object):
 
-    def __init__(self, url, acl='public', profile=None):
-        import socket
+    def __init__(self, url, acl='public', profile=None, region=None):
 
         if url.scheme != 's3':
             raise ReferenceError("Must be an S3 url; got: {}".format(url))
 
         self.url = url
 
-        session = boto3.Session(profile_name=profile)
-
-        self._s3 = session.resource('s3')
+        self.profile = profile
+        self.region = region
 
         if acl == 'public':
             acl = 'public-read'
 
         self._acl = acl
 
-        self._bucket = self._s3.Bucket(self.bucket_name)
+        self._public_url_base = None
 
-        # Check if the bucket name is a resolvable address.
-        try:
-            socket.getaddrinfo(self.bucket_name, None)
-            self.dns_bucket = True
-        except socket.gaierror:
-            self.dns_bucket = False
+    @property
+    def _bucket(self):
+        """A Bucket from the current thread's resource, since resources can't be shared between threads"""
+        return get_s3_resource(self.profile, self.region).Bucket(self.bucket_name)
+
+    @property
+    def dns_bucket(self):
+        return _is_dns_bucket(self.bucket_name)
 
     @property
     def prefix(self):
@@ -200,6 +287,13 @@ class S3Bucket(object):
     def bucket_name(self):
         return self.url.netloc
 
+    @property
+    def client(self):
+        return get_s3_client(self.profile, self.region)
+
+    def key(self, *paths):
+        return join(self.prefix, *paths).strip('/')
+
     def access_url(self, *paths):
 
         if self._acl == 'private':
@@ -209,36 +303,30 @@ class S3Bucket(object):
 
     def private_access_url(self, *paths):
 
-        key = join(self.prefix, *paths).strip('/')
-
-        s3 = boto3.client('s3')
+        return "s3://{}/{}".format(self.bucket_name, self.key(*paths))
 
-        return "s3://{}/{}".format(self.bucket_name, key)
+    @property
+    def public_url_base(self):
+        """The HTTP URL for the bucket, to which keys are appended to make public URLs"""
 
-    def public_access_url(self, *paths):
+        if self._public_url_base is None:
+            url = self.client.meta.endpoint_url.replace('https', 'http')
 
-        key = join(self.prefix, *paths).strip('/')
+            if self.dns_bucket:
+                url = url.replace('/s3.amazonaws.com','') # Assume bucket has name because it is setup as a CNAME
 
-        s3 = boto3.client('s3')
+            self._public_url_base = '{}/{}'.format(url, self.bucket_name)
 
-        url = s3.meta.endpoint_url.replace('https', 'http')
+        return self._public_url_base
 
-        if self.dns_bucket:
-            url = url.replace('/s3.amazonaws.com','') # Assume bucket has name because it is setup as a CNAME
+    def public_access_url(self, *paths):
 
-        return '{}/{}/{}'.format(url, self.bucket_name, key)
+        return '{}/{}'.format(self.public_url_base, self.key(*paths))
 
     def signed_access_url(self, *paths):
 
-        import pdb;
-        pdb.set_trace()
-
-        key = join(self.prefix, *paths).strip('/')
-
-        s3 = boto3.client('s3')
-
-        return s3.generate_presigned_url('get_object', Params={'Bucket': self.bucket_name, 'Key': key})
-
+        return self.client.generate_presigned_url('get_object',
+                                                  Params={'Bucket': self.bucket_name, 'Key': self.key(*paths)})
 
     def exists(self, *paths):
         import botocore
@@ -262,10 +350,8 @@ class S3Bucket(object):
 
     def list(self):
 
-        s3 = boto3.client('s3')
-
         # Create a reusable Paginator
-        paginator = s3.get_paginator('list_objects')
+        paginator = self.client.get_paginator('list_objects')
 
         # Create a PageIterator from the Paginator
         page_iterator = paginator.paginate(Bucket=self.bucket_name)
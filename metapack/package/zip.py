@@ -2,6 +2,8 @@ from os import walk
 from os.path import join
 import zipfile
 from metapack.util import slugify
+from metapack.rowindex import ROW_INDEX_SUFFIX
+from metapack.keyindex import KEY_INDEX_SUFFIX
 
 from .core import PackageBuilder
 
@@ -40,6 +42,9 @@ class ZipPackageBuilder(PackageBuilder):
 
         for root, dirs, files in walk(self.source_dir):
             for f in files:
+                if f.endswith((ROW_INDEX_SUFFIX, KEY_INDEX_SUFFIX)):
+                    continue  # Indexes are only valid for the filesystem package's own files
+
                 source = join(root, f)
                 rel = source.replace(self.source_dir,'').strip('/')
                 dest = join(root_dir, rel)
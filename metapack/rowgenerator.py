@@ -6,6 +6,7 @@
 """
 
 from rowgenerators import Source
+from rowgenerators.generator.excel import ExcelSource
 
 
 class JupyterNotebookSource(Source):
@@ -118,6 +119,49 @@ class PandasDataframeSource(Source):
         self.finish()
 
 
+class ZipMemberSource(Source):
+    """Generate rows from a CSV file in a ZIP archive, streaming the member out of the archive
+    rather than extracting it to the cache"""
 
+    def __init__(self, ref, archive, member, encoding=None, cache=None, working_dir=None, **kwargs):
+        super().__init__(ref, cache, working_dir, **kwargs)
+
+        self.archive = archive
+        self.member = member
+        self.encoding = encoding or 'utf-8'
+
+    def __iter__(self):
+        from csv import reader
+
+        self.start()
+
+        with self.archive.open_text(self.member, self.encoding) as f:
+            yield from reader(f)
+
+        self.finish()
 
 
+class ExcelSidecarSource(ExcelSource):
+    """Generate rows from an Excel file, reading the sheet from a sidecar file in the cache, which is
+    created from the workbook on the first read of any of its sheets"""
+
+    def __iter__(self):
+        from metapack.sidecar import ExcelSidecar
+        from metapack.package.core import Downloader
+
+        try:
+            cache = self.cache or Downloader().cache
+            rows = ExcelSidecar(str(self.url.fspath), cache).rows(self.url.target_segment)
+            first = next(rows, None)
+        except Exception:
+            # Can't use the sidecar, so parse the workbook
+            yield from super().__iter__()
+            return
+
+        self.start()
+
+        if first is not None:
+            yield first
+            yield from rows
+
+        self.finish()
@@ -0,0 +1,188 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Row offset indexes for CSV data files.
+
+When FileSystemPackageBuilder writes a resource's CSV file, it records the byte offset of every
+stride'th data row in a sidecar file next to the CSV file, so reading from any row can seek to the
+nearest indexed row instead of reading and casting all of the rows before it. The index records the
+size and modification time of the CSV file, and is ignored if the file has changed.
+
+The sidecar is a little-endian binary file: a header with the magic number, version, stride, number of
+data rows, and the size and modification time of the CSV file, followed by one 64 bit offset for each
+indexed row.
+"""
+
+import csv
+import io
+import struct
+import sys
+from array import array
+from itertools import groupby, islice
+from os import stat, environ, replace
+from os.path import exists
+
+ROW_INDEX_SUFFIX = '.rowidx'
+
+ROW_INDEX_STRIDE = int(environ.get('METAPACK_ROW_INDEX_STRIDE', 1000))
+
+_MAGIC = b'MPRI'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHIQQq')
+
+
+def row_index_path(data_path):
+    return data_path + ROW_INDEX_SUFFIX
+
+
+class RowIndex(object):
+    """The offsets of every stride'th data row in a CSV file"""
+
+    def __init__(self, data_path, stride, nrows, offsets, validator=None):
+        self.data_path = data_path
+        self.stride = stride
+        self.nrows = nrows
+        self.offsets = offsets
+        self.validator = validator
+
+    @staticmethod
+    def _file_validator(path):
+        st = stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def write(self, path=None):
+        """Write the index to its sidecar file, with the validator of the data file as it is now"""
+
+        path = path or row_index_path(self.data_path)
+
+        size, mtime = self.validator = self._file_validator(self.data_path)
+
+        offsets = array('Q', self.offsets)
+
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        tmp = path + '.tmp'
+
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, self.stride, self.nrows, size, mtime))
+            f.write(offsets.tobytes())
+
+        replace(tmp, path)
+
+        return path
+
+    @classmethod
+    def load(cls, data_path):
+        """Load the index for a data file. Returns None if there is no index, or if the data file
+        has changed since the index was written """
+
+        path = row_index_path(data_path)
+
+        if not exists(path) or not exists(data_path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                magic, version, stride, nrows, size, mtime = _HEADER.unpack(f.read(_HEADER.size))
+
+                if magic != _MAGIC or version != _VERSION:
+                    return None
+
+                offsets = array('Q')
+                offsets.frombytes(f.read())
+        except (OSError, struct.error, ValueError):
+            return None
+
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        if cls._file_validator(data_path) != (size, mtime):
+            return None
+
+        return cls(data_path, stride, nrows, offsets, (size, mtime))
+
+    def locate(self, row):
+        """Return the byte offset of the indexed row at or before a data row, and the number of rows
+        to skip after it """
+
+        row = max(0, min(row, self.nrows))
+
+        i = min(row // self.stride, len(self.offsets) - 1)
+
+        if i < 0:
+            return None, 0
+
+        return self.offsets[i], row - i * self.stride
+
+    def read(self, start=0, stop=None, encoding='utf-8'):
+        """Yield the raw rows, as lists of strings, of the data rows from start to stop"""
+
+        stop = self.nrows if stop is None else min(stop, self.nrows)
+
+        if start >= stop:
+            return
+
+        offset, skip = self.locate(start)
+
+        if offset is None:
+            return
+
+        f = open(self.data_path, 'rb')
+        f.seek(offset)
+
+        with io.TextIOWrapper(f, encoding=encoding, newline='') as t:
+            yield from islice(csv.reader(t), skip, skip + stop - start)
+
+    def read_rows(self, row_numbers, encoding='utf-8'):
+        """Yield (row number, raw row) for each of a collection of data row numbers, in order of row number,
+        opening the file once and reading each block of stride rows at most once"""
+
+        wanted = sorted(set(n for n in row_numbers if 0 <= n < self.nrows))
+
+        if not wanted:
+            return
+
+        with open(self.data_path, 'rb') as f:
+            for block, numbers in groupby(wanted, key=lambda n: n // self.stride):
+                numbers = list(numbers)
+
+                f.seek(self.offsets[block])
+
+                # A new wrapper for each block, since the wrapper reads ahead of the seek position
+                t = io.TextIOWrapper(f, encoding=encoding, newline='')
+                reader = csv.reader(t)
+
+                pos = block * self.stride
+
+                for n in numbers:
+                    for _ in range(n - pos):
+                        next(reader)
+
+                    yield n, next(reader)
+                    pos = n + 1
+
+                t.detach()
+
+
+class RowIndexWriter(object):
+    """Record the offsets of rows as they are written to a binary file"""
+
+    def __init__(self, data_path, f, stride=None):
+        self.data_path = data_path
+        self.f = f
+        self.stride = stride or ROW_INDEX_STRIDE
+        self.offsets = []
+        self.nrows = 0
+
+    def before_row(self):
+        """Call before writing each data row"""
+
+        if self.nrows % self.stride == 0:
+            self.offsets.append(self.f.tell())
+
+        self.nrows += 1
+
+    def index(self):
+        return RowIndex(self.data_path, self.stride, self.nrows, self.offsets)
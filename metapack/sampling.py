@@ -0,0 +1,89 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Single pass random samples of rows, in memory proportional to the size of the sample.
+
+reservoir_sample() uses Li's Algorithm L, which computes how many rows to skip before the next row
+that enters the reservoir, so it draws random numbers only for the rows it keeps, rather than for every
+row. stratified_sample() keeps a separate reservoir for each value of a key.
+
+Both functions return (row number, row) tuples, in order of row number, and copy only the rows they keep.
+"""
+
+from itertools import islice
+from math import exp, floor, log
+from operator import itemgetter
+
+
+def _uniform(rand):
+    """A uniform random number in (0, 1)"""
+    return rand.random() or 5e-324
+
+
+def reservoir_sample(rows, n, rand):
+    """Select n rows, each with equal probability, from an iterable of rows
+
+    :param rows: Iterable of rows
+    :param n: Number of rows to select
+    :param rand: A random.Random
+    :return: List of (row number, row) tuples, in order of row number
+    """
+
+    if n <= 0:
+        return []
+
+    it = enumerate(rows)
+
+    sample = [(i, list(row)) for i, row in islice(it, n)]
+
+    if len(sample) < n:
+        return sample
+
+    w = exp(log(_uniform(rand)) / n)
+
+    while True:
+        skip = floor(log(_uniform(rand)) / log(1 - w)) if w < 1 else 0
+
+        e = next(islice(it, skip, None), None)
+
+        if e is None:
+            break
+
+        sample[rand.randrange(n)] = (e[0], list(e[1]))
+
+        w *= exp(log(_uniform(rand)) / n)
+
+    return sorted(sample, key=itemgetter(0))
+
+
+def stratified_sample(rows, n, key, rand):
+    """Select up to n rows for each value of a key, each with equal probability within its stratum
+
+    :param rows: Iterable of rows
+    :param n: Number of rows to select for each value of the key
+    :param key: Function that returns the stratum of a row
+    :param rand: A random.Random
+    :return: List of (row number, row) tuples, in order of row number
+    """
+
+    if n <= 0:
+        return []
+
+    samples = {}
+    counts = {}
+
+    for i, row in enumerate(rows):
+        k = key(row)
+
+        c = counts.get(k, 0)
+        counts[k] = c + 1
+
+        if c < n:
+            samples.setdefault(k, []).append((i, list(row)))
+        else:
+            j = rand.randint(0, c)
+            if j < n:
+                samples[k][j] = (i, list(row))
+
+    return sorted((e for s in samples.values() for e in s), key=itemgetter(0))
@@ -0,0 +1,169 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Sidecar files for Excel workbooks.
+
+Parsing a workbook is slow, so the first time any sheet of a workbook is read, all of its sheets are
+converted to JSON lines files in the download cache, in a directory named for the hash of the workbook.
+Later reads of any sheet, in any process, read the sidecar instead. The JSON values have the same types,
+string, float and int, that xlrd returns for cells.
+"""
+
+import json
+from hashlib import sha1
+from os import stat, rename, makedirs
+from os.path import join, exists
+from shutil import rmtree
+from threading import Lock
+from uuid import uuid4
+
+SIDECAR_DIR = '_xlsx'
+
+MANIFEST = 'manifest.json'
+
+_hashes = {}
+
+_lock = Lock()
+
+
+def workbook_hash(path):
+    """Return the SHA1 of a workbook file, memoized on the path, size and modification time"""
+
+    st = stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+
+    h = _hashes.get(key)
+
+    if h is None:
+        s = sha1()
+
+        with open(path, 'rb') as f:
+            for b in iter(lambda: f.read(1024 * 1024), b''):
+                s.update(b)
+
+        h = _hashes[key] = s.hexdigest()
+
+    return h
+
+
+class ExcelSidecar(object):
+    """The JSON lines sidecar files for the sheets of an Excel workbook"""
+
+    def __init__(self, path, cache):
+        """
+        :param path: Path to the workbook
+        :param cache: Pyfilesystem cache in which to store the sidecars
+        """
+        self.path = path
+        self.cache = cache
+        self.hash = workbook_hash(path)
+        self.dir = cache.getsyspath(join(SIDECAR_DIR, self.hash))
+        self._manifest = None
+
+    @property
+    def manifest(self):
+
+        if self._manifest is None:
+
+            if not exists(join(self.dir, MANIFEST)):
+                self.convert()
+
+            with open(join(self.dir, MANIFEST)) as f:
+                self._manifest = json.load(f)
+
+        return self._manifest
+
+    def _valid_manifest(self):
+        """Return True if the sidecar directory has a readable manifest, and a file for each sheet"""
+        try:
+            with open(join(self.dir, MANIFEST)) as f:
+                sheets = json.load(f)['sheets']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        return all(exists(join(self.dir, '{}.jsonl'.format(i))) for i in range(len(sheets)))
+
+    def convert(self):
+        """Convert all of the sheets in the workbook to sidecar files"""
+        from xlrd import open_workbook
+
+        with _lock:
+            if exists(join(self.dir, MANIFEST)):
+                return
+
+            tmp_dir = self.dir + '.' + str(uuid4())
+            makedirs(tmp_dir)
+
+            try:
+                wb = open_workbook(filename=self.path)
+
+                sheets = []
+
+                for i, s in enumerate(wb.sheets()):
+                    with open(join(tmp_dir, '{}.jsonl'.format(i)), 'w') as f:
+                        for row_num in range(s.nrows):
+                            f.write(json.dumps(s.row_values(row_num)))
+                            f.write('\n')
+
+                    sheets.append(s.name)
+
+                with open(join(tmp_dir, MANIFEST), 'w') as f:
+                    json.dump({'path': self.path, 'sheets': sheets, 'datemode': wb.datemode}, f)
+
+                try:
+                    rename(tmp_dir, self.dir)
+                except OSError:
+                    if self._valid_manifest():
+                        return  # Another process converted the workbook first
+
+                    # A partial or evicted sidecar is in the way, so replace it
+                    rmtree(self.dir, ignore_errors=True)
+                    rename(tmp_dir, self.dir)
+
+            finally:
+                if exists(tmp_dir):
+                    rmtree(tmp_dir, ignore_errors=True)
+
+    @property
+    def sheet_names(self):
+        return self.manifest['sheets']
+
+    def sheet_path(self, sheet):
+        """Return the path to the sidecar for a sheet, given by name or by number"""
+
+        names = self.sheet_names
+
+        # Same order as ExcelSource: a number is a sheet index, otherwise it is a sheet name
+        if sheet is None or sheet == '':
+            i = 0
+        else:
+            try:
+                i = int(sheet)
+            except ValueError:
+                if sheet not in names:
+                    raise KeyError("No sheet named '{}' in workbook '{}'".format(sheet, self.path))
+                i = names.index(sheet)
+            else:
+                if not 0 <= i < len(names):
+                    raise KeyError("No sheet number {} in workbook '{}'".format(i, self.path))
+
+        return join(self.dir, '{}.jsonl'.format(i))
+
+    def rows(self, sheet=None):
+        """Yield the rows of a sheet, as lists"""
+        from metapack.cache import touch
+
+        path = self.sheet_path(sheet)
+
+        if not exists(path):
+            # Part of the sidecar was evicted from the cache, so rebuild it
+            rmtree(self.dir, ignore_errors=True)
+            self._manifest = None
+            path = self.sheet_path(sheet)
+
+        touch(path)
+
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)
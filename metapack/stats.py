@@ -0,0 +1,221 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Streaming column statistics for resources. Statistics are computed in one pass over the rows, in
+memory that does not grow with the number of rows: distinct counts are estimated with a HyperLogLog
+sketch, and the most common values with the Misra-Gries heavy hitters algorithm.
+"""
+
+from collections import OrderedDict
+from math import sqrt
+
+_MASK64 = (1 << 64) - 1
+
+# Properties that write_schema_stats() sets on Schema columns
+STAT_PROPERTIES = ('nulls', 'distinct', 'min', 'max', 'mean', 'std')
+
+
+def _hash64(v):
+    """A well mixed 64 bit hash, from the splitmix64 finalizer applied to Python's hash"""
+
+    x = hash(v) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values. The count is exact until there are more than
+    exact_limit distinct values"""
+
+    def __init__(self, p=12, exact_limit=1000):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+        self.exact_limit = exact_limit
+        self.exact = set()
+
+    def add(self, v):
+
+        x = _hash64(v)
+
+        if self.exact is not None:
+            self.exact.add(x)
+            if len(self.exact) > self.exact_limit:
+                self.exact = None
+
+        i = x >> (64 - self.p)
+        w = (x << self.p) & _MASK64
+
+        rank = (64 - self.p + 1) if w == 0 else (65 - w.bit_length())
+
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def __len__(self):
+
+        if self.exact is not None:
+            return len(self.exact)
+
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+
+        e = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        zeros = self.registers.count(0)
+
+        if e <= 2.5 * m and zeros:
+            from math import log
+            e = m * log(m / zeros)  # Linear counting, for small cardinalities
+
+        return int(round(e))
+
+
+class HeavyHitters(object):
+    """Find the most common values with the Misra-Gries algorithm. Counts are lower bounds,
+    which may be low by at most n/k for n values"""
+
+    def __init__(self, k=100):
+        self.k = k
+        self.counters = {}
+
+    def add(self, v):
+        c = self.counters
+
+        if v in c:
+            c[v] += 1
+        elif len(c) < self.k:
+            c[v] = 1
+        else:
+            for key in list(c):
+                c[key] -= 1
+                if c[key] == 0:
+                    del c[key]
+
+    def top(self, n=5):
+        return sorted(self.counters.items(), key=lambda e: (-e[1], str(e[0])))[:n]
+
+
+class ColumnStats(object):
+    """Statistics for one column"""
+
+    def __init__(self, name, k=100):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.n = 0  # Number of numeric values
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.distinct = HyperLogLog()
+        self.hitters = HeavyHitters(k)
+
+    def add(self, v):
+
+        self.count += 1
+
+        if v is None or v == '':
+            self.nulls += 1
+            return
+
+        try:
+            if self.min is None or v < self.min:
+                self.min = v
+            if self.max is None or v > self.max:
+                self.max = v
+        except TypeError:
+            pass  # Not comparable to earlier values
+
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            # Welford's algorithm
+            self.n += 1
+            d = v - self.mean
+            self.mean += d / self.n
+            self._m2 += d * (v - self.mean)
+
+        try:
+            self.distinct.add(v)
+            self.hitters.add(v)
+        except TypeError:  # Unhashable
+            v = str(v)
+            self.distinct.add(v)
+            self.hitters.add(v)
+
+    @property
+    def std(self):
+        return sqrt(self._m2 / (self.n - 1)) if self.n > 1 else None
+
+    def dict(self, top=5):
+        return OrderedDict([
+            ('name', self.name),
+            ('count', self.count),
+            ('nulls', self.nulls),
+            ('distinct', len(self.distinct)),
+            ('min', self.min),
+            ('max', self.max),
+            ('mean', self.mean if self.n else None),
+            ('std', self.std),
+            ('top', self.hitters.top(top)),
+        ])
+
+
+def profile(rows, k=100):
+    """Compute statistics for each column of an iterator of rows, with the header first.
+    Returns a list of ColumnStats"""
+
+    rows = iter(rows)
+
+    headers = next(rows, None)
+
+    if headers is None:
+        return []
+
+    stats = [ColumnStats(h, k) for h in headers]
+
+    adders = [s.add for s in stats]
+
+    for row in rows:
+        for add, v in zip(adders, row):
+            add(v)
+
+    return stats
+
+
+def write_schema_stats(resource, stats):
+    """Set the STAT_PROPERTIES on the Schema columns of a resource. Returns the number
+    of columns that were updated"""
+
+    t = resource.schema_term
+
+    if not t:
+        return 0
+
+    by_name = {s.name: s.dict() for s in stats}
+
+    section = t.section
+
+    for p in STAT_PROPERTIES:
+        if section is not None and p not in [str(a).lower() for a in section.args]:
+            section.args.append(p)
+
+    n = 0
+
+    for i, c in enumerate(t.children, 1):
+
+        if not c.term_is('Table.Column'):
+            continue
+
+        d = by_name.get(resource._name_for_col_term(c, i))
+
+        if d is None:
+            continue
+
+        for p in STAT_PROPERTIES:
+            v = d[p]
+            c[p] = None if v is None else str(round(v, 6) if isinstance(v, float) else v)
+
+        n += 1
+
+    return n
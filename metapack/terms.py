@@ -1,10 +1,11 @@
 from itertools import islice
+from operator import itemgetter
 
-from appurl import parse_app_url, WebUrl
+from appurl import WebUrl
 from metapack import MetapackError
 from metapack.doc import EMPTY_SOURCE_HEADER
 from metapack.exc import MetapackError, ResourceError
-from metapack.appurl import MetapackPackageUrl
+from metapack.appurl import MetapackPackageUrl, parse_app_url, url_parts
 from metatab import Term
 from rowgenerators import DownloadError, get_generator
 from rowpipe import RowProcessor
@@ -73,23 +74,61 @@ class Resource(Term):
         """Return a URL that properly combines the base_url and a possibly relative
         resource url"""
 
+        from metapack.package.core import Downloader
+
         if not self.url:
             return None
 
-        u = parse_app_url(self.url)
+        lockfile = Downloader.lockfile
+
+        if lockfile is None:
+            return self._resolve_url()
+
+        lock_key = '{} {}'.format(self.doc.package_url, self.url)
+
+        if Downloader.offline:
+            t = self._locked_url(lockfile.resolved(lock_key))
+            if t is not None:
+                return t
+
+        t = self._resolve_url()
+
+        if not Downloader.offline and t is not None:
+            lockfile.record_resource(lock_key, str(t))
+
+        return t
+
+    def _locked_url(self, s):
+        """Return a URL recorded in a lockfile, or None if it refers to a local file that no longer exists"""
+        from os.path import exists
+
+        if not s:
+            return None
+
+        t = parse_app_url(s, downloader=self.doc.downloader)
+
+        if t.scheme == 'file' and not exists(t.path):
+            return None
+
+        return t
+
+    def _resolve_url(self):
+
+        u = url_parts(self.url)
 
         if u.scheme != 'file':
-            # Hopefully means the URL is http, https, ftp, etc.
-            return u
+            # Hopefully means the URL is http, https, ftp, etc. Use the document's downloader, so
+            # the download goes through the cache, the lockfile and offline mode
+            return parse_app_url(self.url, downloader=self.doc.downloader)
         elif u.resource_format == 'ipynb':
 
             # This shouldn't be a special case, but ...
             t = self.doc.package_url.inner.join_dir(self.url)
-            t = t.as_type(type(u))
-            t.fragment = u.fragment
+            t = t.as_type(type(parse_app_url(self.url)))
+            t.fragment = list(u.fragment) if u.fragment is not None else None
 
         elif u.proto == 'metapack':
-            return u.resource.resolved_url.get_resource().get_target()
+            return parse_app_url(self.url).resource.resolved_url.get_resource().get_target()
 
         else:
             assert isinstance(self.doc.package_url, MetapackPackageUrl), (
@@ -99,11 +138,11 @@ class Resource(Term):
                 t = self.doc.package_url.resolve_url(self.url)
 
                 # Also a hack
-                t.scheme_extension = parse_app_url(self.url).scheme_extension
+                t.scheme_extension = u.scheme_extension
 
                 # Another Hack!
                 if not t.fragment and u.fragment:
-                    t.fragment = u.fragment
+                    t.fragment = list(u.fragment)
 
                 # Yet more hack!
                 t = parse_app_url(str(t))
@@ -265,6 +304,11 @@ class Resource(Term):
 
         self.doc.set_sys_path()  # Set sys path to package 'lib' dir in case of python function generator
 
+        g = self._zip_member_generator()
+
+        if g is not None:
+            return g
+
         ru = self.resolved_url
 
         try:
@@ -277,23 +321,56 @@ class Resource(Term):
         ut = ru.get_resource().get_target()
 
         # Encoding is supposed to be preserved in the URL but isn't
-        source_url = parse_app_url(self.url)
-
-        ut.encoding = source_url.encoding or self.get_value('encoding')
+        ut.encoding = url_parts(self.url).encoding or self.get_value('encoding')
 
         table = self.row_processor_table()
 
-        g = get_generator(ut, table=table, resource=self,
-                          doc=self._doc, working_dir=self._doc.doc_dir,
-                          env=self.env)
+        kwargs = dict(table=table, resource=self, doc=self._doc, working_dir=self._doc.doc_dir, env=self.env)
+
+        if getattr(ut, 'target_format', None) == 'xlsx':
+            # Read Excel resources through the sidecar cache. It isn't registered as a rowgenerators
+            # entry point, so it does not change how other programs read workbooks
+            from metapack.rowgenerator import ExcelSidecarSource
+            g = ExcelSidecarSource(ut, cache=self._doc.cache, **kwargs)
+        else:
+            g = get_generator(ut, **kwargs)
 
         assert g, ut
 
         return g
 
-    def _get_header(self):
+    def _zip_member_generator(self):
+        """For CSV files in ZIP packages, return a generator that streams the file from the archive,
+        or None if the resource is not a CSV file in a ZIP package"""
+        from appurl.util import file_ext
+        from metapack.ziparchive import ZipArchive
+        from metapack.rowgenerator import ZipMemberSource
+
+        pu = self.doc.package_url
+
+        if not isinstance(pu, MetapackPackageUrl) or file_ext(pu.path) != 'zip':
+            return None
+
+        u = url_parts(self.url)
+
+        if u.scheme != 'file' or u.proto == 'metapack' or u.target_format != 'csv':
+            return None
+
+        archive_url = pu.path if pu.scheme == 'file' else str(pu.inner.clear_fragment())
+
+        try:
+            archive = ZipArchive(archive_url, downloader=self.doc.downloader)
+            member = archive.find(u.path)
+        except Exception:
+            return None  # Fall back to extracting the file
+
+        return ZipMemberSource(u.url, archive, member, encoding=u.encoding or self.get_value('encoding'),
+                               cache=self.doc.cache)
+
+    def _get_header(self, head=None):
         """Get the header from the deinfed header rows, for use  on references or resources where the schema
-        has not been run"""
+        has not been run. head is an optional list of the first rows of the data file, to use instead of
+        reading them from the row generator"""
 
         try:
             header_lines = [int(e) for e in str(self.get_value('headerlines', 0)).split(',')]
@@ -301,25 +378,34 @@ class Resource(Term):
             header_lines = [0]
 
         # We're processing the raw datafile, with no schema.
-        header_rows = islice(self.row_generator, min(header_lines), max(header_lines) + 1)
+        if head is None:
+            header_rows = islice(self.row_generator, min(header_lines), max(header_lines) + 1)
+        else:
+            header_rows = head[min(header_lines):max(header_lines) + 1]
 
         from tableintuit import RowIntuiter
         headers = RowIntuiter.coalesce_headers(header_rows)
 
         return headers
 
+    @property
+    def _startline(self):
+        """The row number of the first data row in the data file"""
+
+        # There are several args for SelectiveRowGenerator, but only
+        # start is really important.
+        try:
+            return int(self.get_value('startline', 1))
+        except ValueError as e:
+            return 1
+
     def __iter__(self):
         """Iterate over the resource's rows"""
         from copy import copy
 
         headers = self.headers
 
-        # There are several args for SelectiveRowGenerator, but only
-        # start is really important.
-        try:
-            start = int(self.get_value('startline', 1))
-        except ValueError as e:
-            start = 1
+        start = self._startline
 
         if headers:  # There are headers, so use them, and create a RowProcess to set data types
             yield headers
@@ -349,6 +435,222 @@ class Resource(Term):
         except AttributeError:
             self.errors = {}
 
+    def _local_csv_path(self):
+        """The path to the resource's data file, if it is a local CSV file that can be seeked, or None"""
+        from appurl.util import file_ext
+
+        pu = self.doc.package_url
+
+        if isinstance(pu, MetapackPackageUrl) and file_ext(pu.path) == 'zip':
+            return None  # Members of ZIP archives can't be seeked
+
+        u = url_parts(self.url)
+
+        if u.proto == 'metapack' or u.target_format != 'csv':
+            return None
+
+        if self._startline != 1:
+            return None
+
+        try:
+            t = self.resolved_url.get_resource().get_target()
+        except Exception:
+            return None
+
+        if t.proto != 'file':
+            return None
+
+        return t.path
+
+    @property
+    def _data_encoding(self):
+        return url_parts(self.url).encoding or self.get_value('encoding') or 'utf-8'
+
+    @property
+    def row_index(self):
+        """The row offset index for the resource's data file, or None if the resource is not a local
+        CSV file with a current index, such as the files written by FileSystemPackageBuilder"""
+        from metapack.rowindex import RowIndex
+
+        path = self._local_csv_path()
+
+        return RowIndex.load(path) if path else None
+
+    def _process_rows(self, rows):
+        """Cast raw data rows from the data file, as __iter__ does"""
+
+        if not self.headers:
+            return rows
+
+        return RowProcessor(rows,
+                            self.row_processor_table(),
+                            source_headers=self.source_headers,
+                            env=self.env,
+                            code_path=self.code_path)
+
+    def rows(self, start=0, stop=None):
+        """Yield the data rows from start to stop, without the header. Uses the row index, if there
+        is one, to start reading at the nearest indexed row, rather than reading all of the preceding rows"""
+
+        index = self.row_index
+
+        if index is None:
+            yield from islice(self, start + 1, stop + 1 if stop is not None else None)
+            return
+
+        rg = self._process_rows(index.read(start, stop, encoding=self._data_encoding))
+
+        yield from rg
+
+        self.errors = getattr(rg, 'errors', None) or {}
+
+    def seek(self, row):
+        """Return an iterator of the data rows starting at a row number"""
+
+        return self.rows(row)
+
+    def sample(self, n, seed=None, by=None):
+        """Return a list of randomly selected data rows, in file order, without reading the whole
+        resource into memory.
+
+        :param n: Number of rows to select, or with by, the number of rows for each value of the column
+        :param seed: Seed for the random number generator, for repeatable samples
+        :param by: Name of a column to stratify the sample by
+
+        Without by, a resource with a row index reads only the selected rows, and a resource without one
+        is sampled in one pass over the uncast rows of the data file; in both cases, only the selected rows
+        are cast. With by, the strata are the cast values of the column, so every row is cast.
+        """
+        import random
+        from metapack.sampling import reservoir_sample, stratified_sample
+
+        rand = random.Random(seed)
+
+        if by is not None:
+            rows = iter(self)
+
+            headers = list(next(rows, None) or [])
+
+            try:
+                i = headers.index(by)
+            except ValueError:
+                raise MetapackError("Unknown column '{}'; columns are {}".format(by, headers))
+
+            return [row for _, row in stratified_sample(rows, n, itemgetter(i), rand)]
+
+        if not self.headers:
+            return [row for _, row in reservoir_sample(islice(self, 1, None), n, rand)]
+
+        index = self.row_index
+
+        if index is not None:
+            numbers = rand.sample(range(index.nrows), min(max(n, 0), index.nrows))
+
+            raw = (row for _, row in index.read_rows(numbers, encoding=self._data_encoding))
+
+        else:
+            raw = (row for _, row in reservoir_sample(islice(self.row_generator, self._startline, None),
+                                                      n, rand))
+
+        return list(self._process_rows(raw))
+
+    def build_index(self, column):
+        """Build a persistent key index for a column, next to the data file, so lookup() and lookup_many()
+        read only the matching rows. Returns the path to the index"""
+        from metapack.keyindex import build_key_index
+
+        path = self._local_csv_path()
+
+        if path is None:
+            raise ResourceError("Can't index resource '{}'; only local CSV files, such as the data files of "
+                                "filesystem packages, can be indexed".format(self.name))
+
+        return build_key_index(path, column, encoding=self._data_encoding)
+
+    def _lookup_column(self, column, path):
+        """The column to look up keys in: the given column, or the one column with an Index property
+        in the schema, or the one column with a key index"""
+        from metapack.keyindex import schema_index_columns, indexed_columns
+
+        if column is not None:
+            return column
+
+        columns = schema_index_columns(self.columns()) or (indexed_columns(path) if path else [])
+
+        if len(columns) != 1:
+            raise MetapackError("Specify the column to look up keys in for resource '{}'; indexed columns are {}"
+                                .format(self.name, columns))
+
+        return columns[0]
+
+    def lookup(self, key, column=None):
+        """Return the list of data rows with a key in a column. See lookup_many()"""
+
+        return self.lookup_many([key], column)[key]
+
+    def lookup_many(self, keys, column=None):
+        """Return an OrderedDict that maps each key to the list of data rows that have the key in a column.
+
+        Keys are compared to the text of the values in the data file, so 6073 does not match '06073', and
+        only the matching rows are cast. With a key index from build_index(), only the matching rows are
+        read; without one, the uncast rows of the data file are scanned.
+
+        :param keys: Iterable of keys
+        :param column: Column to look up keys in. Defaults to the indexed column, if there is only one.
+        """
+        from collections import OrderedDict, defaultdict
+        from metapack.keyindex import KeyIndex
+
+        keys = list(OrderedDict.fromkeys(keys))
+
+        results = OrderedDict((k, []) for k in keys)
+
+        path = self._local_csv_path()
+
+        column = self._lookup_column(column, path)
+
+        index = KeyIndex.load(path, column) if path else None
+
+        if index is None:
+            rows = iter(self.row_generator)
+
+            headers = list(self._get_header(list(islice(rows, self._startline))) or [])
+
+            try:
+                i = headers.index(column)
+            except ValueError:
+                raise MetapackError("Unknown column '{}'; columns are {}".format(column, headers))
+
+            by_text = defaultdict(list)
+
+            for k in keys:
+                by_text[str(k)].append(k)
+
+            # Match on the text of the values, as the key index does, and cast only the matching rows
+            matches = [(by_text[str(row[i])], row) for row in rows
+                       if row and i < len(row) and str(row[i]) in by_text]
+
+            for (row_keys, _), row in zip(matches, self._process_rows(row for _, row in matches)):
+                for k in row_keys:
+                    results[k].append(row)
+
+            return results
+
+        with index:
+            offset_keys = defaultdict(list)
+
+            for k in keys:
+                for o in index.offsets(k):
+                    offset_keys[o].append(k)
+
+            raw = (row for _, row in index.read(offset_keys, encoding=self._data_encoding))
+
+            for o, row in zip(sorted(offset_keys), self._process_rows(raw)):
+                for k in offset_keys[o]:
+                    results[k].append(row)
+
+        return results
+
     @property
     def iterdict(self):
         """Iterate over the resource in dict records"""
@@ -386,25 +688,37 @@ class Resource(Term):
     @property
     def iterstruct(self):
         """Yield structures build from the JSON header specifications"""
-        from rowpipe.json import add_to_struct
+        from metapack.jsonstruct import compile_struct_builder
 
         json_headers = [(c['pos'], c.get('json') or c['header']) for c in self.columns()]
 
+        build = compile_struct_builder(json_headers)
+
         for row in self:
-            d = {}
-            for pos, jh in json_headers:
-                add_to_struct(d, jh, row[pos])
-            yield d
+            yield build(row)
 
     def iterjson(self, *args, **kwargs):
-        from rowpipe.json import VTEncoder
-        import json
+        """Yield a JSON string for each structure from iterstruct. With no arguments, uses one
+        encoder from metapack.jsonstruct.make_encoder() for all rows; otherwise, the arguments are
+        passed to json.dumps()"""
+
+        if args or kwargs:
+            from rowpipe.json import VTEncoder
+            import json
 
-        if 'cls' not in kwargs:
-            kwargs['cls'] = VTEncoder
+            if 'cls' not in kwargs:
+                kwargs['cls'] = VTEncoder
 
-        for s in self.iterstruct:
-            yield (json.dumps(s, *args, **kwargs))
+            for s in self.iterstruct:
+                yield (json.dumps(s, *args, **kwargs))
+
+        else:
+            from metapack.jsonstruct import make_encoder
+
+            encode = make_encoder()
+
+            for s in self.iterstruct:
+                yield encode(s)
 
     def dataframe(self, limit=None):
         """Return a pandas datafrome from the resource"""
@@ -513,6 +827,20 @@ class Reference(Resource):
         e['reference'] = self
         return e
 
+    def _local_csv_path(self):
+        """References are iterated without a schema, so they don't use row or key indexes"""
+        return None
+
+    def sample(self, n, seed=None, by=None):
+        """Return a list of randomly selected rows, as Resource.sample() does, in one pass over the reference"""
+        import random
+        from metapack.sampling import reservoir_sample
+
+        if by is not None:
+            return super().sample(n, seed, by)
+
+        return [row for _, row in reservoir_sample(islice(self, 1, None), n, random.Random(seed))]
+
     def __iter__(self):
         """Iterate over the resource's rows"""
         from copy import copy
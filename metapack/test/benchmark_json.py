@@ -0,0 +1,147 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Benchmark building JSON structures from rows and encoding them, as Resource.iterjson does, comparing
+the original per-column add_to_struct() and json.dumps() path with the compiled struct builder and the
+shared encoders from metapack.jsonstruct.
+
+Run the benchmark with:
+
+    python -m metapack.test.benchmark_json --rows 200000 --columns 20
+
+Each scenario reports rows per second for flat paths, where every column is a top-level key, and for
+nested paths, with objects and arrays.
+
+"""
+
+import random
+import time
+from datetime import date
+
+
+def make_rows(n_rows, n_cols):
+    rows = []
+
+    for i in range(n_rows):
+        row = []
+        for j in range(n_cols):
+            k = j % 4
+            if k == 0:
+                row.append(i)
+            elif k == 1:
+                row.append(random.random())
+            elif k == 2:
+                row.append('value-{}'.format(random.randint(0, 1000)))
+            else:
+                row.append(date(2017, 1 + i % 12, 1 + i % 28))
+        rows.append(row)
+
+    return rows
+
+
+def flat_headers(n_cols):
+    return [(j, 'col_{}'.format(j)) for j in range(n_cols)]
+
+
+def nested_headers(n_cols):
+    """Paths with objects, new array items and last array items"""
+
+    headers = []
+
+    for j in range(n_cols):
+        k = j % 4
+        if k == 0:
+            headers.append((j, 'id_{}'.format(j)))
+        elif k == 1:
+            headers.append((j, 'geo.g{}.value'.format(j)))
+        elif k == 2:
+            headers.append((j, 'items[].name'))
+        else:
+            headers.append((j, 'items[-].date'))
+
+    return headers
+
+
+def original(rows, json_headers):
+    import json
+    from rowpipe.json import add_to_struct, VTEncoder
+
+    for row in rows:
+        d = {}
+        for pos, jh in json_headers:
+            add_to_struct(d, jh, row[pos])
+        json.dumps(d, cls=VTEncoder)
+
+
+def compiled(backend):
+    def f(rows, json_headers):
+        from metapack.jsonstruct import compile_struct_builder, make_encoder
+
+        build = compile_struct_builder(json_headers)
+        encode = make_encoder(backend)
+
+        for row in rows:
+            encode(build(row))
+
+    return f
+
+
+def measure(name, f, rows, json_headers):
+    t = time.perf_counter()
+    f(rows, json_headers)
+    elapsed = time.perf_counter() - t
+
+    return {'scenario': name, 'rows': len(rows), 'seconds': round(elapsed, 3),
+            'rows_per_sec': int(len(rows) / elapsed)}
+
+
+def run_benchmark(n_rows, n_cols):
+
+    rows = make_rows(n_rows, n_cols)
+
+    scenarios = [('original', original), ('compiled-json', compiled('json'))]
+
+    try:
+        import orjson
+        scenarios.append(('compiled-orjson', compiled('orjson')))
+    except ImportError:
+        pass
+
+    results = []
+
+    for paths, headers in (('flat', flat_headers(n_cols)), ('nested', nested_headers(n_cols))):
+        for name, f in scenarios:
+            r = measure(name, f, rows, headers)
+            r['paths'] = paths
+            results.append(r)
+
+    return results
+
+
+def main():
+    import argparse
+    import json
+    from tabulate import tabulate
+
+    parser = argparse.ArgumentParser(
+        prog='benchmark_json',
+        description='Benchmark building and encoding JSON structures from rows')
+
+    parser.add_argument('-n', '--rows', type=int, default=100000, help='Number of rows')
+    parser.add_argument('-c', '--columns', type=int, default=20, help='Number of columns')
+    parser.add_argument('-j', '--json', default=False, action='store_true', help='Output JSON')
+
+    args = parser.parse_args()
+
+    results = run_benchmark(args.rows, args.columns)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        header = 'paths scenario rows seconds rows_per_sec'.split()
+        print(tabulate([[r[h] for h in header] for r in results], header))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Benchmark publishing to S3 against a local, in-process S3 stand-in, so that upload performance
+can be measured without an AWS account. The stand-in is provided by the moto package, which must
+be installed separately.
+
+Run the benchmark with:
+
+    python -m metapack.test.benchmark_s3 --files 200 --size 50000
+
+Each scenario reports the number of S3 requests, by operation, the bytes sent and received,
+wall time and peak Python memory allocation.
+
+"""
+
+import os
+import random
+import string
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from os.path import join, dirname, getsize
+from os import makedirs, walk
+
+BENCH_BUCKET = 'metapack-bench'
+
+
+@contextmanager
+def local_s3():
+    """Start an in-process S3 stand-in and create the benchmark bucket"""
+    import boto3
+    from metapack.package.s3 import clear_s3_clients
+
+    try:
+        from moto import mock_aws as mock_s3  # moto >= 5
+    except ImportError:
+        from moto import mock_s3
+
+    # The stand-in doesn't check credentials, but botocore wants to find some.
+    for k, v in (('AWS_ACCESS_KEY_ID', 'bench'), ('AWS_SECRET_ACCESS_KEY', 'bench'),
+                 ('AWS_DEFAULT_REGION', 'us-east-1')):
+        os.environ.setdefault(k, v)
+
+    # Shared clients created outside of the mock would talk to the real S3
+    clear_s3_clients()
+
+    try:
+        with mock_s3():
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BENCH_BUCKET)
+            yield
+    finally:
+        clear_s3_clients()
+
+
+class RequestCounter(object):
+    """Count S3 API calls and bytes transferred, using botocore's event hooks"""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def attach(self, client):
+        client.meta.events.register('before-call.s3', self.before_call)
+        client.meta.events.register('after-call.s3', self.after_call)
+        return self
+
+    def detach(self, client):
+        client.meta.events.unregister('before-call.s3', self.before_call)
+        client.meta.events.unregister('after-call.s3', self.after_call)
+
+    def before_call(self, model, params, **kwargs):
+
+        self.requests[model.name] += 1
+
+        body = params.get('body')
+
+        if isinstance(body, (bytes, bytearray, str)):
+            self.bytes_sent += len(body)
+        elif hasattr(body, 'seek'):
+            pos = body.tell()
+            body.seek(0, 2)
+            self.bytes_sent += body.tell() - pos
+            body.seek(pos)
+
+    def after_call(self, parsed, **kwargs):
+        try:
+            self.bytes_received += int(parsed['ResponseMetadata']['HTTPHeaders'].get('content-length', 0))
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    def reset(self):
+        self.requests.clear()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+def _random_rows(rnd, size):
+    """Generate CSV text of approximately size bytes"""
+
+    lines = ['id,name,value']
+    n = len(lines[0])
+    i = 0
+
+    while n < size:
+        line = '{},{},{}'.format(i, ''.join(rnd.choice(string.ascii_letters) for _ in range(12)),
+                                 rnd.random())
+        lines.append(line)
+        n += len(line) + 1
+        i += 1
+
+    return '\n'.join(lines) + '\n'
+
+
+def make_synthetic_package(base_dir, files=10, size=10000, seed=0):
+    """Write a filesystem package with files data files of approximately size bytes each.
+    Returns the path to the metadata file """
+
+    rnd = random.Random(seed)
+
+    makedirs(join(base_dir, 'data'), exist_ok=True)
+
+    meta = [
+        'Declare,metatab-latest',
+        'Identifier,{}'.format(seed),
+        'Name,example.com-benchmark-{}'.format(seed),
+        'Title,Synthetic benchmark package',
+        'Section,Resources,Name',
+    ]
+
+    for i in range(files):
+        name = 'file_{}'.format(i)
+        with open(join(base_dir, 'data', name + '.csv'), 'w') as f:
+            f.write(_random_rows(rnd, size))
+
+        meta.append('Datafile,data/{}.csv,{}'.format(name, name))
+
+    meta.append('Section,Schema,DataType')
+
+    for i in range(files):
+        meta.extend(['Table,file_{}'.format(i), 'Table.Column,id,integer',
+                     'Table.Column,name,string', 'Table.Column,value,number'])
+
+    path = join(base_dir, 'metadata.csv')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(meta) + '\n')
+
+    return path
+
+
+def change_files(base_dir, fraction, seed=1):
+    """Rewrite a fraction of the data files in a synthetic package with new content"""
+    rnd = random.Random(seed)
+
+    data_dir = join(base_dir, 'data')
+    names = sorted(os.listdir(data_dir))
+
+    for name in names[:max(1, int(len(names) * fraction))]:
+        path = join(data_dir, name)
+        size = getsize(path)
+        with open(path, 'w') as f:
+            f.write(_random_rows(rnd, size))
+
+
+def write_files(bucket, base_dir):
+    """Write all of the files in the package directory with S3Bucket.write, as
+    S3PackageBuilder.save() and metas3.upload() do. """
+
+    for root, dirs, files in walk(base_dir):
+        for f in files:
+            source = join(root, f)
+            rel = source.replace(base_dir, '').strip('/')
+
+            with open(source, 'rb') as flo:
+                bucket.write(flo.read(), rel)
+
+
+def save_package(metadata_path, prefix):
+    """Publish the package with S3PackageBuilder.save()"""
+    from metapack import MetapackUrl, MetapackPackageUrl, Downloader
+    from metapack.package.s3 import S3PackageBuilder
+
+    downloader = Downloader()
+
+    u = MetapackUrl(metadata_path, downloader=downloader)
+    package_root = MetapackPackageUrl('s3://{}/{}'.format(BENCH_BUCKET, prefix), downloader=downloader)
+
+    p = S3PackageBuilder(u, package_root)
+    p.save()
+
+    return p
+
+
+def measure(name, counter, f, *args, **kwargs):
+
+    counter.reset()
+
+    tracemalloc.start()
+    t = time.perf_counter()
+
+    f(*args, **kwargs)
+
+    wall = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'requests': sum(counter.requests.values()),
+        'by_operation': dict(counter.requests),
+        'bytes_sent': counter.bytes_sent,
+        'bytes_received': counter.bytes_received,
+        'wall_time': round(wall, 4),
+        'peak_memory': peak
+    }
+
+
+def run_benchmark(files=10, size=10000, change_fraction=0.1, package=False, work_dir=None):
+    """Run the publish, republish-unchanged and partial-change scenarios, and return a list
+    of result dicts"""
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from appurl import parse_app_url
+    from metapack.package.s3 import S3Bucket
+
+    base_dir = work_dir or mkdtemp(prefix='metapack-bench')
+
+    results = []
+
+    try:
+        make_synthetic_package(base_dir, files, size)
+
+        with local_s3():
+            bucket = S3Bucket(parse_app_url('s3://{}/files'.format(BENCH_BUCKET)), acl='public-read')
+            client = bucket._bucket.meta.client  # The client of this thread's resource
+            counter = RequestCounter().attach(client)
+
+            results.append(measure('publish', counter, write_files, bucket, base_dir))
+            results.append(measure('republish-unchanged', counter, write_files, bucket, base_dir))
+
+            change_files(base_dir, change_fraction)
+            results.append(measure('partial-change', counter, write_files, bucket, base_dir))
+
+            if package:
+                metadata_path = join(base_dir, 'metadata.csv')
+                results.append(measure('package-save', counter, save_package, metadata_path, 'package'))
+
+            counter.detach(client)
+
+    finally:
+        if not work_dir:
+            rmtree(base_dir, ignore_errors=True)
+
+    return results
+
+
+def main():
+    import argparse
+    import json
+    from tabulate import tabulate
+
+    parser = argparse.ArgumentParser(
+        prog='benchmark_s3',
+        description='Benchmark S3 publishing against a local S3 stand-in')
+
+    parser.add_argument('-n', '--files', type=int, default=10, help='Number of data files in the package')
+    parser.add_argument('-s', '--size', type=int, default=10000, help='Approximate size of each data file, in bytes')
+    parser.add_argument('-c', '--change', type=float, default=0.1,
+                        help='Fraction of files to change for the partial-change scenario')
+    parser.add_argument('-p', '--package', default=False, action='store_true',
+                        help='Also benchmark S3PackageBuilder.save()')
+    parser.add_argument('-j', '--json', default=False, action='store_true', help='Output JSON')
+
+    args = parser.parse_args()
+
+    results = run_benchmark(args.files, args.size, args.change, args.package)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        header = 'scenario requests bytes_sent bytes_received wall_time peak_memory'.split()
+        print(tabulate([[r[h] for h in header] for r in results], header))
+
+
+if __name__ == '__main__':
+    main()
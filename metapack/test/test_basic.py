@@ -136,6 +136,689 @@ class TestBasic(unittest.TestCase):
 
         doc._repr_html_() # Check no exceptions
 
+    def test_url_parse_cache(self):
+        from metapack.appurl import parse_app_url, url_parts, _url_class
+
+        s = 'http://example.com/data/file.csv#sheet'
+
+        u1 = parse_app_url(s)
+        hits = _url_class.cache_info().hits
+        u2 = parse_app_url(s)
+
+        self.assertEqual(hits + 1, _url_class.cache_info().hits)
+        self.assertIsNot(u1, u2)  # Url objects are mutable, so each call returns a new one
+        self.assertEqual(type(u1), type(u2))
+        self.assertEqual(str(u1), str(u2))
+
+        p = url_parts(s)
+        self.assertIs(p, url_parts(s))
+        self.assertEqual('http', p.scheme)
+        self.assertEqual('csv', p.resource_format)
+
+        u = MetapackUrl('http://example.com/package#resource', downloader=Downloader())
+        self.assertEqual('/package/metadata.csv', u.path)
+
+    def test_revalidate_policy(self):
+
+        try:
+            Downloader.configure_revalidation([{'pattern': r'census\.gov', 'max_age': 10},
+                                               ('example.com', None)], 100)
+            d = Downloader()
+
+            self.assertEqual(10, d.max_age_for('https://www2.census.gov/data/file.csv'))
+            self.assertIsNone(d.max_age_for('http://example.com/file.csv'))
+            self.assertEqual(100, d.max_age_for('http://library.metatab.org/file.csv'))
+
+        finally:
+            Downloader.configure_revalidation()
+
+        self.assertIsNone(Downloader().max_age_for('https://www2.census.gov/data/file.csv'))
+
+    def test_doc_cache(self):
+        from metapack.doc import DocCache, doc_cache
+        from metapack import MetapackDocumentUrl
+
+        c = DocCache(maxsize=2)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(1, c.get('a'))
+        c.put('c', 3)  # Evicts 'b', the least recently used
+
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(1, c.get('a'))
+        self.assertEqual(3, c.get('c'))
+        self.assertEqual(2, len(c))
+
+        doc_cache.clear()
+
+        u = MetapackDocumentUrl(test_data('packages/example.com/example.com-full-2017-us/metadata.csv'),
+                                downloader=Downloader())
+
+        d1 = u.shared_doc
+        d2 = u.shared_doc
+
+        self.assertIs(d1, d2)
+        self.assertEqual(1, doc_cache.hits)
+        self.assertIsNot(d1, u.doc)
+
+        # Resource URLs also return a private document from doc, and the shared one from shared_doc
+        from metapack import MetapackResourceUrl
+        ru = MetapackResourceUrl(str(u) + '#random-names', downloader=Downloader())
+
+        self.assertIs(ru.shared_doc, ru.shared_doc)
+        self.assertIsNot(ru.shared_doc, ru.doc)
+        self.assertIsNot(ru.doc, ru.doc)
+
+    def test_declaration_registry(self):
+        from metapack.declarations import declarations
+
+        declarations.clear()
+
+        d1 = MetapackDoc(TextRowGenerator("Declare: metatab-latest"))
+        self.assertEqual(1, len(declarations))
+
+        d2 = MetapackDoc(TextRowGenerator("Declare: metatab-latest"))
+        self.assertEqual(1, len(declarations))
+
+        self.assertEqual(sorted(d1.decl_terms.keys()), sorted(d2.decl_terms.keys()))
+        self.assertIn('resources', d2.decl_sections)
+
+        # Sections are copied, so declarations in one document don't change the others
+        self.assertIsNot(d1.decl_sections['resources'], d2.decl_sections['resources'])
+
+    def test_parse_cache(self):
+        from fs.tempfs import TempFS
+        from metapack.doc import _parsed_path
+
+        downloader = Downloader(TempFS())
+
+        path = test_data('packages/example.com/example.com-full-2017-us/metadata.csv')
+
+        d1 = MetapackDoc(path, downloader=downloader)
+
+        pp = _parsed_path(d1._input_ref)
+        self.assertTrue(downloader.cache.exists(pp))
+
+        # The cache holds only the rows of the file, as JSON
+        import json
+        with downloader.cache.open(pp) as f:
+            self.assertEqual(['Declare', 'metatab-latest'], json.load(f)[0][:2])
+
+        d2 = MetapackDoc(path, downloader=downloader)
+
+        self.assertEqual(len(d1.terms), len(d2.terms))
+        self.assertEqual(d1.get_value('Root.Name'), d2.get_value('Root.Name'))
+        self.assertIs(d2, d2.resource('random-names').doc)
+        self.assertEqual(str(d1.resource('random-names').resolved_url),
+                         str(d2.resource('random-names').resolved_url))
+
+        # Documents with Include terms aren't cached, since the key doesn't cover the included files
+        from tempfile import mkdtemp
+        from os.path import join
+        from metapack import MetapackDocumentUrl
+
+        d = mkdtemp()
+
+        with open(join(d, 'metadata.csv'), 'w') as f:
+            f.write('Declare,metatab-latest\nInclude,other.csv\n')
+
+        self.assertIsNone(_parsed_path(MetapackDocumentUrl(join(d, 'metadata.csv'), downloader=downloader)))
+
+    def test_offline_lockfile(self):
+        from fs.tempfs import TempFS
+        from os.path import join
+        from appurl import DownloadError
+        from metapack.lockfile import Lockfile, LockfileError
+
+        d = Downloader(TempFS())
+        url = 'http://example.com/data/file.csv'
+
+        d.cache.makedirs('example.com/data')
+        d.cache.settext('example.com/data/file.csv', 'a,b\n1,2\n')
+
+        lf = Lockfile(join(d.cache.getsyspath('/'), 'metadata.lock'))
+        lf.record_download(url, 'example.com/data/file.csv', d.cache.getsyspath('example.com/data/file.csv'))
+        lf.record_resource('package data/file.csv', url)
+        lf.save()
+
+        lf = Lockfile.load(lf.path)
+        self.assertEqual(url, lf.resolved('package data/file.csv'))
+
+        try:
+            Downloader.configure_lock(lf, offline=True)
+
+            self.assertEqual(('example.com/data/file.csv', None), d._download_with_lock(url))
+
+            with self.assertRaises(DownloadError):
+                d._download_with_lock('http://example.com/data/other.csv')
+
+            # A changed cache file doesn't match the lockfile
+            d.cache.settext('example.com/data/file.csv', 'a,b\n1,3\n')
+            with self.assertRaises(LockfileError):
+                Lockfile.load(lf.path).verify(url, d.cache.getsyspath('example.com/data/file.csv'))
+
+        finally:
+            Downloader.configure_lock()
+
+    def test_remote_urls(self):
+        from metapack.package.core import remote_urls
+
+        doc = MetapackDoc(test_data('packages/example.com/example.com-full-2017-us/metadata.csv'))
+
+        urls = remote_urls(doc)
+
+        self.assertEqual(len(urls), len(set(urls)))
+        self.assertIn('http://public.source.civicknowledge.com/example.com/sources/test_data.zip', urls)
+        self.assertIn('http://library.metatab.org/example.com-simple_example-2017-us-2/metadata.csv', urls)
+        self.assertIn('https://github.com/CivicKnowledge/metatab-py/blob/master/README.rst', urls)
+        self.assertFalse(any(u.startswith(('censusreporter', 'program', 'file')) for u in urls))
+
+    def test_zip_archive(self):
+        from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os.path import join
+        from metapack.ziparchive import ZipArchive
+
+        d = mkdtemp()
+
+        try:
+            data = ''.join('{},{}\n'.format(i, i * 1.5) for i in range(10000))
+
+            path = join(d, 'package.zip')
+
+            with ZipFile(path, 'w') as zf:
+                zf.writestr('package/data/deflated.csv', data, compress_type=ZIP_DEFLATED)
+                zf.writestr('package/data/stored.csv', data, compress_type=ZIP_STORED)
+
+            za = ZipArchive(path)
+
+            self.assertEqual('package/data/stored.csv', za.find('data/stored.csv'))
+            self.assertEqual(data, za.read('data/deflated.csv').decode('utf8'))
+
+            with za.open_text('data/stored.csv') as f:
+                self.assertEqual('1,1.5\n', f.readlines()[1])
+
+        finally:
+            rmtree(d)
+
+    def test_import_time(self):
+        """Importing metapack should not import the Jupyter, HTML or bibliography packages,
+        and should stay within a time budget, in seconds, set by METAPACK_IMPORT_BUDGET"""
+        import subprocess
+        import sys
+        from os import environ
+
+        code = ("import sys, time\n"
+                "t = time.time()\n"
+                "import metapack\n"
+                "print(time.time() - t)\n"
+                "print(' '.join(sys.modules))\n")
+
+        elapsed, modules = subprocess.check_output([sys.executable, '-c', code],
+                                                   universal_newlines=True).splitlines()[-2:]
+
+        modules = modules.split()
+
+        for m in ('IPython', 'nbconvert', 'docopt', 'pybtex', 'markdown', 'nameparser',
+                  'metapack.html', 'metapack.jupyter'):
+            self.assertNotIn(m, modules)
+
+        budget = float(environ.get('METAPACK_IMPORT_BUDGET', 2.0))
+
+        self.assertLess(float(elapsed), budget)
+
+    def test_mp_subcommands(self):
+        """Only the module of the subcommand being run should be imported"""
+        import subprocess
+        import sys
+        from metapack.cli.mp import command_name
+
+        self.assertEqual('run', command_name(['-v', 'run', '-h']))
+        self.assertIsNone(command_name(['-V']))
+
+        out = subprocess.check_output([sys.executable, '-c',
+                                       "import sys; from metapack.cli.mp import make_parser; "
+                                       "make_parser(['run']); print(' '.join(sys.modules))"],
+                                      universal_newlines=True)
+
+        modules = out.split()
+
+        self.assertIn('metapack.cli.run', modules)
+
+        for m in ('metapack.cli.metapack', 'metapack.cli.metas3', 'metapack.cli.metakan',
+                  'metapack.cli.notebook'):
+            self.assertNotIn(m, modules)
+
+        # The root program's help and versions don't load plugins
+        from unittest.mock import patch
+
+        with patch('metapack.cli.mp.plugin_subcommands', side_effect=AssertionError):
+            from metapack.cli.mp import make_parser
+            make_parser([])
+            make_parser(['-V'])
+
+    def test_writers(self):
+        from io import BytesIO
+        from datetime import date
+        from metapack.writers import select_rows, write_rows, format_for_path
+
+        rows = [['a', 'b', 'c']] + [[i, 'x,y' if i == 2 else 'z', date(2020, 1, i + 1)] for i in range(5)]
+
+        b = BytesIO()
+        self.assertEqual(3, write_rows(b, select_rows(rows, ['c', 'a'], 1, 3), 'csv'))
+        self.assertEqual('c,a\n2020-01-02,1\n2020-01-03,2\n2020-01-04,3\n', b.getvalue().decode('utf8'))
+
+        b = BytesIO()
+        write_rows(b, select_rows(rows, limit=3), 'csv')
+        self.assertIn('2,"x,y",2020-01-03', b.getvalue().decode('utf8'))
+
+        b = BytesIO()
+        write_rows(b, select_rows(rows, ['b', 'c'], offset=4), 'jsonl')
+        self.assertEqual('{"b":"z","c":"2020-01-05"}\n', b.getvalue().decode('utf8'))
+
+        self.assertEqual([['b'], ('z',)], list(select_rows(rows, ['b'], limit=1)))
+
+        from metapack.writers import filter_rows
+
+        self.assertEqual([['a', 'b', 'c'], [3, 'z', date(2020, 1, 4)]],
+                         list(filter_rows(rows, ['a>=3', 'c<2020-01-05'])))
+
+        self.assertEqual(['a', 'b', 'c'], next(filter_rows(rows, ['b=x,y'])))
+        self.assertEqual(1, len(list(filter_rows(rows, ['b=x,y']))[1:]))
+
+        self.assertEqual('parquet', format_for_path('/tmp/out.parquet'))
+        self.assertIsNone(format_for_path('-'))
+
+    def test_stats(self):
+        from metapack.stats import profile, HyperLogLog
+
+        rows = [['id', 'cat', 'x']] + [[i, 'a' if i % 4 else 'b', None if i % 10 == 0 else float(i % 7)]
+                                       for i in range(1000)]
+
+        id_, cat, x = [s.dict() for s in profile(rows)]
+
+        self.assertEqual(1000, id_['count'])
+        self.assertEqual(0, id_['min'])
+        self.assertEqual(999, id_['max'])
+        self.assertAlmostEqual(499.5, id_['mean'])
+        self.assertEqual(1000, id_['distinct'])
+
+        self.assertEqual(2, cat['distinct'])
+        self.assertEqual([('a', 750), ('b', 250)], cat['top'])
+
+        self.assertEqual(100, x['nulls'])
+        self.assertEqual(7, x['distinct'])
+        self.assertEqual(6.0, x['max'])
+
+        hll = HyperLogLog()
+        for i in range(50000):
+            hll.add(str(i))
+
+        self.assertLess(abs(len(hll) - 50000), 4000)
+
+    def test_discover_packages(self):
+        from tempfile import mkdtemp
+        from os import makedirs
+        from os.path import join
+        from metapack.cli.metapack import discover_packages
+
+        d = mkdtemp()
+
+        for p in ('a', 'b/c', 'b/_packages/b-1', '.git'):
+            makedirs(join(d, p))
+            with open(join(d, p, 'metadata.csv'), 'w') as f:
+                f.write('Declare,metatab-latest\n')
+
+        self.assertEqual([join(d, 'a', 'metadata.csv'), join(d, 'b', 'c', 'metadata.csv')],
+                         discover_packages(d))
+
+        with open(join(d, 'list.txt'), 'w') as f:
+            f.write('# Packages\nb/c\n\na/metadata.csv\n')
+
+        self.assertEqual([join(d, 'b', 'c', 'metadata.csv'), join(d, 'a', 'metadata.csv')],
+                         discover_packages(join(d, 'list.txt')))
+
+    def test_run_batch(self):
+        import argparse
+        import json
+        from tempfile import mkdtemp
+        from os import makedirs
+        from os.path import join
+        from metapack.cli.metapack import metapack, run_batch
+
+        d = mkdtemp()
+
+        makedirs(join(d, 'a'))
+        with open(join(d, 'a', 'metadata.csv'), 'w') as f:
+            f.write('Declare,metatab-latest\nIdentifier,a0b1c2d3\nName,example.com-batch-a\n')
+
+        with open(join(d, 'list.txt'), 'w') as f:
+            f.write('a\nmissing/metadata.csv\n')
+
+        parser = argparse.ArgumentParser()
+        metapack(parser.add_subparsers())
+
+        report = join(d, 'report.json')
+
+        args = parser.parse_args(['pack', '-B', join(d, 'list.txt'), '-j', '1', '--batch-report', report])
+
+        with self.assertRaises(SystemExit) as cm:
+            run_batch(args)
+
+        self.assertEqual(1, cm.exception.code)
+
+        with open(report) as f:
+            results = {r['path']: r for r in json.load(f)}
+
+        self.assertEqual([join(d, 'a', 'metadata.csv'), join(d, 'missing', 'metadata.csv')], sorted(results))
+
+        good = results[join(d, 'a', 'metadata.csv')]
+        bad = results[join(d, 'missing', 'metadata.csv')]
+
+        self.assertTrue(good['ok'])
+        self.assertIsNone(good['error'])
+        self.assertEqual([], good['packages'])
+
+        self.assertFalse(bad['ok'])
+        self.assertTrue(bad['error'])
+
+    def test_revalidate_option(self):
+        import argparse
+        from tempfile import mkdtemp
+        from os.path import join
+        from metapack.cli.metapack import metapack, run_metapack
+
+        d = mkdtemp()
+
+        with open(join(d, 'metadata.csv'), 'w') as f:
+            f.write('Declare,metatab-latest\nIdentifier,b1c2d3e4\nName,example.com-revalidate\n')
+
+        parser = argparse.ArgumentParser()
+        metapack(parser.add_subparsers())
+
+        try:
+            args = parser.parse_args(['pack', '-i', '--revalidate', '0', join(d, 'metadata.csv')])
+
+            with self.assertRaises(SystemExit):
+                run_metapack(args)
+
+            # The option is applied after the config's revalidation policy, so it isn't reset
+            self.assertEqual(0, Downloader.max_age)
+
+        finally:
+            Downloader.configure_revalidation()
+
+    def test_resolve_distributions(self):
+        from tempfile import mkdtemp
+        from os import makedirs
+        from os.path import join
+        from metapack.cli.core import resolve_distributions
+
+        d = mkdtemp()
+
+        makedirs(join(d, 'a'))
+        with open(join(d, 'a', 'metadata.csv'), 'w') as f:
+            f.write('Declare,metatab-latest\nIdentifier,a0b1c2d3\nName,example.com-dist-a\n')
+
+        with open(join(d, 'metadata.csv'), 'w') as f:
+            f.write('Declare,metatab-latest\nIdentifier,e4f5a6b7\nName,example.com-dist\n')
+            f.write('Distribution,{}\n'.format(join(d, 'a', 'metadata.csv')))
+            f.write('Distribution,{}\n'.format(join(d, 'missing', 'metadata.csv')))
+
+        good, bad = resolve_distributions(MetapackDoc(join(d, 'metadata.csv')), max_workers=2)
+
+        self.assertEqual('fs', good.type)
+        self.assertIsNone(good.error)
+        self.assertEqual('example.com-dist-a', good.doc.get_value('Root.Name'))
+
+        self.assertEqual('fs', bad.type)
+        self.assertIsNotNone(bad.error)
+        self.assertIsNone(bad.doc)
+
+    def test_serve(self):
+        import json
+        from threading import Thread
+        from urllib.request import urlopen, Request
+        from urllib.error import HTTPError
+        from metapack.cli.serve import PackageService, make_handler, _Server
+
+        service = PackageService()
+        p = service.add(test_data('packages/example.com/example.com-simple_example-2017-us/metadata.csv'))
+
+        server = _Server(('127.0.0.1', 0), make_handler(service))
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        def get_json(url):
+            with urlopen(url) as r:
+                return json.loads(r.read().decode('utf8'))
+
+        try:
+            self.assertEqual([p.name], [e['name'] for e in get_json(base + '/')])
+
+            md = get_json(base + '/packages/' + p.name)
+            self.assertIn('random-names', [r['name'] for r in md['resources']])
+
+            with urlopen(base + '/packages/{}/resources/random-names.jsonl?limit=3&columns=name'
+                         .format(p.name)) as r:
+                etag = r.headers['ETag']
+                lines = r.read().decode('utf8').splitlines()
+
+            self.assertEqual(3, len(lines))
+            self.assertEqual(['name'], list(json.loads(lines[0]).keys()))
+
+            with self.assertRaises(HTTPError) as e:
+                urlopen(Request(base + '/packages/{}/resources/random-names.jsonl?limit=3&columns=name'
+                                .format(p.name), headers={'If-None-Match': etag}))
+            self.assertEqual(304, e.exception.code)
+
+            with self.assertRaises(HTTPError) as e:
+                urlopen(base + '/packages/{}/resources/random-names.csv?columns=nope'.format(p.name))
+            self.assertEqual(400, e.exception.code)
+
+            with self.assertRaises(HTTPError) as e:
+                urlopen(base + '/packages/nope')
+            self.assertEqual(404, e.exception.code)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_struct_builder(self):
+        import json
+        from datetime import date
+        from rowpipe.json import add_to_struct, VTEncoder
+        from metapack.jsonstruct import compile_struct_builder, make_encoder
+
+        row = [1, 'a', 2.5, date(2017, 1, 2)]
+
+        for json_headers in ([(0, 'id'), (1, 'name'), (2, 'x'), (3, 'date')],
+                             [(0, 'id'), (1, 'geo.name'), (2, 'geo.x'), (3, 'date')],
+                             [(0, 'id'), (1, 'items[].name'), (2, 'items[-].x'), (3, 'items[].date')],
+                             [(0, 'a'), (1, 'a.b'), (2, 'c'), (3, 'd')]):
+
+            d = {}
+
+            try:
+                for pos, path in json_headers:
+                    add_to_struct(d, path, row[pos])
+            except Exception as e:
+                with self.assertRaises(type(e)):
+                    compile_struct_builder(json_headers)(row)
+                continue
+
+            s = compile_struct_builder(json_headers)(row)
+
+            self.assertEqual(d, s)
+            self.assertEqual(json.dumps(d, cls=VTEncoder), make_encoder('json')(s))
+
+    def test_row_index(self):
+        from os import utime
+        from os.path import join
+        from tempfile import mkdtemp
+        from metapack.util import write_csv
+        from metapack.rowindex import RowIndex, row_index_path
+
+        path = join(mkdtemp(), 'rows.csv')
+
+        rows = [[i, 'a\nb' if i % 7 == 0 else 'ü'] for i in range(2500)]
+
+        write_csv(path, ['n', 'v'], rows, index_path=row_index_path(path))
+
+        index = RowIndex.load(path)
+
+        self.assertEqual(2500, index.nrows)
+        self.assertEqual(3, len(index.offsets))
+
+        self.assertEqual([['1400', 'a\nb'], ['1401', 'ü']], list(index.read(1400, 1402)))
+        self.assertEqual(['2498', '2499'], [r[0] for r in index.read(2498, 5000)])
+        self.assertEqual([], list(index.read(2500)))
+
+        self.assertEqual([0, 999, 1000, 2499], [n for n, row in index.read_rows([2499, 1000, 0, 999, 3000])])
+        self.assertTrue(all(int(row[0]) == n for n, row in index.read_rows(range(0, 2500, 37))))
+
+        utime(path, (0, 0))  # The index is ignored after the data file changes
+        self.assertIsNone(RowIndex.load(path))
+
+    def test_sampling(self):
+        import random
+        from collections import Counter
+        from metapack.sampling import reservoir_sample, stratified_sample
+
+        rows = [[i, 'abc'[i % 3]] for i in range(10000)]
+
+        s = reservoir_sample(iter(rows), 100, random.Random(1))
+
+        self.assertEqual(100, len(s))
+        self.assertEqual(sorted(n for n, row in s), [n for n, row in s])
+        self.assertTrue(all(rows[n] == row for n, row in s))
+        self.assertEqual(s, reservoir_sample(iter(rows), 100, random.Random(1)))
+
+        self.assertEqual(5, len(reservoir_sample(rows[:5], 100, random.Random())))
+        self.assertEqual([], reservoir_sample(rows, 0, random.Random()))
+
+        # Each row should be selected about equally often
+        counts = Counter(n // 1000 for i in range(200) for n, _ in reservoir_sample(rows, 50, random.Random(i)))
+        self.assertTrue(all(800 < c < 1200 for c in counts.values()), counts)
+
+        s = stratified_sample(rows[:20], 2, lambda row: row[1], random.Random(2))
+
+        self.assertEqual({'a': 2, 'b': 2, 'c': 2}, Counter(row[1] for n, row in s))
+        self.assertEqual(sorted(n for n, row in s), [n for n, row in s])
+
+    def test_key_index(self):
+        from os import utime
+        from os.path import join
+        from tempfile import mkdtemp
+        from metapack.util import write_csv
+        from metapack.exc import MetapackError
+        from metapack.keyindex import build_key_index, KeyIndex, indexed_columns, schema_index_columns
+
+        path = join(mkdtemp(), 'rows.csv')
+
+        rows = [[i, '{:05d}'.format(i % 500), 'a\n"b"' if i % 7 == 0 else 'ü'] for i in range(5000)]
+
+        write_csv(path, ['n', 'geoid', 'v'], rows)
+
+        build_key_index(path, 'geoid')
+
+        self.assertEqual(['geoid'], indexed_columns(path))
+
+        with KeyIndex.load(path, 'geoid') as index:
+            self.assertEqual(5000, index.nkeys)
+
+            found = [row for _, row in index.read(index.offsets('00042'))]
+
+            self.assertEqual([str(i) for i in range(42, 5000, 500)], [row[0] for row in found])
+            self.assertEqual(['00042', 'a\n"b"'], found[0][1:])
+
+            self.assertEqual([], index.offsets(42))
+            self.assertEqual([], index.offsets('99999'))
+
+        with self.assertRaises(MetapackError):
+            build_key_index(path, 'nope')
+
+        self.assertEqual(['geoid'], schema_index_columns([{'header': 'geoid', 'index': 'true'},
+                                                          {'header': 'n', 'index': 'no'}, {'header': 'v'}]))
+
+        utime(path, (0, 0))
+        self.assertIsNone(KeyIndex.load(path, 'geoid'))
+
+    def test_resource_lookup(self):
+        from os import makedirs
+        from os.path import join
+        from tempfile import mkdtemp
+        from metapack.util import write_csv
+
+        d = mkdtemp()
+        makedirs(join(d, 'data'))
+
+        write_csv(join(d, 'data', 'rows.csv'), ['n', 'geoid', 'v'],
+                  [[i, '{:05d}'.format(i % 50), 'ü'] for i in range(200)])
+
+        with open(join(d, 'metadata.csv'), 'w') as f:
+            f.write('\n'.join(['Declare,metatab-latest', 'Identifier,c3d4e5f6', 'Name,example.com-lookup',
+                               'Section,Resources,Name', 'Datafile,data/rows.csv,rows',
+                               'Section,Schema,DataType', 'Table,rows', 'Table.Column,n,integer',
+                               'Table.Column,geoid,string', 'Table.Column,v,string']) + '\n')
+
+        r = MetapackDoc(join(d, 'metadata.csv')).resource('rows')
+
+        # Without an index, the data file is scanned
+        scanned = r.lookup_many(['00007', '00099', 7], column='geoid')
+
+        self.assertEqual(['00007', '00099', 7], list(scanned))
+        self.assertEqual([7, 57, 107, 157], [int(row[0]) for row in scanned['00007']])
+        self.assertEqual(['00007', 'ü'], list(scanned['00007'][0][1:]))
+        self.assertEqual([], scanned['00099'])
+        self.assertEqual([], scanned[7])  # Keys are compared to the text in the file
+
+        r.build_index('geoid')
+
+        # With an index, the indexed column is the default, and the results are the same
+        self.assertEqual(scanned, r.lookup_many(['00007', '00099', 7]))
+        self.assertEqual(scanned['00007'], r.lookup('00007'))
+
+    def test_cache_evict(self):
+        from fs.osfs import OSFS
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os import utime, makedirs
+        from os.path import join, exists
+        from metapack.cache import CacheManager, parse_size
+
+        self.assertEqual(500 * 1024 ** 2, parse_size('500M'))
+        self.assertEqual(10 * 1024 ** 3, parse_size('10GB'))
+        self.assertEqual(100, parse_size('100'))
+
+        d = mkdtemp()
+
+        try:
+            makedirs(join(d, 'example.com'))
+
+            for i, name in enumerate(['a', 'b', 'c', 'd']):
+                p = join(d, 'example.com', name)
+                with open(p, 'w') as f:
+                    f.write('x' * 100)
+                utime(p, (1000 + i, 1000))  # 'a' is least recently used
+
+            cm = CacheManager(OSFS(d), budget=250)
+            cm.pin('example.com/b')
+
+            evicted = cm.evict(dry_run=True)
+            self.assertEqual(['example.com/a', 'example.com/c'], [e.path for e in evicted])
+            self.assertTrue(exists(join(d, 'example.com', 'a')))
+
+            evicted = cm.evict(keep=['example.com/a'])
+            self.assertEqual(['example.com/c', 'example.com/d'], [e.path for e in evicted])
+            self.assertTrue(exists(join(d, 'example.com', 'b')))
+            self.assertEqual(200, cm.usage()['size'])
+
+        finally:
+            rmtree(d)
+
 
 
 if __name__ == '__main__':
@@ -14,6 +14,37 @@ from rowgenerators import get_generator, RowGeneratorError
 downloader = Downloader()
 
 
+def build_rows_package(nrows, stride):
+    """Build a filesystem package with one resource, 'rows', of nrows rows, with a row index of the given
+    stride. Returns the package's document"""
+    from tempfile import mkdtemp
+    from os import makedirs
+    from os.path import join
+    from unittest.mock import patch
+
+    d = mkdtemp()
+    makedirs(join(d, 'data'))
+
+    with open(join(d, 'data', 'rows.csv'), 'w', encoding='utf8') as f:
+        f.write('n,k,v\n')
+        for i in range(nrows):
+            f.write('{},{},{}\n'.format(i, 'abc'[i % 3], '"a\nb"' if i % 7 == 0 else 'ü'))
+
+    with open(join(d, 'metadata.csv'), 'w') as f:
+        f.write('\n'.join(['Declare,metatab-latest', 'Identifier,e5f6a7b8', 'Name,example.com-rows',
+                           'Section,Resources,Name', 'Datafile,data/rows.csv,rows',
+                           'Section,Schema,DataType', 'Table,rows', 'Table.Column,n,integer',
+                           'Table.Column,k,string', 'Table.Column,v,string']) + '\n')
+
+    m = MetapackUrl(join(d, 'metadata.csv'), downloader=downloader)
+
+    with patch('metapack.rowindex.ROW_INDEX_STRIDE', stride):
+        _, fs_url, _ = make_filesystem_package(m, m.package_url.join_dir(PACKAGE_PREFIX), downloader.cache, {},
+                                               False)
+
+    return MetapackDoc(fs_url, downloader=downloader)
+
+
 class TestPackages(unittest.TestCase):
     def test_resolve_resource_urls(self):
         """Test how resources are resolved in packages. The resource values must be one of:
@@ -123,6 +154,16 @@ class TestPackages(unittest.TestCase):
 
         self.assertEquals(['random-names', 'renter_cost', 'unicode-latin1'], [r.url for r in url.doc.resources()])
 
+        # Reading the workbook creates sidecars for all of the sheets
+        from metapack.sidecar import ExcelSidecar
+
+        rows = list(url.doc.resource('renter_cost'))
+
+        sc = ExcelSidecar(str(url.path), cache)
+        self.assertIn('meta', sc.sheet_names)
+        self.assertIn('unicode-latin1', sc.sheet_names)
+        self.assertEqual(len(rows), len(list(sc.rows('renter_cost'))))
+
         # ZIP
 
         _, url, created = make_zip_package(fs_url, package_dir, cache, {}, False)
@@ -314,6 +355,116 @@ class TestPackages(unittest.TestCase):
 
         print(m.get_resource().get_target().exists())
 
+    def test_resource_rows(self):
+        from itertools import islice
+        from os import remove
+        from metapack.rowindex import row_index_path
+        from metapack.writers import select_rows
+
+        r = build_rows_package(100, 7).resource('rows')
+
+        self.assertIsNotNone(r.row_index)
+
+        ranges = [(0, 5), (6, 8), (7, 30), (95, 200), (50, None), (100, None)]
+
+        def islice_rows(start, stop):
+            return [list(row) for row in islice(r, start + 1, stop + 1 if stop is not None else None)]
+
+        expected = [islice_rows(start, stop) for start, stop in ranges]
+
+        self.assertEqual(expected, [[list(row) for row in r.rows(start, stop)] for start, stop in ranges])
+
+        self.assertEqual(7, int(list(r.rows(7, 8))[0][0]))
+        self.assertEqual(['a\nb'], [row[2] for row in r.rows(7, 8)])
+
+        # select_rows() seeks with the index, and gets the same rows as skipping them
+        self.assertEqual([list(row) for row in select_rows(iter(r), ['n', 'v'], 20, 5)],
+                         [list(row) for row in select_rows(r, ['n', 'v'], 20, 5)])
+
+        # Without the index, rows() reads from the start of the file
+        remove(row_index_path(r._local_csv_path()))
+        self.assertIsNone(r.row_index)
+
+        self.assertEqual(expected, [[list(row) for row in r.rows(start, stop)] for start, stop in ranges])
+
+    def test_resource_sample(self):
+        from collections import Counter
+        from os import remove
+        from metapack.rowindex import row_index_path
+
+        r = build_rows_package(200, 7).resource('rows')
+
+        self.assertIsNotNone(r.row_index)
+
+        def sample(*args, **kwargs):
+            return [list(row) for row in r.sample(*args, **kwargs)]
+
+        def check(rows, n):
+            numbers = [int(row[0]) for row in rows]
+
+            self.assertEqual(n, len(rows))
+            self.assertEqual(sorted(numbers), numbers)  # In file order
+            self.assertEqual(len(set(numbers)), len(numbers))
+
+            # The rows are cast, and are the rows of the resource
+            self.assertTrue(all(isinstance(row[0], int) for row in rows))
+            self.assertTrue(all(row[1] == 'abc'[int(row[0]) % 3] for row in rows))
+
+        indexed = sample(20, seed=1)
+        check(indexed, 20)
+        self.assertEqual(indexed, sample(20, seed=1))
+
+        stratified = sample(4, seed=2, by='k')
+        check(stratified, 12)
+        self.assertEqual({'a': 4, 'b': 4, 'c': 4}, Counter(row[1] for row in stratified))
+        self.assertEqual(stratified, sample(4, seed=2, by='k'))
+
+        self.assertEqual(200, len(sample(500, seed=3)))
+
+        # Without the index, the sample is selected in one pass over the file
+        remove(row_index_path(r._local_csv_path()))
+        self.assertIsNone(r.row_index)
+
+        unindexed = sample(20, seed=1)
+        check(unindexed, 20)
+        self.assertEqual(unindexed, sample(20, seed=1))
+
+    def test_build_offline(self):
+        """In offline mode, web resources are read only from the cache, so building a package with
+        an uncached resource fails, rather than downloading it"""
+        from tempfile import mkdtemp
+        from os.path import join
+        from fs.tempfs import TempFS
+
+        d = mkdtemp()
+
+        url = 'http://example.com/metapack-offline-test/not-cached.csv'
+
+        with open(join(d, 'metadata.csv'), 'w') as f:
+            f.write('\n'.join(['Declare,metatab-latest', 'Identifier,d4e5f6a7', 'Name,example.com-offline',
+                               'Section,Resources,Name', 'Datafile,{},not-cached'.format(url)]) + '\n')
+
+        offline_downloader = Downloader(TempFS())
+
+        m = MetapackUrl(join(d, 'metadata.csv'), downloader=offline_downloader)
+
+        package_dir = m.package_url.join_dir(PACKAGE_PREFIX)
+
+        try:
+            Downloader.configure_lock(None, offline=True)
+
+            r = MetapackDoc(m, downloader=offline_downloader).resource('not-cached')
+
+            self.assertIsInstance(r.resolved_url.downloader, Downloader)
+
+            with self.assertRaises((Exception, SystemExit)):
+                make_filesystem_package(m, package_dir, offline_downloader.cache, {}, False)
+
+        finally:
+            Downloader.configure_lock()
+
+        self.assertFalse(offline_downloader.cache.exists('example.com/metapack-offline-test/not-cached.csv'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -23,6 +23,85 @@ class TestPublish(unittest.TestCase):
         print(get_config())
 
 
+    def test_ckan_rate_limit(self):
+        from time import monotonic
+        from metapack.cli.metakan import RateLimiter, CkanLookups
+
+        rl = RateLimiter(20)
+
+        t = monotonic()
+        for i in range(10):
+            rl.wait()
+
+        self.assertGreater(monotonic() - t, .4)
+
+        class _Action(object):
+            calls = 0
+
+            def organization_show(self, id):
+                self.calls += 1
+                return {'id': id.upper()}
+
+        class _Client(object):
+            action = _Action()
+
+        c = _Client()
+        lookups = CkanLookups()
+
+        for i in range(5):
+            self.assertEqual('EXAMPLE-COM', lookups.organization_id(c, 'example-com'))
+
+        self.assertEqual(1, c.action.calls)
+
+    def test_ckan_package_diff(self):
+        from copy import deepcopy
+        from metapack.cli.metakan import package_hash, changed_package_keys
+
+        old = {
+            'id': 'abc', 'title': 'Title', 'version': 1, 'notes': 'Notes',
+            'groups': [{'name': 'b', 'id': 2}, {'name': 'a', 'id': 1}],
+            'tags': [{'name': 't'}],
+            'extras': [{'key': 'Root.Name', 'value': 'foo'}, {'key': 'Root.Title', 'value': 'Title'}],
+            'resources': [{'name': 'r1', 'url': 'http://example.com/r1.csv', 'format': 'csv',
+                           'id': 'xyz', 'position': 0}],
+            'metadata_modified': '2017-01-01'
+        }
+
+        new = deepcopy(old)
+        new['version'] = '1'
+        new['groups'].reverse()
+        new['extras'].reverse()
+        del new['metadata_modified']
+        del new['resources'][0]['id']
+
+        self.assertEqual(package_hash(old), package_hash(new))
+        self.assertEqual([], changed_package_keys(old, new))
+
+        new['resources'][0]['url'] = 'http://example.com/r2.csv'
+        new['title'] = 'New Title'
+
+        self.assertNotEqual(package_hash(old), package_hash(new))
+        self.assertEqual(['title', 'resources'], changed_package_keys(old, new))
+
+    def test_s3_benchmark(self):
+
+        try:
+            import moto
+        except ImportError:
+            self.skipTest("moto not installed")
+
+        from metapack.test.benchmark_s3 import run_benchmark
+
+        publish, republish, partial = run_benchmark(files=5, size=2000, change_fraction=.4)
+
+        self.assertEqual(5 + 1, publish['by_operation'].get('PutObject'))
+        self.assertGreater(publish['bytes_sent'], 5 * 2000)
+
+        # Nothing changed, so nothing should be written
+        self.assertIsNone(republish['by_operation'].get('PutObject'))
+
+        self.assertEqual(2, partial['by_operation'].get('PutObject'))
+
     @unittest.skip("Need Sensible Credentials")
     def test_publish_wp(self):
         pass
@@ -7,6 +7,7 @@ import os
 import shutil
 from genericpath import exists
 from os import makedirs
+from functools import lru_cache
 from os.path import join, basename, dirname
 
 import unicodecsv as csv
@@ -14,8 +15,10 @@ import unicodecsv as csv
 
 from appurl.util import slugify # Unused here, but imported from elsewhere.
 
+@lru_cache()
 def declaration_path(name):
-    """Return the path to an included declaration"""
+    """Return the path to an included declaration. The result is memoized, since the
+    declaration files are installed with the package and don't move"""
     from os.path import dirname, join, exists
     import metatab.declarations
     from metatab.exc import IncludeError
@@ -302,34 +305,56 @@ def copytree(src, dst, symlinks=False, ignore=None):
             shutil.copy2(s, d)
 
 
-def write_csv(path_or_flo, headers, gen):
+def write_csv(path_or_flo, headers, gen, index_path=None):
+    """Write a header and rows to a CSV file. If index_path is given, path_or_flo must be a path, and
+    a row offset index for the file, as described in metapack.rowindex, is written to index_path """
+
     try:
         f = open(path_or_flo, "wb")
 
     except TypeError:
         f = path_or_flo  # Assume that it's already a file-like-object
 
+    index = None
+
     try:
         w = csv.writer(f)
         w.writerow(headers)
 
+        if index_path:
+            from metapack.rowindex import RowIndexWriter
+            index = RowIndexWriter(path_or_flo, f)
+            before_row = index.before_row
+        else:
+            before_row = None
+
         row = None
         try:
-            for row in gen:
-                w.writerow(row)
+            if before_row:
+                for row in gen:
+                    before_row()
+                    w.writerow(row)
+            else:
+                for row in gen:
+                    w.writerow(row)
         except:
             import sys
             print("write_csv: ERROR IN ROW", row, file=sys.stderr)
             raise
 
         try:
-            return f.getvalue()
+            value = f.getvalue()
         except AttributeError:
-            return None
+            value = None
 
     finally:
         f.close()
 
+    if index is not None:
+        index.index().write(index_path)
+
+    return value
+
 
 def datetime_now():
     import datetime
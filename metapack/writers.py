@@ -0,0 +1,489 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Buffered writers that stream the rows of a resource to a binary file, as CSV, TSV, JSON Lines,
+Parquet or Arrow IPC. Rows are written in batches, so the cost of a write is paid once per batch
+rather than once per row.
+"""
+
+import io
+import json
+import operator
+import re
+import sys
+from datetime import date, datetime, time
+from decimal import Decimal
+from itertools import islice
+from operator import itemgetter
+
+from metapack.exc import MetapackError
+
+BUFFER_SIZE = 1024 * 1024
+
+BATCH_SIZE = 10000
+
+FORMATS = ('csv', 'tsv', 'jsonl', 'parquet', 'arrow')
+
+_extensions = {
+    '.csv': 'csv',
+    '.tsv': 'tsv',
+    '.tab': 'tsv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.ipc': 'arrow',
+}
+
+
+def format_for_path(path, default=None):
+    """Return the output format for a file path, from its extension"""
+    from os.path import splitext
+
+    if not path or path == '-':
+        return default
+
+    return _extensions.get(splitext(path)[1].lower(), default)
+
+
+def open_output(path=None):
+    """Open a file for writing with a large buffer. If the path is None or '-', write to stdout"""
+
+    if not path or path == '-':
+        sys.stdout.flush()
+        return open(sys.stdout.fileno(), 'wb', buffering=BUFFER_SIZE, closefd=False)
+
+    return open(path, 'wb', buffering=BUFFER_SIZE)
+
+
+def select_rows(rows, columns=None, offset=None, limit=None):
+    """Select columns and a range of rows from an iterator of rows that starts with a header row.
+
+    :param rows: Iterator of rows, with the header first, or a Resource. For a resource with a row index,
+    the data rows are read starting at the offset, rather than reading and skipping the earlier rows.
+    :param columns: List of column names to select, or None for all columns
+    :param offset: Number of data rows to skip
+    :param limit: Maximum number of data rows to return
+    :return: Iterator of rows, with the header first
+    """
+
+    stop = (offset or 0) + limit if limit is not None else None
+
+    if offset and getattr(rows, 'row_index', None) is not None and rows.headers:
+        headers = list(rows.headers)
+        rows = rows.rows(offset, stop)
+
+    else:
+        rows = iter(rows)
+
+        headers = next(rows, None)
+
+        if headers is None:
+            return
+
+        headers = list(headers)
+
+        rows = islice(rows, offset or 0, stop)
+
+    if columns:
+        try:
+            idx = [headers.index(c) for c in columns]
+        except ValueError:
+            raise MetapackError("Unknown columns {}; columns are {}"
+                                .format([c for c in columns if c not in headers], headers))
+
+        headers = [headers[i] for i in idx]
+
+        if len(idx) == 1:
+            i = idx[0]
+            rows = ((row[i],) for row in rows)
+        else:
+            rows = map(itemgetter(*idx), rows)
+
+    yield headers
+    yield from rows
+
+
+_FILTER = re.compile(r'^(.+?)(==|!=|<=|>=|=|<|>)(.*)$')
+
+_OPS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def filter_rows(rows, filters):
+    """Select the rows of an iterator of rows, with the header first, that match all of a list of filters.
+    Each filter is a string of a column name, an operator, and a value, such as 'geoid=06073' or 'year>=2010'.
+    The operators are =, ==, !=, <, <=, > and >=. The value is converted to the type of each row's value
+    before it is compared; rows with null or unconvertable values don't match. """
+
+    rows = iter(rows)
+
+    headers = next(rows, None)
+
+    if headers is None:
+        return
+
+    tests = []
+
+    for f in filters:
+        m = _FILTER.match(f)
+
+        if not m:
+            raise MetapackError("Bad filter '{}'; expected a column, an operator and a value".format(f))
+
+        col, op, value = m.groups()
+
+        try:
+            tests.append((list(headers).index(col.strip()), _OPS[op], value, {}))
+        except ValueError:
+            raise MetapackError("Unknown column '{}' in filter '{}'".format(col.strip(), f))
+
+    def match(row):
+        for i, op, value, converted in tests:
+            v = row[i]
+
+            if v is None:
+                return False
+
+            t = type(v)
+
+            try:
+                target = converted[t]
+            except KeyError:
+                try:
+                    target = converted[t] = _convert(t, value)
+                except (TypeError, ValueError):
+                    target = converted[t] = _NO_MATCH
+
+            if target is _NO_MATCH:
+                return False
+
+            try:
+                if not op(v, target):
+                    return False
+            except TypeError:
+                return False
+
+        return True
+
+    yield headers
+    yield from filter(match, rows)
+
+
+_NO_MATCH = object()
+
+
+def _convert(t, value):
+    """Convert a filter value string to type t"""
+
+    if t is str:
+        return value
+    elif t is bool:
+        return value.lower() in ('1', 'true', 't', 'yes', 'y')
+    elif issubclass(t, (date, time)):  # Dates, times and datetimes
+        return _parse_iso(t, value)
+    else:
+        return t(value)
+
+
+_ISO_FORMATS = (
+    (datetime, ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')),
+    (date, ('%Y-%m-%d',)),
+    (time, ('%H:%M:%S.%f', '%H:%M:%S', '%H:%M')),
+)
+
+
+def _parse_iso(t, value):
+    """Parse an ISO 8601 date, time or datetime string, for the type t"""
+
+    value = value.strip()
+
+    for base, formats in _ISO_FORMATS:  # datetime first, since it is a subclass of date
+        if issubclass(t, base):
+            for fmt in formats:
+                try:
+                    dt = datetime.strptime(value, fmt)
+                except ValueError:
+                    continue
+
+                if base is date:
+                    return dt.date()
+                elif base is time:
+                    return dt.time()
+                else:
+                    return dt
+
+    raise ValueError("Can't parse '{}' as an ISO {}".format(value, t.__name__))
+
+
+def _batches(rows, n=BATCH_SIZE):
+    while True:
+        batch = list(islice(rows, n))
+        if not batch:
+            return
+        yield batch
+
+
+def _json_default(o):
+    if isinstance(o, (date, datetime, time)):
+        return o.isoformat()
+    elif isinstance(o, Decimal):
+        return float(o)
+
+    return str(o)
+
+
+class RowWriter(object):
+    """Base class for writers. Subclasses implement write_batch(), and may implement
+    start() and finish() """
+
+    def __init__(self, f, columns=None):
+        """
+        :param f: Binary file to write to
+        :param columns: Optional column descriptions, as yielded by Resource.columns(), used for
+        the types of Parquet and Arrow columns.
+        """
+        self.f = f
+        self.columns = columns
+        self.headers = None
+        self.count = 0
+
+    def start(self):
+        pass
+
+    def write_batch(self, rows):
+        raise NotImplementedError()
+
+    def finish(self):
+        pass
+
+    def write(self, rows):
+        """Write an iterator of rows, with the header first, and return the number of data rows"""
+
+        rows = iter(rows)
+
+        self.headers = next(rows, None)
+
+        if self.headers is None:
+            return 0
+
+        self.start()
+
+        for batch in _batches(rows):
+            self.write_batch(batch)
+            self.count += len(batch)
+
+        self.finish()
+
+        return self.count
+
+
+class _TextWriter(RowWriter):
+    """A writer that writes text through a buffered UTF-8 wrapper"""
+
+    def start(self):
+        self.text = io.TextIOWrapper(self.f, encoding='utf-8', newline='', write_through=False)
+
+    def finish(self):
+        self.text.flush()
+        self.text.detach()  # Don't close the underlying file
+
+
+class CsvWriter(_TextWriter):
+
+    delimiter = ','
+
+    def start(self):
+        import csv
+
+        super().start()
+        self.writer = csv.writer(self.text, delimiter=self.delimiter, lineterminator='\n')
+        self.writer.writerow(self.headers)
+
+    def write_batch(self, rows):
+        self.writer.writerows(rows)
+
+
+class TsvWriter(CsvWriter):
+
+    delimiter = '\t'
+
+
+class JsonLinesWriter(_TextWriter):
+    """Write each row as a JSON object, keyed by the headers"""
+
+    def start(self):
+        super().start()
+        self.encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_json_default).encode
+
+    def write_batch(self, rows):
+        headers = self.headers
+        encode = self.encode
+
+        self.text.write('\n'.join([encode(dict(zip(headers, row))) for row in rows]))
+        self.text.write('\n')
+
+
+class ArrowWriter(RowWriter):
+    """Write rows as an Arrow IPC stream, one record batch per batch of rows"""
+
+    type_map = {
+        'integer': 'int64',
+        'int': 'int64',
+        'number': 'float64',
+        'float': 'float64',
+        'boolean': 'bool_',
+        'bool': 'bool_',
+        'date': 'date32',
+        'string': 'string',
+        'str': 'string',
+        'text': 'string',
+    }
+
+    def __init__(self, f, columns=None):
+        super().__init__(f, columns)
+
+        try:
+            import pyarrow
+        except ImportError:
+            raise MetapackError("Writing {} requires the pyarrow package".format(type(self).__name__))
+
+        self.pa = pyarrow
+        self.schema = None
+        self.writer = None
+
+    def _declared_type(self, dt):
+        pa = self.pa
+
+        if dt == 'datetime':
+            return pa.timestamp('us')
+        elif dt in self.type_map:
+            return getattr(pa, self.type_map[dt])()
+        else:
+            return None
+
+    def _array(self, values, t):
+        """Convert a column of values to an Arrow array. Values that can't be converted become nulls"""
+        pa = self.pa
+
+        try:
+            return pa.array(values, type=t)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+            pass
+
+        def coerce(v):
+            try:
+                return pa.scalar(v, type=t).as_py()
+            except Exception:
+                return None
+
+        return pa.array([coerce(v) for v in values], type=t)
+
+    def _make_schema(self, batch):
+        pa = self.pa
+
+        datatypes = {c.get('header'): c.get('datatype') for c in (self.columns or [])}
+
+        fields = []
+
+        for i, h in enumerate(self.headers):
+
+            t = self._declared_type(datatypes.get(h))
+
+            if t is None:
+                try:
+                    t = pa.array([row[i] for row in batch]).type
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    t = pa.string()
+
+                if pa.types.is_null(t):
+                    t = pa.string()
+
+            fields.append(pa.field(str(h), t))
+
+        return pa.schema(fields)
+
+    def _open_writer(self):
+        return self.pa.ipc.new_stream(self.f, self.schema)
+
+    def _record_batch(self, rows):
+        columns = list(zip(*rows)) if rows else [[] for _ in self.headers]
+
+        arrays = [self._array(list(c), f.type) for c, f in zip(columns, self.schema)]
+
+        return self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def write_batch(self, rows):
+
+        if self.writer is None:
+            self.schema = self._make_schema(rows)
+            self.writer = self._open_writer()
+
+        self.writer.write_batch(self._record_batch(rows))
+
+    def finish(self):
+
+        if self.writer is None:  # No data rows
+            self.schema = self._make_schema([])
+            self.writer = self._open_writer()
+
+        self.writer.close()
+
+
+class ParquetWriter(ArrowWriter):
+    """Write rows to a Parquet file, one row group per batch of rows"""
+
+    def _open_writer(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise MetapackError("Writing Parquet requires the pyarrow package, built with Parquet support")
+
+        return pq.ParquetWriter(self.f, self.schema)
+
+    def write_batch(self, rows):
+
+        if self.writer is None:
+            self.schema = self._make_schema(rows)
+            self.writer = self._open_writer()
+
+        self.writer.write_table(self.pa.Table.from_batches([self._record_batch(rows)]))
+
+
+writers = {
+    'csv': CsvWriter,
+    'tsv': TsvWriter,
+    'jsonl': JsonLinesWriter,
+    'arrow': ArrowWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def write_rows(f, rows, format='csv', columns=None):
+    """Write rows, with the header first, to a binary file, and return the number of data rows written
+
+    :param f: Binary file
+    :param rows: Iterator of rows, with the header first
+    :param format: One of FORMATS
+    :param columns: Optional column descriptions, as yielded by Resource.columns()
+    """
+
+    try:
+        cls = writers[format]
+    except KeyError:
+        raise MetapackError("Unknown output format '{}'; formats are {}".format(format, FORMATS))
+
+    n = cls(f, columns).write(rows)
+
+    f.flush()
+
+    return n
@@ -0,0 +1,394 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Read members of ZIP archives, such as ZIP packages, without extracting them.
+
+The central directory of each archive is read once and stored as an index in the download cache,
+so later reads go directly to the member's local header. Members are decompressed as they are read.
+Archives may be local files, or HTTP or S3 URLs; for remote archives, only the central directory and the
+bytes of the requested member are fetched, with range requests, unless the Downloader is offline or
+has a lockfile, in which case the whole archive is read through the Downloader's cache.
+"""
+
+import io
+import json
+import struct
+import zlib
+from collections import namedtuple
+from hashlib import sha1
+from os import stat
+from urllib.parse import urlparse
+
+from metapack.exc import ArchiveError
+
+INDEX_DIR = '_zipindex'
+
+CHUNK_SIZE = 256 * 1024
+
+ZipMember = namedtuple('ZipMember', 'name offset compress_size file_size compress_type flags crc')
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_HEADER_SIG = b'PK\x03\x04'
+
+
+class _LocalFile(object):
+    """Byte range access to a local file"""
+
+    def __init__(self, path):
+        self.path = path
+        st = stat(path)
+        self.size = st.st_size
+        self.validator = [st.st_size, st.st_mtime_ns]
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def iter_range(self, start, end):
+
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                b = f.read(min(CHUNK_SIZE, remaining))
+                if not b:
+                    break
+                remaining -= len(b)
+                yield b
+
+
+class _HttpFile(object):
+    """Byte range access to a file on a web server that supports range requests"""
+
+    def __init__(self, url):
+        import requests
+
+        self.url = url
+        self.session = requests.Session()
+
+        r = self.session.head(url, allow_redirects=True)
+        r.raise_for_status()
+
+        if r.headers.get('Accept-Ranges', '').lower() != 'bytes' or 'Content-Length' not in r.headers:
+            raise ArchiveError("Server does not support range requests for '{}'".format(url))
+
+        self.size = int(r.headers['Content-Length'])
+        self.validator = [self.size, r.headers.get('ETag'), r.headers.get('Last-Modified')]
+
+    def open(self):
+        return io.BufferedReader(RangeFile(self), CHUNK_SIZE)
+
+    def read_range(self, start, end):
+        return b''.join(self.iter_range(start, end))
+
+    def iter_range(self, start, end):
+
+        if end <= start:
+            return
+
+        r = self.session.get(self.url, headers={'Range': 'bytes={}-{}'.format(start, end - 1)}, stream=True)
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            r.close()
+            raise ArchiveError("Server ignored range request for '{}'".format(self.url))
+
+        try:
+            yield from r.iter_content(CHUNK_SIZE)
+        finally:
+            r.close()
+
+
+class _S3File(object):
+    """Byte range access to an S3 object"""
+
+    def __init__(self, bucket, key):
+        from metapack.package.s3 import get_s3_client
+
+        self.bucket = bucket
+        self.key = key
+        self.client = get_s3_client()
+
+        h = self.client.head_object(Bucket=bucket, Key=key)
+
+        self.size = h['ContentLength']
+        self.validator = [self.size, h.get('ETag')]
+
+    def open(self):
+        return io.BufferedReader(RangeFile(self), CHUNK_SIZE)
+
+    def read_range(self, start, end):
+        return b''.join(self.iter_range(start, end))
+
+    def iter_range(self, start, end):
+
+        if end <= start:
+            return
+
+        r = self.client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes={}-{}'.format(start, end - 1))
+
+        body = r['Body']
+
+        try:
+            while True:
+                b = body.read(CHUNK_SIZE)
+                if not b:
+                    break
+                yield b
+        finally:
+            body.close()
+
+
+class RangeFile(io.RawIOBase):
+    """A seekable, read-only file that reads a remote file with range requests"""
+
+    def __init__(self, source):
+        self.source = source
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.source.size + offset
+
+        return self.pos
+
+    def readinto(self, b):
+
+        end = min(self.pos + len(b), self.source.size)
+
+        if end <= self.pos:
+            return 0
+
+        data = self.source.read_range(self.pos, end)
+        b[:len(data)] = data
+        self.pos += len(data)
+
+        return len(data)
+
+
+class _MemberStream(io.RawIOBase):
+    """Decompress a member of a zip archive as it is read"""
+
+    def __init__(self, chunks, compress_type):
+        import bz2
+
+        self._chunks = chunks
+        self._buf = b''
+
+        if compress_type == 0:
+            self._decompress = None
+        elif compress_type == 8:
+            self._decompress = zlib.decompressobj(-15)
+        elif compress_type == 12:
+            self._decompress = bz2.BZ2Decompressor()
+        else:
+            raise ArchiveError("Unsupported zip compression type {}".format(compress_type))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+
+        while not self._buf:
+            chunk = next(self._chunks, None)
+
+            if chunk is None:
+                if self._decompress is not None and hasattr(self._decompress, 'flush'):
+                    self._buf = self._decompress.flush()
+                    self._decompress = None
+                    if self._buf:
+                        break
+                return 0
+
+            self._buf = self._decompress.decompress(chunk) if self._decompress else chunk
+
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+
+        return n
+
+    def close(self):
+        try:
+            self._chunks.close()
+        except AttributeError:
+            pass
+
+        super().close()
+
+
+class ZipArchive(object):
+    """A ZIP archive, with a cached index of its members, that can stream members without
+    extracting the archive """
+
+    _memo = {}
+
+    def __init__(self, url, downloader=None):
+        """
+        :param url: Path or URL to the archive. May be a file path, or a file, http, https or s3 URL.
+        :param downloader: Downloader for the cache in which to store the index. If the archive is remote
+        and the downloader has a cached copy, the cached copy is read instead.
+        """
+
+        self.url = str(url)
+        self.downloader = downloader
+        self.source = self._open_source()
+        self._index = None
+
+    def _open_source(self):
+
+        u = urlparse(self.url)
+
+        if u.scheme in ('', 'file'):
+            return _LocalFile(u.path)
+
+        if self.downloader is not None:
+            from metapack.cache import cache_path_for_url
+
+            if getattr(self.downloader, 'offline', False) or getattr(self.downloader, 'lockfile', None):
+                # Range requests would bypass the offline mode and the lockfile, so go through the
+                # downloader, which resolves the URL from the lockfile, or records it
+                cache_path, _ = self.downloader._download_with_lock(self.url)
+                return _LocalFile(self.downloader.cache.getsyspath(cache_path))
+
+            cp = cache_path_for_url(self.url)
+
+            if self.downloader.cache.exists(cp):
+                return _LocalFile(self.downloader.cache.getsyspath(cp))
+
+        if u.scheme in ('http', 'https'):
+            return _HttpFile(self.url)
+        elif u.scheme == 's3':
+            return _S3File(u.netloc, u.path.lstrip('/'))
+
+        raise ArchiveError("Can't read a zip archive from '{}'".format(self.url))
+
+    @property
+    def _index_path(self):
+        return '{}/{}.json'.format(INDEX_DIR, sha1(self.url.encode('utf8')).hexdigest())
+
+    def _read_index(self):
+        """Read the index from the download cache, if it is still valid"""
+
+        if self.downloader is None:
+            return None
+
+        try:
+            with self.downloader.cache.open(self._index_path) as f:
+                d = json.load(f)
+        except Exception:
+            return None
+
+        if d.get('validator') != self.source.validator:
+            return None
+
+        return {e[0]: ZipMember(*e) for e in d['members']}
+
+    def _write_index(self, index):
+
+        if self.downloader is None:
+            return
+
+        try:
+            self.downloader.cache.makedirs(INDEX_DIR, recreate=True)
+
+            with self.downloader.cache.open(self._index_path, 'w') as f:
+                json.dump({'url': self.url, 'validator': self.source.validator,
+                           'members': [list(m) for m in index.values()]}, f)
+        except Exception:
+            pass  # The index is only an optimization
+
+    def _build_index(self):
+        from zipfile import ZipFile, BadZipFile
+
+        try:
+            with self.source.open() as f:
+                zf = ZipFile(f)
+                return {i.filename: ZipMember(i.filename, i.header_offset, i.compress_size, i.file_size,
+                                              i.compress_type, i.flag_bits, i.CRC)
+                        for i in zf.infolist() if not i.is_dir()}
+        except BadZipFile as e:
+            raise ArchiveError("Bad zip archive '{}': {}".format(self.url, e))
+
+    @property
+    def index(self):
+        """Return a dict of ZipMember tuples, keyed by member name"""
+
+        if self._index is None:
+
+            key = (self.url, json.dumps(self.source.validator))
+
+            self._index = self._memo.get(key)
+
+            if self._index is None:
+                self._index = self._read_index()
+
+                if self._index is None:
+                    self._index = self._build_index()
+                    self._write_index(self._index)
+
+                self._memo[key] = self._index
+
+        return self._index
+
+    def names(self):
+        return list(self.index.keys())
+
+    def find(self, name):
+        """Return the name of the member that matches name, either exactly, or as the final part of
+        a member path. Packages store their files in a top-level directory named for the package. """
+
+        index = self.index
+
+        name = name.lstrip('/')
+
+        if name in index:
+            return name
+
+        for n in index:
+            if n.endswith('/' + name):
+                return n
+
+        raise ArchiveError("No member '{}' in zip archive '{}'".format(name, self.url))
+
+    def open(self, name):
+        """Return a binary file-like object that streams the decompressed member"""
+
+        m = self.index[self.find(name)]
+
+        if m.flags & 0x1:
+            raise ArchiveError("Member '{}' of '{}' is encrypted".format(m.name, self.url))
+
+        header = b''.join(self.source.iter_range(m.offset, m.offset + _LOCAL_HEADER.size))
+
+        sig, _, _, _, _, _, _, _, _, name_len, extra_len = _LOCAL_HEADER.unpack(header)
+
+        if sig != _LOCAL_HEADER_SIG:
+            raise ArchiveError("Bad local header for '{}' in '{}'".format(m.name, self.url))
+
+        start = m.offset + _LOCAL_HEADER.size + name_len + extra_len
+
+        chunks = self.source.iter_range(start, start + m.compress_size)
+
+        return io.BufferedReader(_MemberStream(chunks, m.compress_type), CHUNK_SIZE)
+
+    def open_text(self, name, encoding='utf-8'):
+        return io.TextIOWrapper(self.open(name), encoding=encoding, newline='')
+
+    def read(self, name):
+        with self.open(name) as f:
+            return f.read()
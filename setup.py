@@ -51,6 +51,7 @@ setup_d = dict(
         'tableintuit>=0.0.6',
         'geoid>=1.0.4',
         'terminaltables',
+        'tabulate',
         'docopt',
 
 
@@ -87,7 +88,9 @@ setup_d = dict(
             's3=metapack.cli.metas3:metas3',
             'ckan=metapack.cli.metakan:metakan',
             'notebook=metapack.cli.notebook:notebook',
-            'run=metapack.cli.run:run'
+            'run=metapack.cli.run:run',
+            'cache=metapack.cli.cache:cache',
+            'serve=metapack.cli.serve:serve'
 
         ]
 
@@ -102,6 +105,7 @@ setup_d = dict(
     extras_require={
         'test': ['datapackage'],
         'geo': ['fiona', 'shapely', 'pyproj'],
+        'arrow': ['pyarrow'],
 
     },
 